@@ -6,8 +6,10 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils import executor
 from aiogram.utils.helper import Helper, HelperMode, ListItem
 
+from src.parse_securities.moex_client import startup_moex_client, shutdown_moex_client
 from src.strategies.strategy_macd import get_decision_macd_conservative_strategy
-from src.structures.st_portfolio import Portfolio
+from src.structures.st_clock import VirtualClock
+from src.structures.st_portfolio import SIMULATION_START, Portfolio
 
 
 class TestStates(Helper):
@@ -126,7 +128,7 @@ async def set_weights_command(message: types.Message):
     weights = [float(i) for i in weights]
     if not portfolio_exists:
         portfolio = Portfolio(tickers=tickers, weights=weights, init_balance=float(summa),
-                              strategy=get_decision_macd_conservative_strategy)
+                              strategy=get_decision_macd_conservative_strategy, clock=VirtualClock(SIMULATION_START))
         portfolio_exists = True
 
     try:
@@ -144,7 +146,7 @@ async def set_weights_command(message: types.Message):
     except Exception as e:
         print(e)
         portfolio = Portfolio(tickers=tickers, weights=weights, init_balance=float(summa),
-                              strategy=get_decision_macd_conservative_strategy)
+                              strategy=get_decision_macd_conservative_strategy, clock=VirtualClock(SIMULATION_START))
 
 
 @dp.message_handler(state='*', commands=['cancel', 'Отмена'])
@@ -234,9 +236,15 @@ async def some_test_state_case_met(message: types.Message):
     await message.reply(text, reply=False)
 
 
+async def startup(dispatcher: Dispatcher):
+    # один пул соединений с MOEX на все портфели пользователей бота
+    await startup_moex_client()
+
+
 async def shutdown(dispatcher: Dispatcher):
     await dispatcher.storage.close()
     await dispatcher.storage.wait_closed()
+    await shutdown_moex_client()
 
 
 import nest_asyncio
@@ -244,4 +252,4 @@ import nest_asyncio
 nest_asyncio.apply()
 
 if __name__ == '__main__':
-    executor.start_polling(dp, on_shutdown=shutdown)
+    executor.start_polling(dp, on_startup=startup, on_shutdown=shutdown)
@@ -1,14 +1,35 @@
-import aiohttp
-import aiomoex
+import asyncio
+
 import pandas as pd
+from aiomoex.request_helpers import CANDLES, DEFAULT_BOARD, DEFAULT_ENGINE, DEFAULT_MARKET, make_query, make_url
 
+from src.parse_securities.candle_cache import DATETIME_FORMAT, parse_range_bound
+from src.parse_securities.candles import parse_candles
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+from src.parse_securities.security_master import get_security_master
 from src.structures.st_strategies import DataRequest
 
+DEFAULT_MAX_CONCURRENCY = 10  # сколько тикеров по умолчанию загружается одновременно
+
+# Из документации aiomoex : Размер свечки - целое число 1 (1 минута), 10 (10 минут), 60 (1 час), 24 (1 день),
+# 7 (1 неделя), 31 (1 месяц) или 4 (1 квартал)
+INTERVALS = {'1min': 1, '10min': 10, '1h': 60, '1d': 24, '1w': 7, '1m': 31, '1q': 4}
+
 
-async def get_security_history_aiomoex(request: DataRequest) -> dict:
+async def get_security_history_aiomoex(request: DataRequest,
+                                      max_concurrency: int = None,
+                                      timeout: float = None,
+                                      client: MoexClient = None) -> dict:
     """
     Получить историю цен для указанной ценной бумаги.
 
+    Тикеры запрашиваются конкурентно: одновременно выполняется не больше ``max_concurrency`` запросов,
+    а каждый тикер ограничен собственным ``timeout``. Медленный или упавший тикер не задерживает остальные -
+    для него возвращается ответ с ``ok=False`` и текстом ошибки.
+
+    В ответе только колонки из ``request.columns`` (TRADEDATE - время начала свечи begin). Цены приходят в float64,
+    время начала и конца свечи - в int64 (секунды от эпохи, время биржи).
+
     .. code-block:: python
 
         >>> import asyncio
@@ -17,59 +38,158 @@ async def get_security_history_aiomoex(request: DataRequest) -> dict:
         132.0
 
         >>> asyncio.run(get_security_history_aiomoex(DataRequest(['SBER', 'APPL'], '2022-11-05', '2022-11-05')))
-        {'SBER': {'ok': True, 'message': '', 'data': Empty DataFrame
-        Columns: []
-        Index: []}, 'APPL': {'ok': False, 'message': 'Тикера APPL нет на MOEX', 'data': Empty DataFrame
+        {'SBER': {'ok': True, 'message': '', 'lotsize': 10, 'data': Empty DataFrame
+        Columns: [begin, close]
+        Index: []}, 'APPL': {'ok': False, 'message': 'Тикера APPL нет на MOEX', 'lotsize': None, 'data': Empty DataFrame
         Columns: []
         Index: []}}
 
     :param request: Структура запроса StrategyRequest;
+    :param max_concurrency: максимальное количество одновременно загружаемых тикеров.
+                            По умолчанию DEFAULT_MAX_CONCURRENCY;
+    :param timeout: ограничение по времени на загрузку одного тикера в секундах. None - без ограничения;
+    :param client: клиент MOEX ISS с общим пулом соединений. По умолчанию общий клиент процесса;
     :return: словарь с каждым тикером и историей цен.
     """
 
-    # Из документации aiomoex : Размер свечки - целое число 1 (1 минута), 10 (10 минут), 60 (1 час), 24 (1 день),
-    # 7 (1 неделя), 31 (1 месяц) или 4 (1 квартал)
-
-    translate = {'1min': 1, '10min': 10, '1h': 60, '1d': 24, '1w': 7, '1m': 31, '1q': 4}
-
-    interval = translate[request.dt_frequency.lower()]
-
-    # Проверим что указаны необходимые
-    async with aiohttp.ClientSession() as session:
-        data = {}
-
-        for ticker in request.tickers:
-            flg = await check_availability_ticker(ticker)
-
-            if flg['ok']:
-                data[ticker] = {
-                    'ok': True,
-                    'message': '',
-                    'lotsize': flg['data']['LOTSIZE'],
-                    'data': pd.DataFrame(
-                        await aiomoex.get_board_candles(
-                            session,
-                            security=ticker,
-                            start=request.dt_start,
-                            end=request.dt_end,
-                            interval=interval
-                        )
-                    )
-                }
-            else:
-                data[ticker] = {
-                    'ok': False,
-                    'message': f'Тикера {ticker} нет на MOEX',
-                    'lotsize': None,
-                    'data': pd.DataFrame()
-                }
-
-    return data
-
-
-async def check_availability_ticker(ticker: str) -> dict[str, [bool, pd.Series]]:
+    interval = INTERVALS[request.dt_frequency.lower()]
+    semaphore = asyncio.Semaphore(max_concurrency if max_concurrency is not None else DEFAULT_MAX_CONCURRENCY)
+
+    client = client if client is not None else get_moex_client()
+
+    async def fetch(ticker: str) -> dict:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    _get_ticker_history(client, ticker, request, interval),
+                    timeout=timeout
+                )
+            except asyncio.TimeoutError:
+                return _error_response(f'Превышено время ожидания ответа по тикеру {ticker}')
+            except Exception as e:
+                return _error_response(f'Ошибка при загрузке тикера {ticker}: {e}')
+
+    async with client.session_scope():
+        responses = await asyncio.gather(*[fetch(ticker) for ticker in request.tickers])
+
+    return dict(zip(request.tickers, responses))
+
+
+async def _get_ticker_history(client: MoexClient,
+                              ticker: str,
+                              request: DataRequest,
+                              interval: int) -> dict:
+    """
+    Загружает историю цен по одному тикеру.
+
+    :param client: клиент MOEX ISS;
+    :param ticker: тикер бумаги;
+    :param request: исходный запрос;
+    :param interval: размер свечки в терминах aiomoex;
+    :return: ответ по тикеру в формате {'ok', 'message', 'lotsize', 'data'}
+    """
+    lotsize = await get_security_master().lotsize(ticker, client)
+
+    if lotsize is None:
+        return _error_response(f'Тикера {ticker} нет на MOEX')
+
+    async def load(start: pd.Timestamp, end: pd.Timestamp) -> dict:
+        if client.candle_cache is None:
+            candles = await get_board_candles(
+                client,
+                ticker,
+                interval,
+                start.strftime(DATETIME_FORMAT),
+                end.strftime(DATETIME_FORMAT)
+            )
+            data = parse_candles(candles, request.columns)
+        else:
+            data = await _get_cached_candles(client, ticker, interval, start, end, request.columns)
+
+        return {'ok': True, 'message': '', 'lotsize': lotsize, 'data': data}
+
+    # одновременные запросы того же тикера ждут общие ответы, на биржу уходят только непокрытые части периода
+    return await client.coalescer.run(
+        ticker,
+        interval,
+        parse_range_bound(request.dt_start),
+        parse_range_bound(request.dt_end, is_end=True),
+        load,
+        request.columns
+    )
+
+
+async def _get_cached_candles(client: MoexClient,
+                              ticker: str,
+                              interval: int,
+                              start: pd.Timestamp,
+                              end: pd.Timestamp,
+                              columns: list[str] | tuple[str] = None) -> pd.DataFrame:
+    """
+    Возвращает свечи за период через кэш клиента: с биржи загружаются только недостающие части периода.
+    В кэше свечи хранятся со всеми колонками, запрошенные колонки выбираются при ответе.
+
+    :param client: клиент MOEX ISS с настроенным кэшем свечей;
+    :param ticker: тикер бумаги;
+    :param interval: размер свечки в терминах aiomoex;
+    :param start: начало периода;
+    :param end: конец периода;
+    :param columns: запрошенные колонки. None - все колонки;
+    :return: свечи за период
+    """
+    cache = client.candle_cache
+
+    for missing_start, missing_end in cache.missing(ticker, interval, start, end):
+        candles = await get_board_candles(
+            client,
+            ticker,
+            interval,
+            missing_start.strftime(DATETIME_FORMAT),
+            missing_end.strftime(DATETIME_FORMAT)
+        )
+        cache.store(ticker, interval, parse_candles(candles), missing_start, missing_end)
+
+    return cache.get(ticker, interval, start, end, columns)
+
+
+async def get_board_candles(client: MoexClient, ticker: str, interval: int, dt_start: str, dt_end: str) -> list:
+    """
+    Загружает свечи с биржи постранично, как aiomoex.get_board_candles. Каждая страница идет через ограничитель
+    запросов клиента отдельно: при 429/5xx/таймауте повторяется только эта страница.
+
+    :param client: клиент MOEX ISS;
+    :param ticker: тикер бумаги;
+    :param interval: размер свечки в терминах aiomoex;
+    :param dt_start: начало периода;
+    :param dt_end: конец периода;
+    :return: список свечей в формате ISS
+    """
+    url = make_url(engine=DEFAULT_ENGINE, market=DEFAULT_MARKET, board=DEFAULT_BOARD, security=ticker, ending=CANDLES)
+
+    return await client.request_pages(url, CANDLES, make_query(interval=interval, start=dt_start, end=dt_end))
+
+
+def _error_response(message: str) -> dict:
+    """
+    Ответ по тикеру, данные по которому получить не удалось.
+
+    .. code-block:: python
+
+        >>> _error_response('Тикера APPL нет на MOEX')
+        {'ok': False, 'message': 'Тикера APPL нет на MOEX', 'lotsize': None, 'data': Empty DataFrame
+        Columns: []
+        Index: []}
+
+    :param message: текст ошибки;
+    :return: ответ по тикеру в формате {'ok', 'message', 'lotsize', 'data'}
+    """
+    return {'ok': False, 'message': message, 'lotsize': None, 'data': pd.DataFrame()}
+
+
+async def check_availability_ticker(ticker: str, client: MoexClient = None) -> dict[str, [bool, pd.Series]]:
     """
-    Проверить доступность тикера.
+    Проверить доступность тикера. Ответ берется из общего справочника бумаг, который загружается с биржи
+    одним запросом и обновляется по истечении ttl.
 
     .. code-block:: python
 
@@ -83,18 +203,17 @@ async def check_availability_ticker(ticker: str) -> dict[str, [bool, pd.Series]]
         >>> asyncio.run(check_availability_ticker('VKTRBR'))
         {'ok': False, 'data': None}
 
+    :param ticker: тикер бумаги;
+    :param client: клиент MOEX ISS с общим пулом соединений. По умолчанию общий клиент процесса;
+    :return: флаг наличия тикера на MOEX и его справочные данные
     """
 
-    request_url = "https://iss.moex.com/iss/engines/stock/markets/shares/boards/TQBR/securities.json"
-    arguments = {"securities.columns": "SECID," "REGNUMBER," "LOTSIZE," "SHORTNAME"}
+    security = await get_security_master().get(ticker, client)
 
-    async with aiohttp.ClientSession() as session:
-        iss = aiomoex.ISSClient(session, request_url, arguments)
-        data = await iss.get()
-        df = pd.DataFrame(data["securities"])
-        df.set_index("SECID", inplace=True)
+    if security is None:
+        return {'ok': False, 'data': None}
 
-    return {'ok': True, 'data': df.loc[ticker]} if ticker in df.index else {'ok': False, 'data': None}
+    return {'ok': True, 'data': pd.Series(security, name=ticker)}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pandas as pd
+
+from src.parse_securities.async_moex import INTERVALS, get_board_candles
+from src.parse_securities.candle_cache import DATETIME_FORMAT, CandleCache, parse_range_bound
+from src.parse_securities.candles import parse_candles
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+
+DEFAULT_CHUNK = pd.Timedelta(days=7)  # неделя минутных свечей - около 2.5 тысяч строк, 5 страниц ISS
+DEFAULT_BACKFILL_CONCURRENCY = 8  # сколько кусков загружается одновременно
+DEFAULT_REQUESTS_PER_SECOND = 10  # бюджет запросов кусков к бирже в секунду
+DEFAULT_FLUSH_EVERY = 50  # через сколько загруженных кусков тикера они сохраняются в кэш
+
+
+def split_range(start: pd.Timestamp,
+                end: pd.Timestamp,
+                chunk: pd.Timedelta) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Разбивает период на независимые куски не длиннее chunk.
+
+    .. code-block:: python
+
+        >>> split_range(pd.Timestamp('2022-01-01'), pd.Timestamp('2022-01-10 23:59:59'), pd.Timedelta(days=5))
+        [(Timestamp('2022-01-01 00:00:00'), Timestamp('2022-01-05 23:59:59')), \
+(Timestamp('2022-01-06 00:00:00'), Timestamp('2022-01-10 23:59:59'))]
+
+    :param start: начало периода;
+    :param end: конец периода;
+    :param chunk: длина куска;
+    :return: список кусков (начало, конец) включительно
+    """
+    chunks = []
+
+    while start <= end:
+        chunk_end = min(start + chunk - pd.Timedelta(seconds=1), end)
+        chunks.append((start, chunk_end))
+        start = chunk_end + pd.Timedelta(seconds=1)
+
+    return chunks
+
+
+class _RequestPacer:
+
+    def __init__(self, requests_per_second: float):
+        """
+        Равномерно распределяет запросы во времени, чтобы не превышать бюджет запросов в секунду.
+
+        :param requests_per_second: бюджет запросов в секунду. None - без ограничения
+        """
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._next_slot = time.monotonic()
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+
+async def backfill_candles(tickers: list[str] | str,
+                           dt_start: str | pd.Timestamp,
+                           dt_end: str | pd.Timestamp,
+                           dt_frequency: str = '1min',
+                           chunk: pd.Timedelta = DEFAULT_CHUNK,
+                           max_concurrency: int = DEFAULT_BACKFILL_CONCURRENCY,
+                           requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                           client: MoexClient = None,
+                           cache: CandleCache = None,
+                           flush_every: int = DEFAULT_FLUSH_EVERY) -> dict[str, pd.DataFrame]:
+    """
+    Массовая загрузка длинной истории свечей. Период каждого тикера разбивается на куски, которые загружаются
+    конкурентно в рамках бюджета запросов, затем склеиваются и очищаются от дублей по времени начала свечи.
+
+    Если есть кэш свечей (передан явно или настроен в клиенте), загруженные куски тикера сохраняются в кэш
+    пачками по flush_every кусков и в конце загрузки тикера, а при повторном запуске загружаются только те куски,
+    которых в кэше еще нет - прерванную загрузку можно просто запустить заново. Файл кэша перезаписывается раз в
+    flush_every кусков, а не на каждый кусок. Если кусок не загрузился, остальные куски всех тикеров все равно
+    догружаются и сохраняются, и только после этого ошибка пробрасывается дальше.
+
+    .. code-block:: python
+
+        >>> import asyncio
+        >>> history = asyncio.run(backfill_candles('SBER', '2021-01-01', '2021-12-31'))  # doctest: +SKIP
+
+    :param tickers: тикер или список тикеров;
+    :param dt_start: начало периода;
+    :param dt_end: конец периода;
+    :param dt_frequency: частота свечей;
+    :param chunk: длина одного куска периода;
+    :param max_concurrency: сколько кусков загружается одновременно;
+    :param requests_per_second: бюджет запросов кусков в секунду. None - без ограничения;
+    :param client: клиент MOEX ISS. По умолчанию общий клиент процесса;
+    :param cache: кэш свечей для возобновляемой загрузки. По умолчанию кэш клиента;
+    :param flush_every: через сколько загруженных кусков тикера они сохраняются в кэш;
+    :return: словарь тикер -> типизированные свечи со всеми колонками за весь период
+    """
+    if isinstance(tickers, str):
+        tickers = [tickers]
+
+    client = client if client is not None else get_moex_client()
+    cache = cache if cache is not None else client.candle_cache
+    interval = INTERVALS[dt_frequency.lower()]
+    start, end = parse_range_bound(dt_start), parse_range_bound(dt_end, is_end=True)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    pacer = _RequestPacer(requests_per_second)
+
+    async def fetch_chunk(ticker: str,
+                          chunk_start: pd.Timestamp,
+                          chunk_end: pd.Timestamp,
+                          loaded: list[tuple[pd.DataFrame, pd.Timestamp, pd.Timestamp]]) -> pd.DataFrame:
+        async with semaphore:
+            await pacer.wait()
+            data = parse_candles(await get_board_candles(
+                client,
+                ticker,
+                interval,
+                chunk_start.strftime(DATETIME_FORMAT),
+                chunk_end.strftime(DATETIME_FORMAT)
+            ))
+
+        loaded.append((data, chunk_start, chunk_end))
+        if cache is not None and len(loaded) >= flush_every:
+            cache.store_many(ticker, interval, loaded)
+            loaded.clear()
+
+        return data
+
+    async def fetch_ticker(ticker: str) -> pd.DataFrame:
+        if cache is not None:
+            ranges = cache.missing(ticker, interval, start, end)
+        else:
+            ranges = [(start, end)]
+
+        chunks = [part for range_start, range_end in ranges for part in split_range(range_start, range_end, chunk)]
+        loaded = []
+
+        try:
+            # ждем все куски, даже если какой-то упал, чтобы не оставлять загрузки в фоне и сохранить все успешные
+            frames = await asyncio.gather(*[fetch_chunk(ticker, *part, loaded) for part in chunks],
+                                          return_exceptions=True)
+        finally:
+            # куски, загруженные до ошибки или отмены, тоже сохраняются, чтобы повторный запуск их не загружал
+            if cache is not None:
+                cache.store_many(ticker, interval, loaded)
+
+        _raise_first(frames)
+
+        if cache is not None:
+            return cache.get(ticker, interval, start, end)
+
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return parse_candles([])
+
+        return (
+            pd.concat(frames)
+            .drop_duplicates('begin', keep='last')
+            .sort_values('begin')
+            .reset_index(drop=True)
+        )
+
+    async with client.session_scope():
+        histories = await asyncio.gather(*[fetch_ticker(ticker) for ticker in tickers], return_exceptions=True)
+
+    _raise_first(histories)
+
+    return dict(zip(tickers, histories))
+
+
+def _raise_first(results: list) -> None:
+    """
+    Пробрасывает первую ошибку из результатов asyncio.gather(..., return_exceptions=True).
+
+    :param results: результаты и ошибки задач
+    """
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import os
+import pickle
+
+import pandas as pd
+
+from src.parse_securities.candles import select_range, typed_candles
+from src.strategies.indicators import get_indicator_engine
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_range_bound(dt: str | pd.Timestamp, is_end: bool = False) -> pd.Timestamp:
+    """
+    Переводит границу периода запроса в pd.Timestamp. Дата без времени в конце периода означает весь день.
+
+    .. code-block:: python
+
+        >>> parse_range_bound('2022-11-05'), parse_range_bound('2022-11-05', is_end=True)
+        (Timestamp('2022-11-05 00:00:00'), Timestamp('2022-11-05 23:59:59'))
+
+        >>> parse_range_bound('2022-11-05 11:00:00', is_end=True)
+        Timestamp('2022-11-05 11:00:00')
+
+    :param dt: дата или дата-время;
+    :param is_end: является ли граница концом периода;
+    :return: граница периода
+    """
+    if is_end and isinstance(dt, str) and len(dt) == 10:
+        return pd.Timestamp(dt) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+
+    return pd.Timestamp(dt)
+
+
+def merge_ranges(ranges: list[tuple[pd.Timestamp, pd.Timestamp]]) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Объединяет пересекающиеся и соседние (с разрывом не больше секунды) периоды.
+
+    .. code-block:: python
+
+        >>> ts = pd.Timestamp
+        >>> merge_ranges([(ts('2022-01-05'), ts('2022-01-10')), (ts('2022-01-01'), ts('2022-01-04 23:59:59'))])
+        [(Timestamp('2022-01-01 00:00:00'), Timestamp('2022-01-10 00:00:00'))]
+
+    :param ranges: список периодов (начало, конец) включительно;
+    :return: отсортированный список непересекающихся периодов
+    """
+    merged = []
+
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + pd.Timedelta(seconds=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def subtract_ranges(start: pd.Timestamp,
+                    end: pd.Timestamp,
+                    ranges: list[tuple[pd.Timestamp, pd.Timestamp]]) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Возвращает части периода [start, end], которые не покрыты ranges.
+
+    .. code-block:: python
+
+        >>> ts = pd.Timestamp
+        >>> subtract_ranges(ts('2022-01-01'), ts('2022-01-31'), [(ts('2022-01-10'), ts('2022-01-20'))])
+        [(Timestamp('2022-01-01 00:00:00'), Timestamp('2022-01-10 00:00:00')), \
+(Timestamp('2022-01-20 00:00:00'), Timestamp('2022-01-31 00:00:00'))]
+
+        >>> subtract_ranges(ts('2022-01-12'), ts('2022-01-15'), [(ts('2022-01-10'), ts('2022-01-20'))])
+        []
+
+    Границы недостающих периодов совпадают с границами покрытых, поэтому при дозагрузке крайние свечи придут
+    повторно - они удаляются при слиянии по времени начала свечи.
+
+    :param start: начало периода;
+    :param end: конец периода;
+    :param ranges: отсортированные непересекающиеся покрытые периоды;
+    :return: список недостающих периодов
+    """
+    missing = []
+    cursor = start
+
+    for range_start, range_end in ranges:
+        if range_end < cursor:
+            continue
+        if range_start > end:
+            break
+        if range_start > cursor:
+            missing.append((cursor, range_start))
+        cursor = max(cursor, range_end)
+
+    if cursor < end:
+        missing.append((cursor, end))
+
+    return missing
+
+
+class CandleCache:
+
+    def __init__(self, path: str):
+        """
+        Локальный кэш свечей на диске. Для каждой пары (тикер, интервал) хранит загруженные свечи и список
+        периодов, за которые данные уже есть. Запрос к кэшу возвращает только недостающие части периода,
+        которые нужно догрузить с биржи, после чего новые свечи сливаются с уже сохраненными.
+
+        Прошлые свечи не меняются, поэтому покрытым считается только период до начала текущего дня. Свечи за
+        сегодня хранятся, но при следующем запросе загружаются заново.
+
+        :param path: папка, в которой хранится кэш. Создается, если ее нет
+        """
+        self.path = path
+        self._entries: dict[tuple[str, int], dict] = {}
+
+        os.makedirs(path, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(path={self.path!r})'
+
+    def missing(self, ticker: str, interval: int, start: pd.Timestamp, end: pd.Timestamp) -> list[tuple]:
+        """
+        :param ticker: тикер бумаги;
+        :param interval: размер свечки в терминах aiomoex;
+        :param start: начало периода;
+        :param end: конец периода;
+        :return: список периодов (начало, конец), данных за которые нет в кэше
+        """
+        return subtract_ranges(start, end, self._entry(ticker, interval)['ranges'])
+
+    def get(self,
+            ticker: str,
+            interval: int,
+            start: pd.Timestamp,
+            end: pd.Timestamp,
+            columns: list[str] | tuple[str] = None) -> pd.DataFrame:
+        """
+        :param ticker: тикер бумаги;
+        :param interval: размер свечки в терминах aiomoex;
+        :param start: начало периода;
+        :param end: конец периода;
+        :param columns: запрошенные колонки. None - все колонки;
+        :return: свечи из кэша, которые начинаются внутри периода
+        """
+        return select_range(self._entry(ticker, interval)['data'], start, end, columns)
+
+    def store(self,
+              ticker: str,
+              interval: int,
+              data: pd.DataFrame,
+              start: pd.Timestamp,
+              end: pd.Timestamp) -> None:
+        """
+        Сохраняет загруженные с биржи свечи за период и отмечает прошедшую часть периода как покрытую.
+
+        :param ticker: тикер бумаги;
+        :param interval: размер свечки в терминах aiomoex;
+        :param data: типизированные свечи со всеми колонками, загруженные за период;
+        :param start: начало периода;
+        :param end: конец периода
+        """
+        self.store_many(ticker, interval, [(data, start, end)])
+
+    def store_many(self,
+                   ticker: str,
+                   interval: int,
+                   parts: list[tuple[pd.DataFrame, pd.Timestamp, pd.Timestamp]]) -> None:
+        """
+        Сохраняет свечи за несколько периодов одной записью: сохраненные и новые свечи склеиваются и файл
+        перезаписывается один раз, а не на каждый период, как при вызове :meth:`store` на каждый кусок.
+
+        .. code-block:: python
+
+            >>> import tempfile
+            >>> from src.parse_securities.candles import parse_candles
+            >>> cache = CandleCache(tempfile.mkdtemp())
+            >>> days = [pd.Timestamp('2022-01-03'), pd.Timestamp('2022-01-04')]
+            >>> candles = [parse_candles([{'close': 1. + i, 'begin': str(day)}], ['begin', 'close'])
+            ...            for i, day in enumerate(days)]
+            >>> cache.store_many('SBER', 24, [(data, day, day + pd.Timedelta(days=1) - pd.Timedelta(seconds=1))
+            ...                               for data, day in zip(candles, days)])
+            >>> cache.get('SBER', 24, days[0], days[1], ['close'])['close'].tolist(), cache.missing('SBER', 24, *days)
+            ([1.0, 2.0], [])
+
+        :param ticker: тикер бумаги;
+        :param interval: размер свечки в терминах aiomoex;
+        :param parts: список (свечи со всеми колонками, начало периода, конец периода)
+        """
+        if not parts:
+            return
+
+        entry = self._entry(ticker, interval)
+
+        frames = [data for data, _, _ in parts if not data.empty]
+        if frames:
+            if _corrects(entry['data'], pd.concat(frames)):
+                get_indicator_engine().invalidate(ticker)
+
+            entry['data'] = (
+                pd.concat([entry['data'], *frames])
+                .drop_duplicates('begin', keep='last')
+                .sort_values('begin')
+                .reset_index(drop=True)
+            )
+
+        closed = pd.Timestamp.now().normalize() - pd.Timedelta(seconds=1)
+        covered = [(start, min(end, closed)) for _, start, end in parts if start <= min(end, closed)]
+        if covered:
+            entry['ranges'] = merge_ranges(entry['ranges'] + covered)
+
+        with open(self._file(ticker, interval), 'wb') as file:
+            pickle.dump(entry, file)
+
+    def _entry(self, ticker: str, interval: int) -> dict:
+        """
+        Возвращает запись кэша по паре (тикер, интервал), при необходимости читает ее с диска.
+
+        :param ticker: тикер бумаги;
+        :param interval: размер свечки в терминах aiomoex;
+        :return: словарь {'ranges': покрытые периоды, 'data': свечи}
+        """
+        key = (ticker, interval)
+
+        if key not in self._entries:
+            file_name = self._file(ticker, interval)
+
+            if os.path.exists(file_name):
+                with open(file_name, 'rb') as file:
+                    self._entries[key] = pickle.load(file)
+
+                # кэш, сохраненный до перехода на типизированные свечи, хранит время строками
+                self._entries[key]['data'] = typed_candles(self._entries[key]['data'])
+            else:
+                self._entries[key] = {'ranges': [], 'data': pd.DataFrame()}
+
+        return self._entries[key]
+
+    def _file(self, ticker: str, interval: int) -> str:
+        return os.path.join(self.path, f'{ticker}_{interval}.pkl')
+
+
+def _corrects(stored: pd.DataFrame, loaded: pd.DataFrame) -> bool:
+    """
+    Проверяет, меняют ли новые свечи уже сохраненные бары (например, биржа исправила закрытие).
+
+    .. code-block:: python
+
+        >>> stored = pd.DataFrame({'begin': [1, 2], 'close': [10., 11.]})
+        >>> _corrects(stored, pd.DataFrame({'begin': [2, 3], 'close': [11., 12.]}))
+        False
+        >>> _corrects(stored, pd.DataFrame({'begin': [2, 3], 'close': [15., 12.]}))
+        True
+
+    :param stored: сохраненные свечи;
+    :param loaded: новые свечи;
+    :return: есть ли бар с тем же началом, но другими значениями
+    """
+    if stored.empty:
+        return False
+
+    old = stored[stored['begin'].isin(loaded['begin'])].set_index('begin').sort_index()
+    if old.empty:
+        return False
+
+    new = loaded.drop_duplicates('begin', keep='last').set_index('begin').loc[old.index, old.columns]
+    return not old.equals(new)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+FLOAT_COLUMNS = ('open', 'close', 'high', 'low', 'value')  # цены и оборот - float64
+INT_COLUMNS = ('volume',)  # объем в штуках - int64
+TIME_COLUMNS = ('begin', 'end')  # начало и конец свечи - секунды от эпохи (int64), время биржи без часового пояса
+CANDLE_COLUMNS = FLOAT_COLUMNS + INT_COLUMNS + TIME_COLUMNS
+COLUMN_ALIASES = {'tradedate': 'begin'}  # названия колонок из других таблиц ISS, которые есть у свечей
+
+
+def to_epoch(dt: str | pd.Timestamp) -> int:
+    """
+    .. code-block:: python
+
+        >>> to_epoch('2022-11-05 10:00:00')
+        1667642400
+
+    :param dt: дата-время без часового пояса;
+    :return: секунды от эпохи
+    """
+    return pd.Timestamp(dt).value // 10 ** 9
+
+
+def epoch_seconds(dates: pd.DatetimeIndex) -> np.ndarray:
+    """
+    .. code-block:: python
+
+        >>> epoch_seconds(pd.DatetimeIndex(['2022-11-05 10:00:00', '2022-11-05 10:01:00']))
+        array([1667642400, 1667642460])
+
+    :param dates: даты без часового пояса;
+    :return: массив секунд от эпохи (int64)
+    """
+    return dates.values.astype('datetime64[s]').astype(np.int64)
+
+
+def candle_columns(columns: list[str] | tuple[str] = None) -> list[str]:
+    """
+    Переводит колонки из DataRequest в колонки свечей. Регистр не важен, неизвестные колонки пропускаются.
+
+    .. code-block:: python
+
+        >>> candle_columns(('TRADEDATE', 'CLOSE')), candle_columns(['close', 'WAPRICE'])
+        (['begin', 'close'], ['close'])
+
+    :param columns: запрошенные колонки. None - все колонки свечей;
+    :return: список колонок свечей
+    """
+    if columns is None:
+        return list(CANDLE_COLUMNS)
+
+    result = []
+    for column in columns:
+        column = COLUMN_ALIASES.get(column.lower(), column.lower())
+
+        if column in CANDLE_COLUMNS and column not in result:
+            result.append(column)
+
+    return result
+
+
+def parse_candles(rows: list[dict], columns: list[str] | tuple[str] = None) -> pd.DataFrame:
+    """
+    Разбирает ответ ISS (список словарей) сразу в типизированные массивы NumPy, минуя построение DataFrame из
+    списка словарей: разбираются только нужные колонки, цены - float64, время начала и конца свечи - int64.
+
+    .. code-block:: python
+
+        >>> rows = [{'open': 131, 'close': 132, 'high': 133, 'low': 130, 'value': 1320., 'volume': 10,
+        ...          'begin': '2022-11-05 10:00:00', 'end': '2022-11-05 10:00:59'}]
+        >>> candles = parse_candles(rows, ('TRADEDATE', 'CLOSE'))
+        >>> candles
+                begin  close
+        0  1667642400  132.0
+        >>> candles.dtypes.tolist()
+        [dtype('int64'), dtype('float64')]
+
+    :param rows: свечи в формате ISS;
+    :param columns: запрошенные колонки. None - все колонки свечей;
+    :return: свечи с запрошенными колонками
+    """
+    data = {}
+
+    for column in candle_columns(columns):
+        if column in TIME_COLUMNS:
+            data[column] = np.array([row[column] for row in rows], dtype='datetime64[s]').astype(np.int64)
+        elif column in INT_COLUMNS:
+            data[column] = np.fromiter((row[column] for row in rows), dtype=np.int64, count=len(rows))
+        else:
+            data[column] = np.fromiter((row[column] for row in rows), dtype=np.float64, count=len(rows))
+
+    return pd.DataFrame(data, copy=False)
+
+
+def typed_candles(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Приводит свечи, прочитанные из файла или старого кэша (время строкой), к типизированному виду.
+
+    .. code-block:: python
+
+        >>> typed_candles(pd.DataFrame({'close': [132], 'begin': ['2022-11-05 10:00:00']})).dtypes.tolist()
+        [dtype('float64'), dtype('int64')]
+
+    :param data: свечи в формате ISS;
+    :return: свечи с ценами float64 и временем int64
+    """
+    data = data.copy()
+
+    for column in data.columns.intersection(list(CANDLE_COLUMNS)):
+        if column in TIME_COLUMNS:
+            if not pd.api.types.is_integer_dtype(data[column]):
+                data[column] = pd.to_datetime(data[column]).to_numpy(dtype='datetime64[s]').astype(np.int64)
+        elif column in INT_COLUMNS:
+            data[column] = data[column].astype(np.int64)
+        else:
+            data[column] = data[column].astype(np.float64)
+
+    return data
+
+
+def select_range(data: pd.DataFrame,
+                 start: pd.Timestamp,
+                 end: pd.Timestamp,
+                 columns: list[str] | tuple[str] = None) -> pd.DataFrame:
+    """
+    Оставляет свечи, которые начинаются внутри периода [start, end], и запрошенные колонки.
+
+    .. code-block:: python
+
+        >>> data = parse_candles([{'close': 1., 'begin': '2022-01-01 00:00:00'},
+        ...                       {'close': 2., 'begin': '2022-01-02 00:00:00'},
+        ...                       {'close': 3., 'begin': '2022-01-03 00:00:00'}], ['begin', 'close'])
+        >>> select_range(data, pd.Timestamp('2022-01-02'), pd.Timestamp('2022-01-03'), ['close'])['close'].tolist()
+        [2.0, 3.0]
+
+    :param data: типизированные свечи;
+    :param start: начало периода;
+    :param end: конец периода;
+    :param columns: запрошенные колонки. None - все колонки, которые есть в data;
+    :return: свечи за период
+    """
+    if columns is not None:
+        columns = [column for column in candle_columns(columns) if column in data.columns]
+
+    if data.empty:
+        return data if columns is None else data[columns]
+
+    begin = data['begin'].to_numpy()
+    mask = (begin >= to_epoch(start)) & (begin <= to_epoch(end))
+    data = data[mask] if columns is None else data.loc[mask, columns]
+
+    return data.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
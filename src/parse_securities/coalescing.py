@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+import pandas as pd
+
+from src.parse_securities.candle_cache import subtract_ranges
+from src.parse_securities.candles import candle_columns, select_range
+
+
+class RequestCoalescer:
+
+    def __init__(self):
+        """
+        Объединяет одновременные запросы свечей. Если по тикеру, интервалу и набору колонок уже выполняется запрос
+        за тот же период, то новый запрос не уходит на биржу, а дожидается уже выполняющегося. Если выполняющиеся
+        запросы покрывают период частично, то на биржу уходят только непокрытые части, а ответ собирается из
+        выполняющихся запросов и дозагруженных частей.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> async def load(start, end):
+            ...     await asyncio.sleep(0)
+            ...     begin = [int(day.timestamp()) for day in pd.date_range(start, end)]
+            ...     return {'ok': True, 'message': '', 'lotsize': 1, 'data': pd.DataFrame({'begin': begin})}
+            >>> async def main(coalescer):
+            ...     start, end = pd.Timestamp('2022-01-01'), pd.Timestamp('2022-01-31')
+            ...     responses = await asyncio.gather(*[coalescer.run('SBER', 24, start, end, load) for _ in range(3)],
+            ...                                      coalescer.run('SBER', 24, end - pd.Timedelta(days=5),
+            ...                                                    end + pd.Timedelta(days=5), load))
+            ...     return len(responses[-1]['data']), coalescer.stats()
+            >>> asyncio.run(main(RequestCoalescer()))  # на биржу ушли 2022-01-01 - 01-31 и только 2022-01-31 - 02-05
+            (11, {'requests': 4, 'issued': 2, 'coalesced_identical': 2, 'coalesced_overlap': 0, \
+'coalesced_partial': 1, 'saved': 2})
+
+        """
+        self._in_flight: dict[tuple, list[tuple[pd.Timestamp, pd.Timestamp, asyncio.Future]]] = defaultdict(list)
+
+        self.requests = 0  # всего запросов
+        self.issued = 0  # запросов, которые действительно ушли на биржу (в том числе дозагрузки частей периода)
+        self.coalesced_identical = 0  # запросов, которые дождались такого же запроса
+        self.coalesced_overlap = 0  # запросов, период которых целиком покрыт выполняющимися запросами
+        self.coalesced_partial = 0  # запросов, для которых на биржу ушли только непокрытые части периода
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.stats()})'
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: счетчики запросов: всего, ушло на биржу, объединено с одинаковыми, с покрывающими и частично
+                 покрывающими, сэкономлено целиком
+        """
+        return {
+            'requests': self.requests,
+            'issued': self.issued,
+            'coalesced_identical': self.coalesced_identical,
+            'coalesced_overlap': self.coalesced_overlap,
+            'coalesced_partial': self.coalesced_partial,
+            'saved': self.coalesced_identical + self.coalesced_overlap,
+        }
+
+    async def run(self,
+                  ticker: str,
+                  interval: int,
+                  start: pd.Timestamp,
+                  end: pd.Timestamp,
+                  load: Callable[[pd.Timestamp, pd.Timestamp], Awaitable[dict]],
+                  columns: list[str] | tuple[str] = None) -> dict:
+        """
+        Выполняет запрос или присоединяется к уже выполняющимся.
+
+        :param ticker: тикер бумаги;
+        :param interval: размер свечки в терминах aiomoex;
+        :param start: начало периода;
+        :param end: конец периода;
+        :param load: функция от начала и конца периода, которая загружает ответ по тикеру в формате
+                     {'ok', 'message', 'lotsize', 'data'} за этот период;
+        :param columns: запрошенные колонки. Запросы с разными колонками не объединяются;
+        :return: ответ по тикеру за период
+        """
+        self.requests += 1
+        in_flight = self._in_flight[(ticker, interval, tuple(columns) if columns is not None else None)]
+
+        for flight_start, flight_end, future in in_flight:
+            if (flight_start, flight_end) == (start, end):
+                self.coalesced_identical += 1
+                # shield - отмена одного из ожидающих (например, по таймауту) не должна отменять общий запрос
+                response = await asyncio.shield(future)
+                return {**response, 'data': response['data'].copy(deep=False)}
+
+        # собрать ответ из нескольких периодов можно, только если в нем есть время начала свечи
+        overlapping = []
+        if 'begin' in candle_columns(columns):
+            overlapping = [flight for flight in in_flight if flight[0] <= end and start <= flight[1]]
+
+        if not overlapping:
+            response = await asyncio.shield(self._issue(in_flight, start, end, load))
+            return {**response, 'data': response['data'].copy(deep=False)}
+
+        gaps = subtract_ranges(start, end, [(flight_start, flight_end) for flight_start, flight_end, _ in overlapping])
+        if gaps:
+            self.coalesced_partial += 1
+        else:
+            self.coalesced_overlap += 1
+
+        futures = [future for _, _, future in overlapping] + \
+                  [self._issue(in_flight, gap_start, gap_end, load) for gap_start, gap_end in gaps]
+        responses = await asyncio.gather(*[asyncio.shield(future) for future in futures])
+
+        for response in responses:
+            if not response['ok']:
+                return {**response, 'data': response['data'].copy(deep=False)}
+
+        # границы частей совпадают с границами выполняющихся запросов, поэтому крайние свечи приходят дважды
+        data = pd.concat([response['data'] for response in responses], ignore_index=True)
+        data = data.drop_duplicates('begin').sort_values('begin', kind='stable')
+
+        return {**responses[0], 'data': select_range(data, start, end)}
+
+    def _issue(self,
+               in_flight: list[tuple[pd.Timestamp, pd.Timestamp, asyncio.Future]],
+               start: pd.Timestamp,
+               end: pd.Timestamp,
+               load: Callable[[pd.Timestamp, pd.Timestamp], Awaitable[dict]]) -> asyncio.Future:
+        """
+        Отправляет запрос на биржу и регистрирует его как выполняющийся до получения ответа.
+
+        :return: future с ответом за период
+        """
+        self.issued += 1
+        future = asyncio.ensure_future(load(start, end))
+        flight = (start, end, future)
+        in_flight.append(flight)
+        future.add_done_callback(lambda _: in_flight.remove(flight))
+
+        return future
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,444 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import zlib
+from typing import Awaitable, TypeVar
+
+import numpy as np
+import pandas as pd
+
+from src.parse_securities.async_moex import get_security_history_aiomoex
+from src.parse_securities.candle_cache import parse_range_bound
+from src.parse_securities.candles import CANDLE_COLUMNS, epoch_seconds, parse_candles, select_range, to_epoch, \
+    typed_candles
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+from src.structures.st_strategies import DataRequest
+
+T = TypeVar('T')
+
+
+class BaseDataSource:
+    """
+    Базовый класс источника рыночных данных. Источник принимает DataRequest и возвращает словарь тикер -> ответ
+    в формате {'ok', 'message', 'lotsize', 'data'}, как get_security_history_aiomoex.
+    """
+
+    async def get_history(self, request: DataRequest) -> dict:
+        """
+        Возвращает историю цен по всем тикерам запроса.
+
+        :param request: запрос данных;
+        :return: словарь с каждым тикером и историей цен
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """
+        Закрывает соединения источника в текущем event loop. После закрытия источник можно снова использовать.
+        """
+
+    async def __call__(self, request: DataRequest) -> dict:
+        return await self.get_history(request)
+
+
+class MoexDataSource(BaseDataSource):
+
+    def __init__(self, client: MoexClient = None, max_concurrency: int = None, timeout: float = None):
+        """
+        Источник данных MOEX ISS.
+
+        :param client: клиент MOEX ISS. По умолчанию общий клиент процесса;
+        :param max_concurrency: максимальное количество одновременно загружаемых тикеров;
+        :param timeout: ограничение по времени на загрузку одного тикера в секундах
+        """
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(client={self.client})'
+
+    async def get_history(self, request: DataRequest) -> dict:
+        return await get_security_history_aiomoex(request, self.max_concurrency, self.timeout, self.client)
+
+    async def close(self) -> None:
+        """
+        Закрывает сессию клиента (по умолчанию общего клиента процесса), открытую в текущем event loop.
+        """
+        await (self.client if self.client is not None else get_moex_client()).close()
+
+
+class MemoryDataSource(BaseDataSource):
+
+    def __init__(self, frames: dict[tuple[str, str], pd.DataFrame] = None, lotsizes: dict[str, int] = None):
+        """
+        Источник данных из свечей, которые уже лежат в памяти. Свечи хранятся в формате ISS (колонки open, close,
+        high, low, value, volume, begin, end) отдельно для каждой пары (тикер, частота) и приводятся к тем же типам,
+        что и ответы биржи: цены float64, время int64.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> candles = pd.DataFrame({'close': [10, 11], 'begin': ['2022-01-03 00:00:00', '2022-01-04 00:00:00']})
+            >>> source = MemoryDataSource({('SBER', '1d'): candles}, lotsizes={'SBER': 10})
+            >>> response = asyncio.run(source(DataRequest(['SBER', 'APPL'], '2022-01-04', '2022-01-04', '1d')))
+            >>> response['SBER']['data']['close'].tolist(), response['SBER']['lotsize'], response['APPL']['ok']
+            ([11.0], 10, False)
+
+        :param frames: словарь (тикер, частота) -> свечи;
+        :param lotsizes: лотность бумаг. Для бумаг, которых нет в словаре, лотность 1
+        """
+        self.frames: dict[tuple[str, str], pd.DataFrame] = {}
+        self.lotsizes = lotsizes if lotsizes is not None else {}
+
+        for (ticker, frequency), data in (frames or {}).items():
+            self.add(ticker, frequency, data)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(frames={list(self.frames)})'
+
+    def add(self, ticker: str, frequency: str, data: pd.DataFrame) -> None:
+        """
+        Добавляет свечи по тикеру.
+
+        :param ticker: тикер бумаги;
+        :param frequency: частота свечей: 1min, 10min, 1h, 1d, 1w, 1m, 1q;
+        :param data: свечи в формате ISS
+        """
+        self.frames[(ticker, frequency.lower())] = typed_candles(data).sort_values('begin').reset_index(drop=True)
+
+    async def get_history(self, request: DataRequest) -> dict:
+        start = parse_range_bound(request.dt_start)
+        end = parse_range_bound(request.dt_end, is_end=True)
+        frequency = request.dt_frequency.lower()
+
+        response = {}
+        for ticker in request.tickers:
+            data = self._get_candles(ticker, frequency, start, end)
+            if data is not None:
+                data = select_range(data, start, end, request.columns)
+
+            if data is None:
+                response[ticker] = {
+                    'ok': False,
+                    'message': f'Тикера {ticker} нет в источнике данных',
+                    'lotsize': None,
+                    'data': pd.DataFrame()
+                }
+            else:
+                response[ticker] = {'ok': True, 'message': '', 'lotsize': self.lotsizes.get(ticker, 1), 'data': data}
+
+        return response
+
+    def _get_candles(self, ticker: str, frequency: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        """
+        :param ticker: тикер бумаги;
+        :param frequency: частота свечей;
+        :param start: начало периода;
+        :param end: конец периода;
+        :return: свечи за период со всеми колонками или None, если тикера нет в источнике
+        """
+        return self.frames.get((ticker, frequency))
+
+
+class FileDataSource(MemoryDataSource):
+
+    def __init__(self, path: str, lotsizes: dict[str, int] = None):
+        """
+        Источник данных из локальных файлов. Свечи по каждой паре (тикер, частота) лежат в отдельном файле
+        ``{path}/{ticker}_{частота}.parquet`` или ``{path}/{ticker}_{частота}.csv`` в формате ISS, например
+        ``SBER_1d.csv``. Файл читается при первом обращении и дальше хранится в памяти.
+
+        :param path: папка с файлами;
+        :param lotsizes: лотность бумаг. Для бумаг, которых нет в словаре, лотность 1
+        """
+        super().__init__(lotsizes=lotsizes)
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(path={self.path!r})'
+
+    def _get_candles(self, ticker: str, frequency: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        if (ticker, frequency) not in self.frames:
+            file_name = os.path.join(self.path, f'{ticker}_{frequency}')
+
+            if os.path.exists(file_name + '.parquet'):
+                self.add(ticker, frequency, pd.read_parquet(file_name + '.parquet'))
+            elif os.path.exists(file_name + '.csv'):
+                self.add(ticker, frequency, pd.read_csv(file_name + '.csv'))
+
+        return super()._get_candles(ticker, frequency, start, end)
+
+
+class MemmapDataSource(MemoryDataSource):
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, path: str):
+        """
+        Источник данных из свечей, которые отображаются в память из файлов ``.npy`` (np.load с mmap_mode='r').
+        Свечи всех пар (тикер, частота) лежат подряд в одном файле на колонку, а оглавление хранит смещение и
+        количество свечей каждой пары. Процессы, которые открыли одну и ту же папку, читают одни и те же страницы
+        памяти ОС без копирования: в память процесса попадают только свечи запрошенного периода. Папка создается
+        из источника в памяти через :meth:`write`.
+
+        .. code-block:: python
+
+            >>> import asyncio, tempfile
+            >>> candles = pd.DataFrame({'close': [10, 11], 'begin': ['2022-01-03 00:00:00', '2022-01-04 00:00:00']})
+            >>> path = tempfile.mkdtemp()
+            >>> source = MemmapDataSource.write(MemoryDataSource({('SBER', '1d'): candles}, {'SBER': 10}), path)
+            >>> response = asyncio.run(source(DataRequest(['SBER'], '2022-01-04', '2022-01-04', '1d')))
+            >>> response['SBER']['data']['close'].tolist(), response['SBER']['lotsize']
+            ([11.0], 10)
+
+        :param path: папка, в которую записан источник
+        """
+        with open(os.path.join(path, self.MANIFEST)) as file:
+            manifest = json.load(file)
+
+        super().__init__(lotsizes=manifest['lotsizes'])
+        self.path = path
+        self.columns = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r')
+                        for column in manifest['columns']}
+        self.index = {(ticker, frequency): (offset, length) for ticker, frequency, offset, length in manifest['index']}
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(path={self.path!r}, frames={list(self.index)})'
+
+    @classmethod
+    def write(cls, source: MemoryDataSource, path: str) -> MemmapDataSource:
+        """
+        Записывает все свечи источника в папку и открывает ее.
+
+        :param source: источник со свечами в памяти;
+        :param path: папка для файлов;
+        :return: источник, открытый из записанной папки
+        """
+        os.makedirs(path, exist_ok=True)
+        frames = source.frames
+
+        # колонки, которые есть у всех пар, в порядке CANDLE_COLUMNS
+        columns = [column for column in CANDLE_COLUMNS if all(column in frame.columns for frame in frames.values())]
+        columns = columns if frames else []
+        index, offset = [], 0
+        for (ticker, frequency), frame in frames.items():
+            index.append([ticker, frequency, offset, len(frame)])
+            offset += len(frame)
+
+        for column in columns:
+            values = np.concatenate([frame[column].to_numpy() for frame in frames.values()])
+            np.save(os.path.join(path, f'{column}.npy'), values)
+
+        with open(os.path.join(path, cls.MANIFEST), 'w') as file:
+            json.dump({
+                'columns': columns,
+                'index': index,
+                'lotsizes': {ticker: int(lotsize) for ticker, lotsize in source.lotsizes.items() if lotsize is not None}
+            }, file)
+
+        return cls(path)
+
+    def _get_candles(self, ticker: str, frequency: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        if (ticker, frequency) not in self.index:
+            return None
+
+        offset, length = self.index[(ticker, frequency)]
+        begin = self.columns['begin'][offset:offset + length]  # свечи пары отсортированы по времени начала
+        hi = offset + int(np.searchsorted(begin, to_epoch(end), 'right'))
+        lo = offset + int(np.searchsorted(begin, to_epoch(start), 'left'))
+
+        return pd.DataFrame({column: np.array(values[lo:hi]) for column, values in self.columns.items()})
+
+
+class SyntheticDataSource(MemoryDataSource):
+    INTRADAY_MINUTES = {'1min': 1, '10min': 10, '1h': 60}
+    SESSION_START = pd.Timedelta(hours=10)  # начало основной торговой сессии
+    SESSION_MINUTES = 520  # длительность основной торговой сессии в минутах
+    ORIGIN = '2010-01-01'  # начало синтетической истории
+    HORIZON = '2030-12-31'  # конец синтетической истории
+
+    def __init__(self,
+                 seed: int = 0,
+                 start_price: float = 100,
+                 drift: float = 0.05,
+                 volatility: float = 0.3,
+                 lotsizes: dict[str, int] = None):
+        """
+        Синтетический источник данных для бэктестов и бенчмарков без доступа к сети. Дневные цены каждого тикера -
+        геометрическое броуновское движение по рабочим дням, внутридневные свечи - броуновский мост от закрытия
+        предыдущего дня к закрытию текущего. Все цены детерминированно зависят от seed и тикера, поэтому
+        пересекающиеся запросы возвращают одинаковые свечи.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> source = SyntheticDataSource(seed=42)
+            >>> request = DataRequest(['SBER'], '2022-01-10', '2022-01-14', '1d')
+            >>> daily = asyncio.run(source(request))['SBER']['data']
+            >>> len(daily), daily['close'].equals(asyncio.run(source(request))['SBER']['data']['close'])
+            (5, True)
+
+            >>> request = DataRequest(['SBER'], '2022-01-14 00:00:00', '2022-01-14 23:59:59', '1min')
+            >>> minutes = asyncio.run(source(request))['SBER']['data']
+            >>> len(minutes), bool(np.isclose(minutes['close'].iloc[-1], daily['close'].iloc[-1]))
+            (520, True)
+
+        :param seed: зерно генератора случайных чисел;
+        :param start_price: цена в начале синтетической истории;
+        :param drift: годовой снос доходности;
+        :param volatility: годовая волатильность доходности;
+        :param lotsizes: лотность бумаг. Для бумаг, которых нет в словаре, лотность 1
+        """
+        super().__init__(lotsizes=lotsizes)
+        self.seed = seed
+        self.start_price = start_price
+        self.drift = drift
+        self.volatility = volatility
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(seed={self.seed}, volatility={self.volatility})'
+
+    def _get_candles(self, ticker: str, frequency: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        if frequency in self.INTRADAY_MINUTES:
+            return self._intraday(ticker, frequency, start, end)
+
+        if (ticker, frequency) not in self.frames:
+            daily = self._daily(ticker)
+
+            if frequency != '1d':
+                rule = {'1w': 'W-MON', '1m': 'MS', '1q': 'QS'}[frequency]
+                daily = self._resample(daily, rule)
+
+            self.add(ticker, frequency, daily)
+
+        return super()._get_candles(ticker, frequency, start, end)
+
+    def _rng(self, ticker: str, *keys: int) -> np.random.Generator:
+        return np.random.default_rng([self.seed, zlib.crc32(ticker.encode()), *keys])
+
+    def _daily(self, ticker: str) -> pd.DataFrame:
+        """
+        :param ticker: тикер бумаги;
+        :return: дневные свечи за всю синтетическую историю
+        """
+        if (ticker, '1d') in self.frames:
+            return self.frames[(ticker, '1d')]
+
+        rng = self._rng(ticker)
+        dates = pd.bdate_range(self.ORIGIN, self.HORIZON)
+
+        returns = rng.normal(self.drift / 252, self.volatility / np.sqrt(252), len(dates))
+        close = self.start_price * np.exp(np.cumsum(returns))
+        open_ = np.concatenate([[self.start_price], close[:-1]])
+        spread = np.abs(rng.normal(0, self.volatility / np.sqrt(252) / 2, (2, len(dates))))
+        volume = rng.integers(1_000, 100_000, len(dates))
+
+        return pd.DataFrame({
+            'open': open_,
+            'close': close,
+            'high': np.maximum(open_, close) * (1 + spread[0]),
+            'low': np.minimum(open_, close) * (1 - spread[1]),
+            'value': volume * close,
+            'volume': volume,
+            'begin': epoch_seconds(dates),
+            'end': epoch_seconds(dates + pd.Timedelta(hours=23, minutes=59, seconds=59)),
+        })
+
+    def _intraday(self, ticker: str, frequency: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        """
+        :param ticker: тикер бумаги;
+        :param frequency: частота внутридневных свечей;
+        :param start: начало периода;
+        :param end: конец периода;
+        :return: внутридневные свечи за период
+        """
+        daily = self._daily(ticker)
+        dates = pd.to_datetime(daily['begin'], unit='s')
+        days = np.flatnonzero((dates >= start.normalize()) & (dates <= end))
+
+        step = self.INTRADAY_MINUTES[frequency]
+        bars_per_day = self.SESSION_MINUTES // step
+        frames = []
+
+        for day in days:
+            rng = self._rng(ticker, int(day))
+            open_price, close_price = np.log(daily['open'].iloc[day]), np.log(daily['close'].iloc[day])
+
+            # броуновский мост в логарифмах цен, который начинается на открытии дня и заканчивается на закрытии
+            t = np.arange(1, bars_per_day + 1) / bars_per_day
+            walk = np.cumsum(rng.normal(0, self.volatility / np.sqrt(252 * bars_per_day), bars_per_day))
+            close = np.exp(open_price + t * (close_price - open_price) + walk - t * walk[-1])
+            open_ = np.concatenate([[np.exp(open_price)], close[:-1]])
+            spread = np.abs(rng.normal(0, self.volatility / np.sqrt(252 * bars_per_day) / 2, (2, bars_per_day)))
+            volume = rng.integers(10, 1_000, bars_per_day)
+
+            begin = dates.iloc[day] + self.SESSION_START + pd.to_timedelta(np.arange(bars_per_day) * step, unit='min')
+            frames.append(pd.DataFrame({
+                'open': open_,
+                'close': close,
+                'high': np.maximum(open_, close) * (1 + spread[0]),
+                'low': np.minimum(open_, close) * (1 - spread[1]),
+                'value': volume * close,
+                'volume': volume,
+                'begin': epoch_seconds(begin),
+                'end': epoch_seconds(begin + pd.Timedelta(minutes=step - 1, seconds=59)),
+            }))
+
+        if not frames:
+            return parse_candles([])
+
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def _resample(daily: pd.DataFrame, rule: str) -> pd.DataFrame:
+        """
+        :param daily: дневные свечи;
+        :param rule: правило агрегации pandas;
+        :return: свечи более крупного интервала
+        """
+        data = daily.set_index(pd.to_datetime(daily['begin'], unit='s'))
+        grouped = data.resample(rule, label='left', closed='left')
+        resampled = pd.DataFrame({
+            'open': grouped['open'].first(),
+            'close': grouped['close'].last(),
+            'high': grouped['high'].max(),
+            'low': grouped['low'].min(),
+            'value': grouped['value'].sum(),
+            'volume': grouped['volume'].sum(),
+            'begin': grouped['begin'].first(),
+            'end': grouped['end'].last(),
+        }).dropna()
+
+        return resampled.reset_index(drop=True)
+
+
+def run_with_source(data_source: BaseDataSource, coroutine: Awaitable[T]) -> T:
+    """
+    Выполняет корутину в новом event loop, как ``asyncio.run``, и перед закрытием loop закрывает соединения
+    источника данных. Сессия aiohttp привязана к event loop, поэтому без этого сессия, открытая в одноразовом
+    loop, остается незакрытой ("Unclosed client session").
+
+    .. code-block:: python
+
+        >>> run_with_source(MoexDataSource(), asyncio.sleep(0, result='ok'))
+        'ok'
+
+    :param data_source: источник данных, через который идут запросы корутины;
+    :param coroutine: корутина;
+    :return: результат корутины
+    """
+    async def main() -> T:
+        try:
+            return await coroutine
+        finally:
+            await data_source.close()
+
+    return asyncio.run(main())
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar('T')
+
+
+class LoopLocal(Generic[T]):
+
+    def __init__(self, factory: Callable[[], T]):
+        """
+        Объект, который создается заново для каждого event loop. Примитивы asyncio (Lock, Condition) привязываются
+        к loop, в котором их впервые использовали, а общие объекты процесса (снимок котировок, справочник бумаг,
+        ограничитель запросов) вызываются и из разных одноразовых loop через asyncio.run.
+
+        .. code-block:: python
+
+            >>> lock = LoopLocal(asyncio.Lock)
+            >>> async def get_lock():
+            ...     return lock.get()
+            >>> asyncio.run(get_lock()) is asyncio.run(get_lock())
+            False
+
+        :param factory: функция без аргументов, которая создает объект для нового loop
+        """
+        self.factory = factory
+
+        self._value: T | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def get(self) -> T:
+        """
+        :return: объект текущего event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._value = self.factory()
+            self._loop = loop
+
+        return self._value
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
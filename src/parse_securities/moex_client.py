@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+import aiohttp
+import aiomoex
+
+from src.parse_securities.candle_cache import CandleCache
+from src.parse_securities.coalescing import RequestCoalescer
+from src.parse_securities.rate_limiter import AdaptiveRateLimiter
+
+T = TypeVar('T')
+
+DEFAULT_CONNECTION_LIMIT = 100  # общее количество соединений в пуле
+DEFAULT_CONNECTION_LIMIT_PER_HOST = 20  # количество одновременных соединений с одним хостом (iss.moex.com)
+DEFAULT_KEEPALIVE_TIMEOUT = 60  # сколько секунд держать открытым неиспользуемое соединение
+DEFAULT_REQUEST_TIMEOUT = 60  # ограничение по времени на один http запрос
+
+
+class MoexClient:
+
+    def __init__(self,
+                 limit: int = DEFAULT_CONNECTION_LIMIT,
+                 limit_per_host: int = DEFAULT_CONNECTION_LIMIT_PER_HOST,
+                 keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                 candle_cache: CandleCache | str = None,
+                 rate_limiter: AdaptiveRateLimiter = None):
+        """
+        Клиент MOEX ISS, который владеет одним пулом keep-alive соединений. Весь трафик к бирже (история цен,
+        справочник бумаг) должен идти через одну сессию клиента, чтобы не платить за установку TCP + TLS
+        соединения на каждый запрос.
+
+        Одновременные запросы свечей одного тикера за один и тот же (или более узкий) период объединяются в один
+        запрос к бирже, сколько запросов удалось сэкономить - показывает ``client.coalescer.stats()``.
+
+        Каждый http запрос к бирже проходит через ограничитель ``client.limiter``: бюджет запросов в секунду,
+        адаптивное количество одновременных запросов и повторы после 429/5xx/таймаутов, см. :meth:`request`.
+        Ответы из нескольких страниц загружаются через :meth:`request_pages`, где каждая страница - отдельный
+        запрос через ограничитель.
+
+        Сессия создается лениво при первом запросе или явно через :meth:`start`, закрывается через :meth:`close`.
+        Сессия aiohttp привязана к event loop, поэтому если клиент используется из нового event loop
+        (например, после очередного ``asyncio.run``), то сессия пересоздается. Публичные функции загрузки работают
+        внутри :meth:`session_scope`: сессию, которую никто не открыл явно, закрывает последний завершившийся вызов,
+        поэтому ``asyncio.run(get_security_history_aiomoex(...))`` не оставляет незакрытую сессию. Чтобы пул
+        соединений жил между вызовами в одном event loop, его открывают через :meth:`start` (или
+        startup_moex_client) и закрывают через :meth:`close`.
+
+        .. code-block:: python
+
+            >>> client = MoexClient(limit=10, limit_per_host=5)
+            >>> client
+            MoexClient(limit=10, limit_per_host=5, started=False)
+
+        :param limit: общее количество соединений в пуле;
+        :param limit_per_host: количество одновременных соединений с одним хостом;
+        :param keepalive_timeout: сколько секунд держать открытым неиспользуемое соединение;
+        :param request_timeout: ограничение по времени на один http запрос в секундах;
+        :param candle_cache: кэш свечей на диске или путь к папке с ним. None - свечи всегда загружаются с биржи;
+        :param rate_limiter: ограничитель запросов. По умолчанию AdaptiveRateLimiter с параметрами по умолчанию
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.candle_cache = CandleCache(candle_cache) if isinstance(candle_cache, str) else candle_cache
+        self.coalescer = RequestCoalescer()
+        self.limiter = rate_limiter if rate_limiter is not None else AdaptiveRateLimiter(max_concurrency=limit_per_host)
+
+        self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._owned = False  # сессия открыта явно через start и закрывается только через close
+        self._scopes = 0  # сколько вызовов session_scope сейчас выполняется
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(limit={self.limit}, limit_per_host={self.limit_per_host}, ' \
+               f'started={self.started})'
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None and not self._session.closed
+
+    async def start(self) -> None:
+        """
+        Открывает пул соединений, который живет до вызова :meth:`close`. Повторный вызов ничего не делает.
+        """
+        await self.get_session()
+        self._owned = True
+
+    async def close(self) -> None:
+        """
+        Закрывает пул соединений. После закрытия клиент можно снова использовать - сессия создастся заново.
+        """
+        if self.started and self._loop is asyncio.get_running_loop():
+            await self._session.close()
+
+        self._session = None
+        self._loop = None
+        self._owned = False
+
+    @asynccontextmanager
+    async def session_scope(self) -> AsyncIterator[MoexClient]:
+        """
+        Область использования клиента в текущем event loop. Если пул не открыт явно через :meth:`start`, то при
+        выходе из последней одновременной области сессия закрывается: loop, который ее открыл, может сразу
+        завершиться (например, ``asyncio.run``), и сессия осталась бы незакрытой.
+
+        .. code-block:: python
+
+            >>> async def main(client):
+            ...     async with client.session_scope():
+            ...         await client.get_session()
+            ...         opened = client.started
+            ...     return opened, client.started
+            >>> asyncio.run(main(MoexClient()))
+            (True, False)
+
+        :return: сам клиент
+        """
+        self._scopes += 1
+        try:
+            yield self
+        finally:
+            self._scopes -= 1
+            if not self._scopes and not self._owned and self._loop is asyncio.get_running_loop():
+                await self.close()
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Возвращает общую сессию клиента, при необходимости создает ее.
+
+        :return: сессия aiohttp с общим пулом соединений
+        """
+        loop = asyncio.get_running_loop()
+
+        # Сессия из другого (скорее всего уже закрытого) event loop не может быть использована
+        if self._loop is not loop:
+            self._session = None
+            self._owned = False
+
+        if not self.started:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+            self._loop = loop
+
+        return self._session
+
+    async def request(self, request: Callable[[aiohttp.ClientSession], Awaitable[T]]) -> T:
+        """
+        Выполняет запрос к бирже через ограничитель запросов клиента. Ограничитель считает каждый вызов одним
+        http запросом (один токен бюджета, одно измерение времени ответа), поэтому функция должна отправлять ровно
+        один запрос. Постраничные ответы (например, aiomoex.get_board_candles) загружаются через
+        :meth:`request_pages`.
+
+        .. code-block:: python
+
+            >>> import aiomoex
+            >>> async def main(client):
+            ...     return await client.request(lambda session: aiomoex.find_securities(session, 'SBER'))
+            >>> asyncio.run(main(MoexClient()))  # doctest: +SKIP
+
+        :param request: функция, которая получает сессию клиента и отправляет запрос. Вызывается заново на каждый
+                        повтор;
+        :return: ответ запроса
+        """
+        async def attempt() -> T:
+            return await request(await self.get_session())
+
+        return await self.limiter.run(attempt)
+
+    async def request_pages(self, url: str, table: str, query: dict = None) -> list[dict]:
+        """
+        Загружает ответ ISS, который приходит несколькими страницами, как aiomoex.ISSClient.get_all, но каждая
+        страница - отдельный запрос через ограничитель: бюджет запросов в секунду расходуется по числу страниц,
+        время ответа измеряется по каждой странице, а после ошибки повторяется только упавшая страница.
+
+        .. code-block:: python
+
+            >>> from aiomoex.request_helpers import make_query, make_url
+            >>> async def main(client):
+            ...     url = make_url(engine='stock', market='shares', board='TQBR', security='SBER', ending='candles')
+            ...     return await client.request_pages(url, 'candles', make_query(interval=1, start='2022-11-01'))
+            >>> asyncio.run(main(MoexClient()))  # doctest: +SKIP
+
+        :param url: адрес запроса;
+        :param table: таблица ответа, строки которой нужно собрать;
+        :param query: параметры запроса;
+        :return: строки таблицы со всех страниц
+        """
+        rows = []
+        start = 0
+
+        while True:
+            page = await self.request(
+                lambda session, start=start: aiomoex.ISSClient(session, url, query).get(start)
+            )
+            page_rows = page.get(table, [])
+            rows.extend(page_rows)
+
+            # у части ответов есть курсор с размером страницы и общим количеством строк, у остальных (например,
+            # свечей) последняя страница - пустая
+            cursor = page.get('history.cursor')
+            if cursor:
+                page_size = cursor[0]['PAGESIZE']
+                if start + page_size >= cursor[0]['TOTAL']:
+                    return rows
+            else:
+                page_size = len(page_rows)
+                if not page_size:
+                    return rows
+
+            start += page_size
+
+    async def __aenter__(self) -> MoexClient:
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+
+_moex_client: MoexClient | None = None
+
+
+def get_moex_client() -> MoexClient:
+    """
+    Возвращает общий для процесса клиент MOEX ISS, при необходимости создает его с параметрами по умолчанию.
+
+    .. code-block:: python
+
+        >>> get_moex_client() is get_moex_client()
+        True
+
+    :return: клиент MOEX ISS
+    """
+    global _moex_client
+
+    if _moex_client is None:
+        _moex_client = MoexClient()
+
+    return _moex_client
+
+
+async def startup_moex_client(**kwargs) -> MoexClient:
+    """
+    Хук запуска: открывает соединения общего клиента. Если указаны параметры пула, то клиент пересоздается с ними.
+
+    :param kwargs: параметры MoexClient: limit, limit_per_host, keepalive_timeout, request_timeout, candle_cache,
+                   rate_limiter;
+    :return: общий клиент MOEX ISS
+    """
+    global _moex_client
+
+    if _moex_client is None or kwargs:
+        if _moex_client is not None:
+            await _moex_client.close()
+        _moex_client = MoexClient(**kwargs)
+
+    await _moex_client.start()
+
+    return _moex_client
+
+
+async def shutdown_moex_client() -> None:
+    """
+    Хук остановки: закрывает пул соединений общего клиента.
+    """
+    if _moex_client is not None:
+        await _moex_client.close()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
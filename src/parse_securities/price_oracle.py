@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import pandas as pd
+
+from src.parse_securities.data_sources import BaseDataSource, MoexDataSource
+from src.structures.st_strategies import DataRequest
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_RESOLUTIONS = ('1min', '1d')  # последняя минутная свеча, а если ее нет - закрытие прошлого дня
+DEFAULT_PRICE_CACHE_SIZE = 65536  # сколько цен (тикер, время, частота) хранит оракул
+RESOLUTION_LOOKBACKS = {  # насколько назад от момента цены ищется последняя свеча
+    '1min': pd.Timedelta(minutes=10),
+    '10min': pd.Timedelta(hours=1),
+    '1h': pd.Timedelta(days=1),
+    '1d': pd.Timedelta(days=7),
+}
+
+
+class PriceOracle:
+
+    def __init__(self,
+                 data_source: BaseDataSource = None,
+                 resolutions: tuple[str, ...] = DEFAULT_RESOLUTIONS,
+                 maxsize: int = DEFAULT_PRICE_CACHE_SIZE):
+        """
+        Единый источник цены бумаги на момент времени для расчета суммы заявки, исполнения и оценки позиций.
+        Цена по ключу (тикер, время, частота) загружается один раз, поэтому все шаги одного решения видят одну и ту
+        же цену, а запрос цен по всем тикерам шага - один запрос на частоту, см. :meth:`prefetch`.
+
+        Цена на момент ``dtime`` - цена закрытия последней свечи, которая началась не позже ``dtime``, в пределах
+        RESOLUTION_LOOKBACKS: если в эту минуту сделок не было, то берется предыдущая свеча. Дневная свеча
+        текущего дня еще не закрыта, поэтому для частоты '1d' берется закрытие последнего завершенного дня - цена
+        никогда не заглядывает вперед. Частоты перебираются в порядке ``resolutions``: например, с
+        ``('1min', '1d')`` при отсутствии минутных свечей берется закрытие прошлого дня. Если цены нет ни на одной
+        частоте, то цены нет.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> from src.parse_securities.data_sources import MemoryDataSource
+            >>> source = MemoryDataSource({
+            ...     ('SBER', '1min'): pd.DataFrame({'close': [130.5, 130.7],
+            ...                                     'begin': ['2022-10-03 11:00:00', '2022-10-03 11:01:00']}),
+            ...     ('SBER', '1d'): pd.DataFrame({'close': [129., 131.], 'begin': ['2022-09-30', '2022-10-03']}),
+            ... })
+            >>> oracle = PriceOracle(source, ('1min', '1d'))
+            >>> asyncio.run(oracle.price('SBER', '2022-10-03 11:00:00'))
+            130.5
+            >>> asyncio.run(oracle.price('SBER', '2022-10-03 11:05:00'))  # сделок не было - предыдущая свеча
+            130.7
+            >>> asyncio.run(oracle.price('SBER', '2022-10-03 10:30:00'))  # минутных свечей нет - закрытие 30.09
+            129.0
+            >>> asyncio.run(oracle.price('SBER', '2022-10-03 11:00:00')), oracle.stats()
+            (130.5, {'hits': 1, 'misses': 3, 'size': 4})
+
+        :param data_source: источник свечей. По умолчанию MOEX ISS;
+        :param resolutions: частоты свечей в порядке, в котором ищется цена;
+        :param maxsize: сколько цен хранить
+        """
+        self.data_source = data_source if data_source is not None else MoexDataSource()
+        self.resolutions = tuple(resolution.lower() for resolution in resolutions)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._cache: OrderedDict[tuple[str, pd.Timestamp, str], dict] = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(resolutions={self.resolutions}, {self.stats()})'
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: попадания и промахи кэша, количество цен в кэше
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    @staticmethod
+    def window(dtime: str | pd.Timestamp, resolution: str) -> tuple[pd.Timestamp, pd.Timestamp]:
+        """
+        Период, в котором ищется последняя свеча для цены на момент dtime: свечи, которые начались не позже dtime,
+        а для дней - завершенные дни до дня dtime.
+
+        .. code-block:: python
+
+            >>> PriceOracle.window('2022-10-03 11:00:00', '1min')
+            (Timestamp('2022-10-03 10:50:00'), Timestamp('2022-10-03 11:00:00'))
+            >>> PriceOracle.window('2022-10-03 11:00:00', '1d')
+            (Timestamp('2022-09-26 00:00:00'), Timestamp('2022-10-02 23:59:59'))
+
+        :param dtime: момент времени;
+        :param resolution: частота свечей;
+        :return: начало и конец периода включительно
+        """
+        end = pd.Timestamp(dtime)
+        if resolution == '1d':
+            # день dtime еще не закончился, поэтому берутся только дни до него
+            day = end.normalize()
+            return day - RESOLUTION_LOOKBACKS[resolution], day - pd.Timedelta(seconds=1)
+
+        return end - RESOLUTION_LOOKBACKS[resolution], end
+
+    async def prefetch(self, tickers: list[str], dtime: str | pd.Timestamp) -> None:
+        """
+        Загружает цены по всем тикерам на момент dtime: не больше одного запроса на каждую частоту, следующая
+        частота запрашивается только для тикеров, по которым цены не нашлось.
+
+        :param tickers: тикеры бумаг;
+        :param dtime: момент времени
+        """
+        pending = list(dict.fromkeys(tickers))
+
+        for resolution in self.resolutions:
+            start, end = self.window(dtime, resolution)
+            entries = {ticker: self._cache.get((ticker, end, resolution)) for ticker in pending}
+            missing = [ticker for ticker, entry in entries.items() if entry is None]
+
+            if missing:
+                history = await self.data_source.get_history(DataRequest(
+                    tickers=missing,
+                    dt_start=start.strftime(DATETIME_FORMAT),
+                    dt_end=end.strftime(DATETIME_FORMAT),
+                    dt_frequency=resolution
+                ))
+
+                for ticker in missing:
+                    entries[ticker] = self._entry(history[ticker], resolution)
+                    self._store((ticker, end, resolution), entries[ticker])
+
+            pending = [ticker for ticker in pending if entries[ticker]['price'] is None]
+            if not pending:
+                break
+
+    async def get(self, ticker: str, dtime: str | pd.Timestamp) -> dict:
+        """
+        Цена бумаги на момент времени с учетом порядка частот.
+
+        :param ticker: тикер бумаги;
+        :param dtime: момент времени;
+        :return: словарь {'ok', 'message', 'lotsize', 'price', 'resolution'}. Если цены нет ни на одной частоте,
+                 то price - None, а остальные поля - ответ источника для первой частоты
+        """
+        keys = [(ticker, self.window(dtime, resolution)[1], resolution) for resolution in self.resolutions]
+
+        if self._resolved(keys):
+            self.hits += 1
+        else:
+            self.misses += 1
+            await self.prefetch([ticker], dtime)
+
+        first = None
+
+        for key in keys:
+            entry = self._cache.get(key)
+            if entry is None:
+                continue
+
+            self._cache.move_to_end(key)
+            if entry['price'] is not None:
+                return entry
+
+            first = first if first is not None else entry
+
+        return first if first is not None else {'ok': False, 'message': f'Нет цены {ticker} на {dtime}',
+                                                'lotsize': None, 'price': None, 'resolution': None}
+
+    async def price(self, ticker: str, dtime: str | pd.Timestamp) -> float | None:
+        """
+        :param ticker: тикер бумаги;
+        :param dtime: момент времени;
+        :return: цена бумаги или None, если цены нет
+        """
+        return (await self.get(ticker, dtime))['price']
+
+    async def response(self, ticker: str, dtime: str | pd.Timestamp) -> dict:
+        """
+        Цена бумаги в формате ответа источника данных: цена - единственное значение колонки close.
+
+        :param ticker: тикер бумаги;
+        :param dtime: момент времени;
+        :return: словарь {'ok', 'message', 'lotsize', 'data'}
+        """
+        entry = await self.get(ticker, dtime)
+
+        return {
+            'ok': entry['ok'],
+            'message': entry['message'],
+            'lotsize': entry['lotsize'],
+            'data': pd.DataFrame({'close': [entry['price']] if entry['price'] is not None else []}, dtype=float)
+        }
+
+    def _resolved(self, keys: list[tuple[str, pd.Timestamp, str]]) -> bool:
+        """
+        :return: есть ли в кэше все, что нужно для цены: цена на одной из частот или пустые ответы по всем частотам
+        """
+        for key in keys:
+            entry = self._cache.get(key)
+
+            if entry is None:
+                return False
+
+            if entry['price'] is not None:
+                return True
+
+        return True
+
+    @staticmethod
+    def _entry(response: dict, resolution: str) -> dict:
+        price = None
+        if response['ok'] and not response['data'].empty:
+            price = float(response['data']['close'].iloc[-1])  # последняя свеча, которая началась до момента цены
+
+        return {'ok': response['ok'], 'message': response['message'], 'lotsize': response['lotsize'],
+                'price': price, 'resolution': resolution}
+
+    def _store(self, key: tuple[str, pd.Timestamp, str], entry: dict) -> None:
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
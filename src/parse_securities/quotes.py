@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import aiohttp
+import aiomoex
+from aiomoex.client import ISSMoexError
+
+from src.parse_securities.loop_local import LoopLocal
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+from src.structures.st_strategies import TypeAction
+
+MARKETDATA_URL = "https://iss.moex.com/iss/engines/stock/markets/shares/boards/TQBR/securities.json"
+MARKETDATA_COLUMNS = ("SECID", "LAST", "BID", "OFFER")
+DEFAULT_REFRESH_INTERVAL = 5  # как часто обновлять котировки, секунды
+# сбои сети и биржи, после которых фоновое обновление продолжается с прошлым снимком
+REFRESH_ERRORS = (aiohttp.ClientError, ISSMoexError, asyncio.TimeoutError)
+
+
+class QuoteSnapshot:
+
+    def __init__(self, refresh_interval: float = DEFAULT_REFRESH_INTERVAL):
+        """
+        Снимок котировок всех бумаг режима торгов TQBR: последняя цена сделки, лучшие цены покупки и продажи.
+        Обновляется одним запросом к таблице marketdata ISS сразу по всем тикерам - вместо отдельного запроса свечей
+        на каждый тикер. Снимок считается актуальным ``refresh_interval`` секунд, после чего обновляется при
+        следующем обращении или фоновой задачей, см. :meth:`start`. Сбои фонового обновления подряд считаются в
+        ``failures``, последняя ошибка - в ``last_error``: по ним видно, что снимок перестал обновляться.
+
+        .. code-block:: python
+
+            >>> snapshot = QuoteSnapshot()
+            >>> snapshot.update({'SBER': {'LAST': 132.1, 'BID': 132.0, 'OFFER': 132.2}})
+            >>> asyncio.run(snapshot.price('SBER', TypeAction.BUY)), asyncio.run(snapshot.price('SBER'))
+            (132.2, 132.1)
+            >>> asyncio.run(snapshot.price('APPL')) is None
+            True
+
+        :param refresh_interval: время жизни снимка в секундах
+        """
+        self.refresh_interval = refresh_interval
+        self.failures = 0  # сколько фоновых обновлений подряд не удалось
+        self.last_error: BaseException | None = None  # ошибка последнего неудачного фонового обновления
+
+        self._quotes: dict[str, dict] = {}
+        self._loaded_at: float | None = None
+        self._lock: LoopLocal[asyncio.Lock] = LoopLocal(asyncio.Lock)
+        self._task: asyncio.Task | None = None
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(quotes={len(self._quotes)}, expired={self.expired}, ' \
+               f'failures={self.failures})'
+
+    @property
+    def loaded_at(self) -> float | None:
+        """
+        Время загрузки снимка (unix time) или None, если снимок еще не загружался.
+        """
+        return self._loaded_at
+
+    @property
+    def expired(self) -> bool:
+        return self._loaded_at is None or time.time() - self._loaded_at > self.refresh_interval
+
+    def update(self, quotes: dict[str, dict], loaded_at: float = None) -> None:
+        """
+        Заменяет содержимое снимка.
+
+        :param quotes: словарь тикер -> {'LAST', 'BID', 'OFFER'};
+        :param loaded_at: время загрузки снимка (unix time). По умолчанию текущее время
+        """
+        self._quotes = quotes
+        self._loaded_at = loaded_at if loaded_at is not None else time.time()
+
+    async def refresh(self, client: MoexClient = None, force: bool = False) -> None:
+        """
+        Загружает котировки, если снимок устарел. Одновременные вызовы приводят к одному запросу.
+
+        :param client: клиент MOEX ISS. По умолчанию общий клиент процесса;
+        :param force: загрузить котировки, даже если снимок еще не устарел
+        """
+        if not force and not self.expired:
+            return
+
+        async with self._lock.get():
+            # пока ждали блокировку, снимок мог обновить другой запрос
+            if not force and not self.expired:
+                return
+
+            client = client if client is not None else get_moex_client()
+            async with client.session_scope():
+                data = await client.request(lambda session: aiomoex.ISSClient(
+                    session,
+                    MARKETDATA_URL,
+                    {"iss.only": "marketdata", "marketdata.columns": ",".join(MARKETDATA_COLUMNS)}
+                ).get())
+
+            self.update({row['SECID']: {column: row[column] for column in MARKETDATA_COLUMNS[1:]}
+                         for row in data['marketdata']})
+
+    async def get(self, ticker: str, client: MoexClient = None) -> dict | None:
+        """
+        Котировки по тикеру.
+
+        :param ticker: тикер бумаги;
+        :param client: клиент MOEX ISS, через который будет обновлен снимок при необходимости;
+        :return: словарь {'LAST', 'BID', 'OFFER'} или None, если тикера нет в режиме TQBR
+        """
+        await self.refresh(client)
+        return self._quotes.get(ticker)
+
+    async def price(self, ticker: str, type_action: TypeAction = None, client: MoexClient = None) -> float | None:
+        """
+        Цена, по которой можно исполнить заявку: покупка - по лучшей цене продажи (OFFER), продажа - по лучшей цене
+        покупки (BID), иначе - последняя цена сделки (LAST). Если нужной цены нет (например, вне торговой сессии),
+        то берется последняя цена сделки.
+
+        :param ticker: тикер бумаги;
+        :param type_action: тип операции. None - оценка позиции по последней цене;
+        :param client: клиент MOEX ISS;
+        :return: цена или None, если котировок по тикеру нет
+        """
+        quote = await self.get(ticker, client)
+
+        if quote is None:
+            return None
+
+        if type_action == TypeAction.BUY and quote['OFFER']:
+            return quote['OFFER']
+
+        if type_action == TypeAction.SELL and quote['BID']:
+            return quote['BID']
+
+        return quote['LAST'] or None
+
+    def start(self, client: MoexClient = None) -> asyncio.Task:
+        """
+        Запускает фоновое обновление снимка раз в ``refresh_interval`` секунд в текущем event loop.
+        Повторный вызов возвращает уже запущенную задачу.
+
+        :param client: клиент MOEX ISS. По умолчанию общий клиент процесса;
+        :return: фоновая задача
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._refresh_forever(client))
+
+        return self._task
+
+    async def stop(self) -> None:
+        """
+        Останавливает фоновое обновление снимка.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        self._task = None
+
+    async def _refresh_forever(self, client: MoexClient = None) -> None:
+        while True:
+            try:
+                await self.refresh(client, force=True)
+            except REFRESH_ERRORS as e:
+                # сбой биржи или сети не должен останавливать фоновую задачу - остается прошлый снимок
+                self.failures += 1
+                self.last_error = e
+            else:
+                self.failures = 0
+
+            await asyncio.sleep(self.refresh_interval)
+
+
+_quote_snapshot: QuoteSnapshot | None = None
+
+
+def get_quote_snapshot() -> QuoteSnapshot:
+    """
+    Возвращает общий для процесса снимок котировок.
+
+    :return: снимок котировок
+    """
+    global _quote_snapshot
+
+    if _quote_snapshot is None:
+        _quote_snapshot = QuoteSnapshot()
+
+    return _quote_snapshot
+
+
+def set_quote_snapshot(quote_snapshot: QuoteSnapshot) -> None:
+    """
+    Заменяет общий снимок котировок, например, на снимок с другим интервалом обновления.
+
+    :param quote_snapshot: новый снимок
+    """
+    global _quote_snapshot
+
+    _quote_snapshot = quote_snapshot
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
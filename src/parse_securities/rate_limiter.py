@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+
+import aiohttp
+from aiomoex.client import ISSMoexError
+
+from src.parse_securities.loop_local import LoopLocal
+
+T = TypeVar('T')
+
+DEFAULT_REQUESTS_PER_SECOND = 20  # средний бюджет запросов к ISS в секунду
+DEFAULT_BURST = 20  # сколько запросов можно отправить разом после простоя
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_MAX_CONCURRENCY = 20  # больше, чем соединений с одним хостом в пуле клиента, не имеет смысла
+DEFAULT_TARGET_LATENCY = 2.  # время ответа в секундах, выше которого биржа считается перегруженной
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF_BASE = 0.5  # первая пауза перед повтором в секундах, дальше удваивается
+DEFAULT_BACKOFF_CAP = 30.  # максимальная пауза перед повтором в секундах
+LATENCY_SMOOTHING = 0.2  # вес нового наблюдения в экспоненциальном среднем времени ответа и доли ошибок
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})  # ответы, после которых запрос имеет смысл повторить
+
+
+def retry_status(error: BaseException) -> int | None:
+    """
+    Код ответа HTTP, который вызвал ошибку. aiomoex заворачивает ошибку aiohttp в ISSMoexError, поэтому код
+    ищется и в самой ошибке, и в ее причине.
+
+    .. code-block:: python
+
+        >>> from aiohttp import ClientResponseError, RequestInfo
+        >>> error = ClientResponseError(RequestInfo('https://iss.moex.com', 'GET', {}), (), status=429)
+        >>> retry_status(error), retry_status(ValueError())
+        (429, None)
+
+    :param error: ошибка запроса;
+    :return: код ответа или None, если ошибка возникла не из-за ответа сервера
+    """
+    for candidate in (error, error.__cause__):
+        if isinstance(candidate, aiohttp.ClientResponseError):
+            return candidate.status
+
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Можно ли повторить запрос после ошибки: превышен лимит запросов (429), ошибка сервера (5xx), таймаут
+    или обрыв соединения. Остальные ошибки (например, 404 или неверные данные) повторять бессмысленно.
+
+    .. code-block:: python
+
+        >>> is_retryable(asyncio.TimeoutError()), is_retryable(ISSMoexError('Неверный url'))
+        (True, False)
+
+    :param error: ошибка запроса;
+    :return: флаг повтора
+    """
+    status = retry_status(error)
+
+    if status is not None:
+        return status in RETRY_STATUSES
+
+    if isinstance(error, ISSMoexError):
+        return isinstance(error.__cause__, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+def backoff_delay(attempt: int, base: float = DEFAULT_BACKOFF_BASE, cap: float = DEFAULT_BACKOFF_CAP) -> float:
+    """
+    Пауза перед повтором: экспоненциальная с полным случайным разбросом ("full jitter"), чтобы одновременно
+    упавшие запросы не приходили на биржу снова одной пачкой.
+
+    .. code-block:: python
+
+        >>> all(0 <= backoff_delay(attempt) <= min(DEFAULT_BACKOFF_CAP, 0.5 * 2 ** attempt) for attempt in range(10))
+        True
+
+    :param attempt: номер повтора, начиная с 0;
+    :param base: первая пауза в секундах;
+    :param cap: максимальная пауза в секундах;
+    :return: пауза в секундах
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveRateLimiter:
+
+    def __init__(self,
+                 requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                 burst: int = DEFAULT_BURST,
+                 min_concurrency: int = DEFAULT_MIN_CONCURRENCY,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 target_latency: float = DEFAULT_TARGET_LATENCY,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE,
+                 backoff_cap: float = DEFAULT_BACKOFF_CAP):
+        """
+        Ограничитель запросов к ISS. Стоит перед каждым запросом к бирже и решает три задачи:
+
+        * token bucket - не больше ``requests_per_second`` запросов в секунду в среднем и не больше ``burst`` разом;
+        * адаптивное количество одновременных запросов (AIMD): пока ответы быстрые и без ошибок, лимит растет на
+          единицу за каждое "окно" успешных запросов, при ответе 429/5xx, таймауте или времени ответа выше
+          ``target_latency`` лимит уменьшается вдвое;
+        * повтор запросов после 429/5xx/таймаутов с экспоненциальной паузой со случайным разбросом.
+
+        Статистика для настройки пропускной способности - :meth:`stats`.
+
+        .. code-block:: python
+
+            >>> async def request():
+            ...     return 'ok'
+            >>> limiter = AdaptiveRateLimiter(requests_per_second=100, max_concurrency=4)
+            >>> asyncio.run(limiter.run(request))
+            'ok'
+            >>> limiter.stats()['requests'], limiter.stats()['retries'], limiter.stats()['concurrency']
+            (1, 0, 4.0)
+
+        :param requests_per_second: средний бюджет запросов в секунду. None - без ограничения;
+        :param burst: сколько запросов можно отправить разом после простоя;
+        :param min_concurrency: нижняя граница количества одновременных запросов;
+        :param max_concurrency: верхняя граница количества одновременных запросов, с нее лимит начинает;
+        :param target_latency: время ответа в секундах, выше которого лимит одновременных запросов снижается;
+        :param max_retries: сколько раз повторять запрос после ошибки, которую можно повторить;
+        :param backoff_base: первая пауза перед повтором в секундах;
+        :param backoff_cap: максимальная пауза перед повтором в секундах
+        """
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.concurrency = float(max_concurrency)  # текущий лимит одновременных запросов
+        self.in_flight = 0
+        self.latency: float | None = None  # экспоненциальное среднее времени ответа
+        self.error_rate = 0.  # экспоненциальное среднее доли ошибок
+
+        self.requests = 0  # всего вызовов run
+        self.attempts = 0  # всего отправленных запросов, включая повторы
+        self.retries = 0
+        self.throttled = 0  # ответов 429
+        self.failures = 0  # запросов, которые так и не удалось выполнить
+        self.waited = 0.  # суммарное ожидание токенов и пауз перед повторами в секундах
+
+        self._decreased_at = float('-inf')
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._condition: LoopLocal[asyncio.Condition] = LoopLocal(self._new_condition)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(requests_per_second={self.requests_per_second}, ' \
+               f'concurrency={self.concurrency:.1f})'
+
+    def stats(self) -> dict[str, float]:
+        """
+        :return: счетчики запросов, повторов и ошибок, текущий лимит одновременных запросов, среднее время ответа,
+                 доля ошибок и суммарное время ожидания
+        """
+        return {
+            'requests': self.requests,
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'failures': self.failures,
+            'concurrency': round(self.concurrency, 2),
+            'in_flight': self.in_flight,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'waited': round(self.waited, 3),
+        }
+
+    async def run(self, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет запрос в рамках лимитов, при необходимости повторяет его.
+
+        :param request: функция без аргументов, которая отправляет запрос к ISS. Вызывается заново на каждый повтор;
+        :return: ответ запроса
+        """
+        self.requests += 1
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._attempt(request)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+
+            self.retries += 1
+            delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    async def _attempt(self, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Одна попытка запроса: ждет токен и свободное место среди одновременных запросов, затем учитывает результат.
+        """
+        await self._acquire_token()
+
+        condition = self._condition.get()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+
+        self.attempts += 1
+        started_at = time.monotonic()
+
+        try:
+            response = await request()
+        except Exception as e:
+            self._on_error(e)
+            raise
+        else:
+            self._on_success(time.monotonic() - started_at)
+            return response
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                condition.notify_all()
+
+    async def _acquire_token(self) -> None:
+        """
+        Забирает токен из корзины. Если токенов нет, то токен берется "в долг" и запрос ждет, пока он накопится,
+        - так запросы обслуживаются строго по очереди прихода.
+        """
+        if not self.requests_per_second:
+            return
+
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.requests_per_second)
+        self._updated_at = now
+        self._tokens -= 1
+
+        if self._tokens < 0:
+            delay = -self._tokens / self.requests_per_second
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    def _new_condition(self) -> asyncio.Condition:
+        # запросы прошлого loop уже не выполняются, поэтому в новом loop счет начинается заново
+        self.in_flight = 0
+
+        return asyncio.Condition()
+
+    def _on_success(self, latency: float) -> None:
+        """
+        Учитывает успешный ответ: быстрый ответ увеличивает лимит одновременных запросов, медленный - уменьшает.
+        """
+        self.latency = latency if self.latency is None else \
+            (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+        self.error_rate *= 1 - LATENCY_SMOOTHING
+
+        if latency > self.target_latency:
+            self._decrease()
+        else:
+            # аддитивный рост: +1 к лимиту за каждые concurrency успешных запросов
+            self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+
+    def _on_error(self, error: BaseException) -> None:
+        """
+        Учитывает ошибку: перегрузка биржи (429, 5xx, таймаут) вдвое уменьшает лимит одновременных запросов.
+        """
+        self.error_rate = (1 - LATENCY_SMOOTHING) * self.error_rate + LATENCY_SMOOTHING
+
+        if retry_status(error) == 429:
+            self.throttled += 1
+
+        if is_retryable(error):
+            self._decrease()
+
+    def _decrease(self) -> None:
+        # пачка ошибок от одной перегрузки снижает лимит один раз, а не по разу на каждый запрос
+        now = time.monotonic()
+        if now - self._decreased_at < self.target_latency:
+            return
+
+        self._decreased_at = now
+        self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+
+import aiomoex
+
+from src.parse_securities.loop_local import LoopLocal
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+
+SECURITIES_URL = "https://iss.moex.com/iss/engines/stock/markets/shares/boards/TQBR/securities.json"
+SECURITIES_COLUMNS = ("SECID", "REGNUMBER", "LOTSIZE", "SHORTNAME")
+DEFAULT_SECURITY_MASTER_TTL = 60 * 60 * 12  # справочник бумаг меняется редко, обновляем раз в 12 часов
+
+
+class SecurityMaster:
+
+    def __init__(self, ttl: float = DEFAULT_SECURITY_MASTER_TTL, path: str = None):
+        """
+        Справочник бумаг режима торгов TQBR. Загружается одним запросом к ISS и хранится в памяти в виде словаря
+        тикер -> справочные данные, поэтому проверка наличия тикера и лотности выполняется за O(1).
+        Справочник перезагружается, когда истекает ttl. Если указан путь, то справочник сохраняется на диск и при
+        следующем запуске читается оттуда, пока не устарел.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> master = SecurityMaster()
+            >>> master.update({'SBER': {'REGNUMBER': '10301481B', 'LOTSIZE': 10, 'SHORTNAME': 'Сбербанк'}})
+            >>> asyncio.run(master.lotsize('SBER')), asyncio.run(master.is_available('VKTRBR'))
+            (10, False)
+
+        :param ttl: время жизни справочника в секундах;
+        :param path: путь к json файлу для сохранения справочника между запусками. None - не сохранять
+        """
+        self.ttl = ttl
+        self.path = path
+
+        self._securities: dict[str, dict] = {}
+        self._loaded_at: float | None = None
+        self._lock: LoopLocal[asyncio.Lock] = LoopLocal(asyncio.Lock)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(securities={len(self._securities)}, expired={self.expired})'
+
+    @property
+    def expired(self) -> bool:
+        return self._loaded_at is None or time.time() - self._loaded_at > self.ttl
+
+    def update(self, securities: dict[str, dict], loaded_at: float = None) -> None:
+        """
+        Заменяет содержимое справочника.
+
+        :param securities: словарь тикер -> {'REGNUMBER', 'LOTSIZE', 'SHORTNAME'};
+        :param loaded_at: время загрузки справочника (unix time). По умолчанию текущее время
+        """
+        self._securities = securities
+        self._loaded_at = loaded_at if loaded_at is not None else time.time()
+
+    async def load(self, client: MoexClient = None, force: bool = False) -> None:
+        """
+        Загружает справочник, если он еще не загружен или устарел. Одновременные вызовы приводят к одному запросу.
+
+        :param client: клиент MOEX ISS. По умолчанию общий клиент процесса;
+        :param force: загрузить справочник с биржи, даже если он еще не устарел
+        """
+        if not force and not self.expired:
+            return
+
+        async with self._lock.get():
+            # пока ждали блокировку, справочник мог загрузить другой запрос
+            if not force and not self.expired:
+                return
+
+            if not force and self._read():
+                return
+
+            client = client if client is not None else get_moex_client()
+            async with client.session_scope():
+                data = await client.request(lambda session: aiomoex.ISSClient(
+                    session,
+                    SECURITIES_URL,
+                    {"securities.columns": ",".join(SECURITIES_COLUMNS)}
+                ).get())
+
+            self.update({row['SECID']: {column: row[column] for column in SECURITIES_COLUMNS[1:]}
+                         for row in data['securities']})
+            self._write()
+
+    async def get(self, ticker: str, client: MoexClient = None) -> dict | None:
+        """
+        Справочные данные по тикеру.
+
+        :param ticker: тикер бумаги;
+        :param client: клиент MOEX ISS, через который будет загружен справочник при необходимости;
+        :return: словарь {'REGNUMBER', 'LOTSIZE', 'SHORTNAME'} или None, если тикера нет на MOEX
+        """
+        await self.load(client)
+        return self._securities.get(ticker)
+
+    async def is_available(self, ticker: str, client: MoexClient = None) -> bool:
+        """
+        :param ticker: тикер бумаги;
+        :param client: клиент MOEX ISS;
+        :return: торгуется ли бумага в режиме TQBR
+        """
+        return await self.get(ticker, client) is not None
+
+    async def lotsize(self, ticker: str, client: MoexClient = None) -> int | None:
+        """
+        :param ticker: тикер бумаги;
+        :param client: клиент MOEX ISS;
+        :return: лотность бумаги или None, если тикера нет на MOEX
+        """
+        security = await self.get(ticker, client)
+        return security['LOTSIZE'] if security is not None else None
+
+    def _read(self) -> bool:
+        """
+        Читает справочник с диска, если он там есть и не устарел.
+
+        :return: удалось ли прочитать актуальный справочник
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        with open(self.path, encoding='utf-8') as file:
+            dump = json.load(file)
+
+        if time.time() - dump['loaded_at'] > self.ttl:
+            return False
+
+        self.update(dump['securities'], dump['loaded_at'])
+        return True
+
+    def _write(self) -> None:
+        """
+        Сохраняет справочник на диск, если указан путь.
+        """
+        if self.path is None:
+            return
+
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump({'loaded_at': self._loaded_at, 'securities': self._securities}, file, ensure_ascii=False)
+
+
+_security_master: SecurityMaster | None = None
+
+
+def get_security_master() -> SecurityMaster:
+    """
+    Возвращает общий для процесса справочник бумаг.
+
+    :return: справочник бумаг
+    """
+    global _security_master
+
+    if _security_master is None:
+        _security_master = SecurityMaster()
+
+    return _security_master
+
+
+def set_security_master(security_master: SecurityMaster) -> None:
+    """
+    Заменяет общий справочник бумаг, например, на справочник с другим ttl или сохранением на диск.
+
+    :param security_master: новый справочник
+    """
+    global _security_master
+
+    _security_master = security_master
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import math
+from collections import OrderedDict, deque
+from typing import Callable
+
+import pandas as pd
+
+DEFAULT_INDICATOR_CACHE_SIZE = 4096  # сколько рассчитанных рядов хранит кэш индикаторов
+
+
+class StreamingEMA:
+
+    def __init__(self, span: int, min_periods: int = 0):
+        """
+        Экспоненциальное скользящее среднее, которое обновляется за O(1) на каждую новую цену. Совпадает с
+        ``pd.Series.ewm(span=span, min_periods=min_periods).mean()`` (adjust=True): числитель и знаменатель взвешенной
+        суммы хранятся в состоянии и умножаются на (1 - alpha) на каждом шаге.
+
+        .. code-block:: python
+
+            >>> import pandas as pd
+            >>> prices = pd.Series([10., 11., 12., 11.5, 13.])
+            >>> ema = StreamingEMA(span=3)
+            >>> [round(ema.update(price), 6) for price in prices] == prices.ewm(span=3).mean().round(6).tolist()
+            True
+
+        :param span: период EMA;
+        :param min_periods: сколько значений нужно, чтобы EMA начала возвращать значения, а не nan
+        """
+        self.span = span
+        self.min_periods = min_periods
+        self.decay = 1 - 2 / (span + 1)
+
+        self.numerator = 0.
+        self.denominator = 0.
+        self.count = 0  # количество полученных значений, не считая nan
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(span={self.span}, value={self.value})'
+
+    @property
+    def value(self) -> float:
+        if self.count == 0 or self.count < self.min_periods:
+            return math.nan
+
+        return self.numerator / self.denominator
+
+    def update(self, price: float) -> float:
+        """
+        :param price: новое значение ряда. nan после первого значения только уменьшает вес прошлых значений,
+                      как в pandas с ignore_na=False;
+        :return: новое значение EMA
+        """
+        if math.isnan(price):
+            if self.count:
+                self.numerator *= self.decay
+                self.denominator *= self.decay
+            return self.value
+
+        self.numerator = price + self.decay * self.numerator
+        self.denominator = 1 + self.decay * self.denominator
+        self.count += 1
+
+        return self.value
+
+    def get_state(self) -> dict:
+        """
+        :return: состояние индикатора, которое можно сохранить в json
+        """
+        return {'span': self.span, 'min_periods': self.min_periods, 'numerator': self.numerator,
+                'denominator': self.denominator, 'count': self.count}
+
+    @classmethod
+    def from_state(cls, state: dict) -> StreamingEMA:
+        """
+        :param state: состояние из get_state;
+        :return: индикатор с восстановленным состоянием
+        """
+        ema = cls(state['span'], state['min_periods'])
+        ema.numerator, ema.denominator, ema.count = state['numerator'], state['denominator'], state['count']
+        return ema
+
+
+class StreamingMACD:
+
+    def __init__(self, short_period: int = 12, long_period: int = 26, signal_period: int = 4):
+        """
+        Линейный MACD и его сигнальная линия, которые обновляются за O(1) на каждую новую цену. Совпадают с
+        calc_linear_macd и calc_signal_linear_macd, посчитанными по всей истории цен.
+
+        .. code-block:: python
+
+            >>> import numpy as np
+            >>> import pandas as pd
+            >>> from src.strategies.strategy_macd import calc_signal_linear_macd
+            >>> prices = pd.Series(100 + 10 * np.sin(np.arange(100) / 10))
+            >>> macd = StreamingMACD()
+            >>> signal = [macd.update(price)[1] for price in prices]
+            >>> np.allclose(signal, calc_signal_linear_macd(prices), equal_nan=True)
+            True
+
+        :param short_period: размер окна для короткого экспоненциального скользящего среднего;
+        :param long_period: размер окна для длинного экспоненциального скользящего среднего;
+        :param signal_period: период для сглаживания индикатора macd
+        """
+        self.short = StreamingEMA(short_period, min_periods=short_period)
+        self.long = StreamingEMA(long_period, min_periods=long_period)
+        self.signal = StreamingEMA(signal_period)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(macd={self.macd}, signal={self.signal.value})'
+
+    @property
+    def macd(self) -> float:
+        return self.short.value - self.long.value
+
+    def update(self, price: float) -> tuple[float, float]:
+        """
+        :param price: новая цена;
+        :return: новые значения MACD и сигнальной линии
+        """
+        self.short.update(price)
+        self.long.update(price)
+        macd = self.macd
+
+        return macd, self.signal.update(macd)
+
+    def get_state(self) -> dict:
+        """
+        :return: состояние индикатора, которое можно сохранить в json
+        """
+        return {'short': self.short.get_state(), 'long': self.long.get_state(), 'signal': self.signal.get_state()}
+
+    @classmethod
+    def from_state(cls, state: dict) -> StreamingMACD:
+        """
+        :param state: состояние из get_state;
+        :return: индикатор с восстановленным состоянием
+        """
+        macd = cls.__new__(cls)
+        macd.short = StreamingEMA.from_state(state['short'])
+        macd.long = StreamingEMA.from_state(state['long'])
+        macd.signal = StreamingEMA.from_state(state['signal'])
+        return macd
+
+
+class StreamingRollingMean:
+
+    def __init__(self, window: int):
+        """
+        Скользящее среднее по окну, которое обновляется за O(1): в состоянии хранятся последние значения окна и их
+        сумма. Совпадает с ``pd.Series.rolling(window).mean()``.
+
+        .. code-block:: python
+
+            >>> mean = StreamingRollingMean(window=3)
+            >>> [mean.update(price) for price in [1., 2., 3., 4.]]
+            [nan, nan, 2.0, 3.0]
+
+        :param window: размер окна
+        """
+        self.window = window
+        self.values: deque[float] = deque(maxlen=window)
+        self.total = 0.
+        self._updates = 0
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(window={self.window}, value={self.value})'
+
+    @property
+    def value(self) -> float:
+        if len(self.values) < self.window:
+            return math.nan
+
+        return self.total / self.window
+
+    def update(self, price: float) -> float:
+        """
+        :param price: новое значение ряда;
+        :return: новое значение скользящего среднего
+        """
+        if len(self.values) == self.window:
+            self.total -= self.values[0]
+
+        self.values.append(price)
+        self.total += price
+
+        # раз в окно сумма пересчитывается заново, чтобы не копилась ошибка округления от вычитаний
+        self._updates += 1
+        if self._updates % self.window == 0:
+            self.total = sum(self.values)
+
+        return self.value
+
+    def get_state(self) -> dict:
+        """
+        :return: состояние индикатора, которое можно сохранить в json
+        """
+        return {'window': self.window, 'values': list(self.values)}
+
+    @classmethod
+    def from_state(cls, state: dict) -> StreamingRollingMean:
+        """
+        :param state: состояние из get_state;
+        :return: индикатор с восстановленным состоянием
+        """
+        mean = cls(state['window'])
+        for value in state['values']:
+            mean.update(value)
+        return mean
+
+
+class IndicatorEngine:
+
+    def __init__(self, maxsize: int = DEFAULT_INDICATOR_CACHE_SIZE):
+        """
+        Общий кэш производных рядов (EMA, MACD, сигнальная линия, скользящее среднее, доходности). Ключ - тикер,
+        частота, версия истории тикера, индикатор, его параметры и окно цен (длина, первый и последний бар и
+        последнее значение), поэтому ключ строится за O(1), а один и тот же ряд считается один раз на бар, сколько бы
+        стратегий его ни запросили. Исправление прошлых баров ключ не меняет: тот, кто перезаписал историю (например,
+        кэш свечей), вызывает :meth:`invalidate`, и версия тикера увеличивается. Старые ряды вытесняются по LRU.
+        Если тикер не указан, ряд считается без кэша.
+
+        .. code-block:: python
+
+            >>> engine = IndicatorEngine(maxsize=16)
+            >>> prices = pd.Series([10., 11., 12., 11.5, 13.] * 10)
+            >>> signal = engine.macd_signal(prices, ticker='SBER')
+            >>> engine.macd_signal(prices, ticker='SBER') is signal
+            True
+            >>> ema = engine.ema(prices, span=12, min_periods=12, ticker='SBER')  # уже посчитана для MACD
+            >>> engine.stats()
+            {'hits': 2, 'misses': 4, 'size': 4}
+            >>> index = pd.date_range('2022-10-03', periods=5)
+            >>> mean = engine.rolling_mean(pd.Series([1., 2., 3., 4., 5.], index=index), 3, ticker='SBER')
+            >>> engine.invalidate('SBER')  # прошлые бары исправлены
+            >>> engine.rolling_mean(pd.Series([1., 9., 9., 9., 5.], index=index), 3, ticker='SBER').tolist()[2:]
+            [6.333333333333333, 9.0, 7.666666666666667]
+
+        :param maxsize: сколько рядов хранить
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._cache: OrderedDict[tuple, pd.Series] = OrderedDict()
+        self._versions: dict[str, int] = {}  # тикер -> версия истории
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.stats()})'
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: попадания и промахи кэша, количество рядов в кэше
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def invalidate(self, ticker: str) -> None:
+        """
+        Отмечает, что прошлые бары тикера изменились: ряды, посчитанные по старой истории, больше не выдаются и
+        вытесняются по LRU.
+
+        :param ticker: тикер бумаги
+        """
+        self._versions[ticker] = self._versions.get(ticker, 0) + 1
+
+    def get(self,
+            indicator: str,
+            prices: pd.Series,
+            params: tuple,
+            compute: Callable[[], pd.Series],
+            ticker: str = None,
+            frequency: str = '1d') -> pd.Series:
+        """
+        Возвращает ряд из кэша или считает его.
+
+        :param indicator: название индикатора;
+        :param prices: ряд цен;
+        :param params: параметры индикатора;
+        :param compute: функция без аргументов, которая считает ряд;
+        :param ticker: тикер бумаги. None - не кэшировать;
+        :param frequency: частота цен;
+        :return: ряд индикатора
+        """
+        if ticker is None or prices.empty:
+            return compute()
+
+        window = (len(prices), prices.index[0], prices.index[-1], prices.iloc[-1])
+        key = (ticker, frequency, self._versions.get(ticker, 0), indicator, params, window)
+
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        result = compute()
+        self._cache[key] = result
+
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+        return result
+
+    def ema(self,
+            prices: pd.Series,
+            span: int,
+            min_periods: int = 0,
+            ticker: str = None,
+            frequency: str = '1d') -> pd.Series:
+        """
+        :return: prices.ewm(span=span, min_periods=min_periods).mean()
+        """
+        return self.get('ema', prices, (span, min_periods),
+                        lambda: prices.ewm(span=span, min_periods=min_periods).mean(), ticker, frequency)
+
+    def rolling_mean(self, prices: pd.Series, window: int, ticker: str = None, frequency: str = '1d') -> pd.Series:
+        """
+        :return: prices.rolling(window).mean()
+        """
+        return self.get('rolling_mean', prices, (window,), lambda: prices.rolling(window).mean(), ticker, frequency)
+
+    def pct_change(self, prices: pd.Series, ticker: str = None, frequency: str = '1d') -> pd.Series:
+        """
+        :return: prices.pct_change()
+        """
+        return self.get('pct_change', prices, (), prices.pct_change, ticker, frequency)
+
+    def macd(self,
+             prices: pd.Series,
+             short_period: int = 12,
+             long_period: int = 26,
+             ticker: str = None,
+             frequency: str = '1d') -> pd.Series:
+        """
+        :return: линейный MACD, как calc_linear_macd. EMA берутся из кэша
+        """
+        def compute() -> pd.Series:
+            return self.ema(prices, short_period, short_period, ticker, frequency) - \
+                self.ema(prices, long_period, long_period, ticker, frequency)
+
+        return self.get('macd', prices, (short_period, long_period), compute, ticker, frequency)
+
+    def macd_signal(self,
+                    prices: pd.Series,
+                    short_period: int = 12,
+                    long_period: int = 26,
+                    signal_period: int = 4,
+                    ticker: str = None,
+                    frequency: str = '1d') -> pd.Series:
+        """
+        :return: сигнальная линия MACD, как calc_signal_linear_macd. MACD берется из кэша
+        """
+        def compute() -> pd.Series:
+            return self.macd(prices, short_period, long_period, ticker, frequency).ewm(span=signal_period).mean()
+
+        return self.get('macd_signal', prices, (short_period, long_period, signal_period), compute, ticker, frequency)
+
+
+_indicator_engine: IndicatorEngine | None = None
+
+
+def get_indicator_engine() -> IndicatorEngine:
+    """
+    Возвращает общий для процесса кэш индикаторов.
+
+    :return: кэш индикаторов
+    """
+    global _indicator_engine
+
+    if _indicator_engine is None:
+        _indicator_engine = IndicatorEngine()
+
+    return _indicator_engine
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
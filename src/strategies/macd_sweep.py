@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.strategies.indicators import IndicatorEngine
+from src.strategies.strategy_macd import simulate_macd_conservative_strategy
+from src.structures.st_strategies import TypeAction
+
+PARAMETERS = ('short_period', 'long_period', 'signal_period', 'ma_period')
+RANKING = (('total_return', False), ('max_drawdown', False), ('trades', True))  # колонка и порядок по возрастанию
+SWEEP_CACHE_SIZE = 16384  # сколько рядов индикаторов хранит кэш каждого процесса перебора
+CHUNKS_PER_PROCESS = 4  # на сколько частей делится перебор на каждый процесс
+
+_sweep_prices: pd.DataFrame | None = None
+_sweep_engine: IndicatorEngine | None = None
+
+
+def macd_parameter_grid(short_periods: list[int],
+                        long_periods: list[int],
+                        signal_periods: list[int],
+                        ma_periods: list[int]) -> list[dict]:
+    """
+    Сетка параметров консервативной стратегии macd. Комбинации, где короткий период не меньше длинного,
+    пропускаются.
+
+    .. code-block:: python
+
+        >>> grid = macd_parameter_grid([8, 12], [12, 26], [4], [60])
+        >>> [(params['short_period'], params['long_period']) for params in grid]
+        [(8, 12), (8, 26), (12, 26)]
+
+    :param short_periods: размеры окна короткой EMA;
+    :param long_periods: размеры окна длинной EMA;
+    :param signal_periods: периоды сглаживания macd;
+    :param ma_periods: периоды скользящего среднего;
+    :return: список параметров стратегии
+    """
+    return [
+        dict(zip(PARAMETERS, values))
+        for values in itertools.product(short_periods, long_periods, signal_periods, ma_periods)
+        if values[0] < values[1]
+    ]
+
+
+def random_macd_parameters(n: int,
+                           short_range: tuple[int, int] = (3, 20),
+                           long_range: tuple[int, int] = (10, 60),
+                           signal_range: tuple[int, int] = (2, 15),
+                           ma_range: tuple[int, int] = (10, 200),
+                           seed: int = None) -> list[dict]:
+    """
+    Случайный поиск: n различных наборов параметров из диапазонов (границы включительно), короткий период меньше
+    длинного. Если различных наборов в диапазонах меньше n, то возвращаются все.
+
+    .. code-block:: python
+
+        >>> configs = random_macd_parameters(100, seed=0)
+        >>> len(configs), all(params['short_period'] < params['long_period'] for params in configs)
+        (100, True)
+
+    :param n: количество наборов;
+    :param short_range: диапазон короткого периода;
+    :param long_range: диапазон длинного периода;
+    :param signal_range: диапазон периода сглаживания;
+    :param ma_range: диапазон периода скользящего среднего;
+    :param seed: зерно генератора случайных чисел;
+    :return: список параметров стратегии
+    """
+    ranges = (short_range, long_range, signal_range, ma_range)
+    low = np.array([bounds[0] for bounds in ranges])
+    high = np.array([bounds[1] for bounds in ranges]) + 1
+    pairs = sum(1 for short in range(low[0], high[0]) for long in range(low[1], high[1]) if short < long)
+    total = pairs * (high[2] - low[2]) * (high[3] - low[3])
+
+    rng = np.random.default_rng(seed)
+    configs: dict[tuple, dict] = {}
+
+    while len(configs) < min(n, total):
+        for values in rng.integers(low, high, size=(n, len(PARAMETERS))).tolist():
+            if values[0] < values[1] and len(configs) < n:
+                configs.setdefault(tuple(values), dict(zip(PARAMETERS, values)))
+
+    return list(configs.values())
+
+
+def evaluate_macd_parameters(prices: pd.DataFrame, params: dict, engine: IndicatorEngine = None) -> dict:
+    """
+    Оценка одного набора параметров: портфель с равными весами тикеров (ребалансировка на каждом таймстемпе),
+    каждая часть торгует по simulate_macd_conservative_strategy. EMA, сигнальная линия и скользящее среднее берутся
+    из кэша индикаторов, поэтому наборы с общими периодами не считают их заново.
+
+    .. code-block:: python
+
+        >>> prices = pd.DataFrame({'A': 100 + 10 * np.sin(np.arange(300) / 10), 'B': np.linspace(100, 200, 300)})
+        >>> result = evaluate_macd_parameters(prices, {'short_period': 12, 'long_period': 26, 'signal_period': 4,
+        ...                                            'ma_period': 60}, IndicatorEngine())
+        >>> result['trades'], round(result['exposure'], 3)
+        (8, 0.017)
+
+    :param prices: датафрейм цен, колонки - тикеры;
+    :param params: параметры стратегии: short_period, long_period, signal_period, ma_period;
+    :param engine: кэш индикаторов. Если None, то кэш создается только на этот вызов;
+    :return: параметры и метрики: total_return, max_drawdown (не больше 0), trades, exposure
+    """
+    engine = engine if engine is not None else IndicatorEngine()
+    returns = pd.DataFrame(0., index=prices.index, columns=prices.columns)
+    trades = 0
+    exposure = 0.
+
+    for ticker in prices.columns:
+        series = prices[ticker].dropna()
+        if series.empty:
+            continue
+
+        signal = engine.macd_signal(series, params['short_period'], params['long_period'], params['signal_period'],
+                                    ticker=ticker)
+        ma_prices = engine.rolling_mean(series, params['ma_period'], ticker=ticker)
+
+        simulation = simulate_macd_conservative_strategy(series, signal=signal, ma_prices=ma_prices)
+        returns[ticker] = simulation['returns']
+        trades += int((simulation['type_action'] != TypeAction.NOTHING).sum())
+        exposure += float((simulation['position'] != 0).mean())
+
+    equity = (1 + returns.fillna(0).mean(axis=1)).cumprod()
+    drawdown = equity / equity.cummax() - 1 if len(equity) else pd.Series([0.])
+
+    return {
+        **{name: params[name] for name in PARAMETERS},
+        'total_return': float(equity.iloc[-1] - 1) if len(equity) else 0.,
+        'max_drawdown': float(drawdown.min()),
+        'trades': trades,
+        'exposure': exposure / max(len(prices.columns), 1),
+    }
+
+
+def rank_macd_parameters(results: pd.DataFrame) -> pd.DataFrame:
+    """
+    Сортирует результаты перебора: больше доходность, меньше просадка, меньше сделок.
+
+    :param results: датафрейм метрик evaluate_macd_parameters;
+    :return: отсортированный датафрейм с колонкой rank (1 - лучший набор)
+    """
+    columns, ascending = zip(*RANKING)
+    ranked = results.sort_values(list(columns), ascending=list(ascending), kind='stable').reset_index(drop=True)
+    ranked.insert(0, 'rank', np.arange(1, len(ranked) + 1))
+
+    return ranked
+
+
+def sweep_macd_conservative_strategy(prices: pd.DataFrame,
+                                     configs: list[dict],
+                                     processes: int = None) -> pd.DataFrame:
+    """
+    Перебор параметров консервативной стратегии macd по тикерам в пуле процессов. Цены передаются в каждый процесс
+    один раз, у каждого процесса свой кэш индикаторов. Наборы сортируются по периодам и делятся на
+    последовательные части, поэтому наборы с одинаковыми EMA и сигнальной линией попадают в один процесс и
+    считаются подряд - EMA по каждому периоду считается в процессе один раз на тикер.
+
+    .. code-block:: python
+
+        >>> prices = pd.DataFrame({'A': 100 + 10 * np.sin(np.arange(300) / 10), 'B': np.linspace(100, 200, 300)})
+        >>> configs = macd_parameter_grid([8, 12], [26], [4, 9], [30, 60])
+        >>> ranked = sweep_macd_conservative_strategy(prices, configs, processes=1)
+        >>> ranked.columns.tolist()[5:]
+        ['total_return', 'max_drawdown', 'trades', 'exposure']
+        >>> len(ranked), ranked['total_return'].is_monotonic_decreasing
+        (8, True)
+
+    :param prices: датафрейм цен, колонки - тикеры;
+    :param configs: параметры стратегии, например из macd_parameter_grid или random_macd_parameters;
+    :param processes: количество процессов. По умолчанию количество ядер. 1 - без пула, в текущем процессе;
+    :return: результаты rank_macd_parameters
+    """
+    ordered = sorted(configs, key=lambda params: tuple(params[name] for name in PARAMETERS))
+
+    if processes == 1:
+        _init_sweep(prices)
+        results = _evaluate_chunk(ordered)
+    else:
+        with ProcessPoolExecutor(processes, initializer=_init_sweep, initargs=(prices,)) as executor:
+            n_chunks = (processes or os.cpu_count() or 1) * CHUNKS_PER_PROCESS
+            chunks = [chunk.tolist() for chunk in np.array_split(np.array(ordered, dtype=object), n_chunks)]
+            results = list(itertools.chain.from_iterable(executor.map(_evaluate_chunk, chunks)))
+
+    return rank_macd_parameters(pd.DataFrame(results, columns=[*PARAMETERS, *next(zip(*RANKING)), 'exposure']))
+
+
+def _init_sweep(prices: pd.DataFrame) -> None:
+    global _sweep_prices, _sweep_engine
+
+    _sweep_prices = prices
+    _sweep_engine = IndicatorEngine(maxsize=SWEEP_CACHE_SIZE)
+
+
+def _evaluate_chunk(configs: list[dict]) -> list[dict]:
+    """
+    Оценка части наборов параметров в процессе пула.
+
+    :param configs: параметры стратегии, отсортированные по периодам;
+    :return: метрики каждого набора
+    """
+    return [evaluate_macd_parameters(_sweep_prices, params, _sweep_engine) for params in configs]
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -4,6 +4,8 @@ import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+from src.strategies.indicators import get_indicator_engine
+
 
 class StockDataset(Dataset):
 
@@ -43,13 +45,14 @@ class RNNGAV(torch.nn.Module):
         out = self.tanh(out)
         return out
 
-    def predict(self, _x: torch.Tensor):
+    def predict(self, _x: torch.Tensor, ticker: str = None):
         """
         :param _x: - исходные сырые цены
+        :param ticker: - тикер бумаги. Если указан, то доходности берутся из общего кэша индикаторов
         :return: - предсказание на следующие 5 дней
         """
         assert len(_x) > self.input_size
-        pct = _x.pct_change().dropna().values
+        pct = get_indicator_engine().pct_change(_x, ticker=ticker).dropna().values
         pct = torch.tensor(pct[-self.input_size:]).reshape(1, self.input_size, 1).float()
         pred = self.forward(pct).flatten()
         pred_x = [_x.iloc[-1]]
@@ -1,9 +1,13 @@
+from __future__ import annotations
+
 import asyncio
+from collections import deque
 
-import aiohttp
+import numpy as np
 import pandas as pd
 
 from src.parse_securities.async_moex import get_security_history_aiomoex
+from src.strategies.indicators import StreamingMACD, StreamingRollingMean, get_indicator_engine
 from src.structures.st_strategies import StrategyResponse, DataRequest, TypeAction
 
 
@@ -44,14 +48,25 @@ async def get_decision_macd_conservative_strategy(prices: pd.Series, **kwargs) -
     """
     Возвращает ответ по консервативной стратегии macd на последний таймстемп.
 
+    Параметры стратегии передаются через kwargs, например ``functools.partial(
+    get_decision_macd_conservative_strategy, short_period=8, long_period=21)`` для Portfolio.
+
     :param prices: массив цен (закрытия / открытия / и т.д.);
-    :param kwargs: параметры для расчета сигнала:  short_period, long_period, signal_period;
+    :param kwargs: параметры для расчета сигнала: short_period, long_period, signal_period, параметр стратегий
+                   ma_period. ticker и frequency (по умолчанию 1d) - ключ общего кэша индикаторов;
     :return:
     """
 
-    async with aiohttp.ClientSession():
-        str_bull = await _get_decision_macd_cs_bullish(prices, **kwargs)
-        str_bear = await _get_decision_macd_cs_bearish(prices, **kwargs)
+    # сигнал нужен обеим стратегиям, берем его из общего кэша индикаторов - он считается один раз на бар
+    signal = get_indicator_engine().macd_signal(prices,
+                                                short_period=kwargs.get('short_period', 12),
+                                                long_period=kwargs.get('long_period', 26),
+                                                signal_period=kwargs.get('signal_period', 4),
+                                                ticker=kwargs.get('ticker'),
+                                                frequency=kwargs.get('frequency', '1d'))
+
+    str_bull = await _get_decision_macd_cs_bullish(prices, signal=signal, **kwargs)
+    str_bear = await _get_decision_macd_cs_bearish(prices, signal=signal, **kwargs)
 
     if str_bear.type_action is not None:
         return str_bear
@@ -63,18 +78,24 @@ async def get_decision_macd_conservative_strategy(prices: pd.Series, **kwargs) -
 
 
 # TODO: исправить на флаг продажи
-async def _get_decision_macd_cs_bearish(prices: pd.Series, ma_period: int = 60, **kwargs) -> StrategyResponse:
+async def _get_decision_macd_cs_bearish(prices: pd.Series,
+                                       ma_period: int = 60,
+                                       signal: pd.Series = None,
+                                       **kwargs) -> StrategyResponse:
     """
     Возвращает ответ по консервативной стратегии на понижение macd на последний таймстемп.
 
     :param prices: массив цен (закрытия / открытия / и т.д.);
     :param ma_period: период для скользящего среднего;
+    :param signal: уже посчитанный сигнал calc_signal_linear_macd(prices). Если None, то считается здесь;
     :param kwargs: параметры для расчета сигнала:  short_period, long_period, signal_period;
     :return: dict с ответом от стратегии
     """
-    signal = calc_signal_linear_macd(prices)
+    signal = signal if signal is not None else calc_signal_linear_macd(prices)
     if signal.iloc[-1] < 0 and (signal.iloc[-5:-2] > 0).all():  # проверяем, что сигнал медвежий после бычьих
-        ma_prices = prices.rolling(ma_period).mean()  # Находим скользящее среднее с большим окном
+        # Находим скользящее среднее с большим окном
+        ma_prices = get_indicator_engine().rolling_mean(prices, ma_period, ticker=kwargs.get('ticker'),
+                                                        frequency=kwargs.get('frequency', '1d'))
         delta = abs(ma_prices.iloc[-1] - prices.iloc[-1])
         st = prices.iloc[-1] + delta * 0.75
         tp = prices.iloc[-1] - delta * 0.75
@@ -93,18 +114,24 @@ async def _get_decision_macd_cs_bearish(prices: pd.Series, ma_period: int = 60,
 
 
 # TODO: исправить, чтобы цена округлялась по константе PRICE_ROUND
-async def _get_decision_macd_cs_bullish(prices: pd.Series, ma_period: int = 60, **kwargs) -> StrategyResponse:
+async def _get_decision_macd_cs_bullish(prices: pd.Series,
+                                       ma_period: int = 60,
+                                       signal: pd.Series = None,
+                                       **kwargs) -> StrategyResponse:
     """
     Возвращает ответ по консервативной стратегии на повышение macd на последний таймстемп.
 
     :param prices: массив цен (закрытия / открытия / и т.д.);
     :param ma_period: период для скользящего среднего;
+    :param signal: уже посчитанный сигнал calc_signal_linear_macd(prices). Если None, то считается здесь;
     :param kwargs: параметры для расчета сигнала:  short_period, long_period, signal_period;
     :return: dict с ответом от стратегии
     """
-    signal = calc_signal_linear_macd(prices)
+    signal = signal if signal is not None else calc_signal_linear_macd(prices)
     if signal.iloc[-1] > 0 and (signal.iloc[-5:-2] < 0).all():  # проверяем, что сигнал бычий после медвежьих
-        ma_prices = prices.rolling(ma_period).mean()  # Находим скользящее среднее с большим окном
+        # Находим скользящее среднее с большим окном
+        ma_prices = get_indicator_engine().rolling_mean(prices, ma_period, ticker=kwargs.get('ticker'),
+                                                        frequency=kwargs.get('frequency', '1d'))
         delta = abs(ma_prices.iloc[-1] - prices.iloc[-1])
         st = prices.iloc[-1] - delta * 0.75
         tp = prices.iloc[-1] + delta * 0.75
@@ -122,6 +149,292 @@ async def _get_decision_macd_cs_bullish(prices: pd.Series, ma_period: int = 60,
     return StrategyResponse()
 
 
+def get_signals_macd_conservative_strategy(prices: pd.Series,
+                                           ma_period: int = 60,
+                                           short_period: int = 12,
+                                           long_period: int = 26,
+                                           signal_period: int = 4,
+                                           signal: pd.Series = None,
+                                           ma_prices: pd.Series = None) -> pd.DataFrame:
+    """
+    Векторизованный режим консервативной стратегии macd: решения для каждого таймстемпа ряда цен за один проход.
+    EMA и скользящее среднее считаются по всему ряду один раз, их значение на таймстемпе совпадает со значением на
+    окне до этого таймстемпа, поэтому решения совпадают с пошаговым вызовом
+    get_decision_macd_conservative_strategy на prices.iloc[:i + 1].
+
+    .. code-block:: python
+
+        >>> import numpy as np
+        >>> prices = pd.Series(100 + 10 * np.sin(np.arange(300) / 10))
+        >>> signals = get_signals_macd_conservative_strategy(prices)
+        >>> signals.columns.tolist()
+        ['signal', 'bullish', 'bearish', 'type_action', 'price', 'stop_loss', 'take_profit']
+        >>> int(signals['bearish'].sum()), int(signals['bullish'].sum())
+        (8, 8)
+
+    :param prices: массив цен (закрытия / открытия / и т.д.);
+    :param ma_period: период для скользящего среднего;
+    :param short_period: размер окна для короткого экспоненциального скользящего среднего;
+    :param long_period: размер окна для длинного экспоненциального скользящего среднего;
+    :param signal_period: период для сглаживания индикатора macd;
+    :param signal: уже посчитанный сигнал calc_signal_linear_macd(prices, ...). Если None, то считается здесь;
+    :param ma_prices: уже посчитанное скользящее среднее prices.rolling(ma_period).mean(). Если None, то
+                      считается здесь;
+    :return: датафрейм с индексом prices: сигнал, флаги бычьего и медвежьего пересечения, действие стратегии,
+             цена, стоп-лосс и тейк-профит
+    """
+    signal = signal if signal is not None else calc_signal_linear_macd(prices, short_period, long_period,
+                                                                       signal_period)
+    ma_prices = ma_prices if ma_prices is not None else prices.rolling(ma_period).mean()
+    position = np.arange(len(prices))
+
+    # пошаговая стратегия смотрит на значения сигнала signal.iloc[-5:-2], то есть на 2, 3 и 4 таймстемпа назад.
+    # Таймстемпов до начала ряда в окне нет, поэтому они условию не мешают
+    was_bullish = np.ones(len(prices), dtype=bool)
+    was_bearish = np.ones(len(prices), dtype=bool)
+    for lag in (2, 3, 4):
+        lagged = signal.shift(lag).to_numpy()
+        was_bullish &= (lagged > 0) | (position < lag)
+        was_bearish &= (lagged < 0) | (position < lag)
+
+    bearish = (signal.to_numpy() < 0) & was_bullish  # сигнал медвежий после бычьих
+    bullish = (signal.to_numpy() > 0) & was_bearish  # сигнал бычий после медвежьих
+
+    delta = (ma_prices - prices).abs() * 0.75
+
+    # get_decision_macd_conservative_strategy всегда возвращает ответ медвежьей стратегии, если он есть
+    # (см. TODO у _get_decision_macd_cs_bearish), поэтому бычий сигнал действием не становится
+    type_action = np.where(bearish, TypeAction.SELL, TypeAction.NOTHING)
+
+    return pd.DataFrame({
+        'signal': signal,
+        'bullish': bullish,
+        'bearish': bearish,
+        'type_action': type_action,
+        'price': prices.where(bearish),
+        'stop_loss': (prices + delta).where(bearish),
+        'take_profit': (prices - delta).where(bearish),
+    }, index=prices.index)
+
+
+def simulate_macd_conservative_strategy(prices: pd.Series, **kwargs) -> pd.DataFrame:
+    """
+    Векторизованная симуляция позиции по консервативной стратегии macd. Каждое действие стратегии открывает позицию
+    в его направлении (или переворачивает текущую) по цене таймстемпа со своими стоп-лоссом и тейк-профитом.
+    Позиция закрывается на первом таймстемпе после открытия, где цена пересекла стоп-лосс или тейк-профит
+    (сравнение, как в Portfolio.check_st_tp), и остается закрытой до следующего действия.
+
+    .. code-block:: python
+
+        >>> import numpy as np
+        >>> prices = pd.Series(100 + 10 * np.sin(np.arange(300) / 10))
+        >>> simulation = simulate_macd_conservative_strategy(prices)
+        >>> simulation['position'].value_counts().to_dict()
+        {0: 290, -1: 10}
+        >>> int(simulation['transition'].sum())
+        8
+
+    :param prices: массив цен (закрытия / открытия / и т.д.);
+    :param kwargs: параметры get_signals_macd_conservative_strategy: ma_period, short_period, long_period,
+                   signal_period и уже посчитанные signal и ma_prices;
+    :return: датафрейм сигналов get_signals_macd_conservative_strategy и колонки position (1 - длинная позиция,
+             -1 - короткая, 0 - без позиции), transition (позиция изменилась), returns (доходность стратегии)
+             и equity (накопленная доходность)
+    """
+    signals = get_signals_macd_conservative_strategy(prices, **kwargs)
+    entry = signals['type_action'] != TypeAction.NOTHING
+
+    # номер сделки: каждое действие стратегии начинает новую сделку, ее параметры действуют до следующего действия
+    trade = entry.cumsum()
+    direction = signals['type_action'].where(entry).ffill().fillna(TypeAction.NOTHING)
+    stop_loss = signals['stop_loss'].where(entry).ffill()
+    take_profit = signals['take_profit'].where(entry).ffill()
+
+    long_exit = (prices < stop_loss) | (prices > take_profit)
+    short_exit = (prices > stop_loss) | (prices < take_profit)
+    hit = ((direction == TypeAction.BUY) & long_exit) | ((direction == TypeAction.SELL) & short_exit)
+    hit &= ~entry  # на таймстемпе открытия позиция не закрывается
+
+    closed = hit.astype(int).groupby(trade).cumsum() > 0
+    position = direction.where(~closed, TypeAction.NOTHING).astype(int)
+
+    signals['position'] = position
+    signals['transition'] = position.diff().fillna(position).ne(0)
+    signals['returns'] = position.shift(1, fill_value=0) * prices.pct_change().fillna(0)
+    signals['equity'] = (1 + signals['returns']).cumprod()
+
+    return signals
+
+
+def backtest_macd_conservative_strategy(prices: pd.DataFrame, **kwargs) -> pd.DataFrame:
+    """
+    Векторизованный бэктест консервативной стратегии macd по многим тикерам сразу.
+
+    .. code-block:: python
+
+        >>> import numpy as np
+        >>> prices = pd.DataFrame({'A': 100 + 10 * np.sin(np.arange(300) / 10), 'B': np.linspace(100, 200, 300)})
+        >>> backtest_macd_conservative_strategy(prices)['trades'].to_dict()
+        {'A': 8, 'B': 0}
+
+    :param prices: датафрейм цен, колонки - тикеры;
+    :param kwargs: параметры стратегии: ma_period, short_period, long_period, signal_period;
+    :return: датафрейм с тикерами в индексе: количество сделок, доля времени в позиции и итоговая доходность
+    """
+    summary = {}
+
+    for ticker in prices.columns:
+        simulation = simulate_macd_conservative_strategy(prices[ticker].dropna(), **kwargs)
+        summary[ticker] = {
+            'trades': int((simulation['type_action'] != TypeAction.NOTHING).sum()),
+            'exposure': float((simulation['position'] != 0).mean()),
+            'total_return': float(simulation['equity'].iloc[-1] - 1) if len(simulation) else 0.,
+        }
+
+    return pd.DataFrame.from_dict(summary, orient='index')
+
+
+class MacdConservativeStreamingStrategy:
+
+    def __init__(self, ma_period: int = 60, short_period: int = 12, long_period: int = 26, signal_period: int = 4):
+        """
+        Консервативная стратегия macd на потоковых индикаторах: для каждого тикера хранится состояние EMA, MACD,
+        сигнальной линии и скользящего среднего, и каждая новая цена обрабатывается за O(1) - задержка решения не
+        зависит от длины истории. Решения совпадают с get_signals_macd_conservative_strategy по всей истории,
+        которую получила стратегия.
+
+        Стратегию можно передать в Portfolio вместо get_decision_macd_conservative_strategy: при каждом вызове она
+        обрабатывает только цены, индекс которых больше последнего обработанного.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> prices = pd.Series(100 + 10 * np.sin(np.arange(300) / 10))
+            >>> strategy = MacdConservativeStreamingStrategy()
+            >>> actions = [strategy.update('SBER', price).type_action for price in prices]
+            >>> actions == get_signals_macd_conservative_strategy(prices)['type_action'].tolist()
+            True
+            >>> restored = MacdConservativeStreamingStrategy.from_state(strategy.get_state())
+            >>> restored.update('SBER', 101.).comment == strategy.update('SBER', 101.).comment
+            True
+
+        :param ma_period: период для скользящего среднего;
+        :param short_period: размер окна для короткого экспоненциального скользящего среднего;
+        :param long_period: размер окна для длинного экспоненциального скользящего среднего;
+        :param signal_period: период для сглаживания индикатора macd
+        """
+        self.ma_period = ma_period
+        self.short_period = short_period
+        self.long_period = long_period
+        self.signal_period = signal_period
+
+        self.states: dict[str, dict] = {}
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(tickers={list(self.states)})'
+
+    def _new_state(self) -> dict:
+        return {
+            'macd': StreamingMACD(self.short_period, self.long_period, self.signal_period),
+            'ma': StreamingRollingMean(self.ma_period),
+            'signals': deque(maxlen=5),  # последние значения сигнала: решению нужны 2, 3 и 4 таймстемпа назад
+            'last_index': None,
+        }
+
+    def update(self, ticker: str, price: float) -> StrategyResponse:
+        """
+        Обрабатывает новую цену тикера за O(1).
+
+        :param ticker: тикер бумаги;
+        :param price: новая цена;
+        :return: ответ стратегии на эту цену
+        """
+        state = self.states.get(ticker)
+        if state is None:
+            state = self.states[ticker] = self._new_state()
+
+        signal = state['macd'].update(price)[1]
+        ma_price = state['ma'].update(price)
+        signals = state['signals']
+        signals.append(signal)
+
+        previous = list(signals)[-5:-2]
+        if signal < 0 and all(value > 0 for value in previous):  # проверяем, что сигнал медвежий после бычьих
+            delta = abs(ma_price - price)
+            st = price + delta * 0.75
+            tp = price - delta * 0.75
+
+            return StrategyResponse(
+                ticker=ticker,
+                type_action=TypeAction.SELL,
+                price=price,
+                stop_loss=st,
+                take_profit=tp,
+                comment=f'Сигнал медвежий: {signal}. Продаем по цене и ждем пока цена не достигнет {tp:.2f}.'
+            )
+
+        # как и get_decision_macd_conservative_strategy, возвращаем ответ медвежьей стратегии
+        return StrategyResponse(comment='macd bearish conservative strategy is not triggered')
+
+    async def __call__(self, prices: pd.Series, **kwargs) -> StrategyResponse:
+        """
+        Обрабатывает цены, которых стратегия еще не видела, и возвращает решение на последний таймстемп.
+
+        :param prices: массив цен с возрастающим индексом (например, время начала свечи);
+        :param kwargs: ticker - тикер бумаги;
+        :return: ответ стратегии. Если новых цен нет, то ничего не делать
+        """
+        ticker = kwargs['ticker']
+        last_index = self.states[ticker]['last_index'] if ticker in self.states else None
+        new_prices = prices if last_index is None else prices[prices.index > last_index]
+
+        response = StrategyResponse()
+        for price in new_prices:
+            response = self.update(ticker, price)
+
+        if len(new_prices):
+            self.states[ticker]['last_index'] = new_prices.index[-1]
+
+        return response
+
+    def get_state(self) -> dict:
+        """
+        :return: параметры и состояние стратегии по всем тикерам, которые можно сохранить в json
+        """
+        return {
+            'params': {'ma_period': self.ma_period, 'short_period': self.short_period,
+                       'long_period': self.long_period, 'signal_period': self.signal_period},
+            'states': {
+                ticker: {
+                    'macd': state['macd'].get_state(),
+                    'ma': state['ma'].get_state(),
+                    'signals': list(state['signals']),
+                    'last_index': state['last_index'].item() if hasattr(state['last_index'], 'item')
+                    else state['last_index'],
+                }
+                for ticker, state in self.states.items()
+            },
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> MacdConservativeStreamingStrategy:
+        """
+        :param state: состояние из get_state;
+        :return: стратегия с восстановленным состоянием
+        """
+        strategy = cls(**state['params'])
+
+        for ticker, ticker_state in state['states'].items():
+            strategy.states[ticker] = {
+                'macd': StreamingMACD.from_state(ticker_state['macd']),
+                'ma': StreamingRollingMean.from_state(ticker_state['ma']),
+                'signals': deque(ticker_state['signals'], maxlen=5),
+                'last_index': ticker_state['last_index'],
+            }
+
+        return strategy
+
+
 async def test():
     """ Тест - скачиваем данные по сберу и запускаем нашу стратегию для каждой даты """
     req = DataRequest(['SBER'], '2022-04-01', '2022-09-01', '1d', ['TRADEDATE', 'CLOSE'])
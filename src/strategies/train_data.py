@@ -11,7 +11,8 @@ data = asyncio.run(get_security_history_aiomoex(
         tickers=MOEX_LIST,
         dt_start='2018-01-01',
         dt_end='2022-10-01',
-        dt_frequency='1d'
+        dt_frequency='1d',
+        columns=['TRADEDATE', 'CLOSE']
     )
 ))
 data = pd.DataFrame(data).T
@@ -20,7 +21,7 @@ for _, row in data.iterrows():
     if row['data'].shape[0] == 0:
         continue
     row.data['ticker'] = row.name
-    row.data['date'] = row.data.begin.str.slice(0, 10)
+    row.data['date'] = pd.to_datetime(row.data.begin, unit='s').dt.strftime('%Y-%m-%d')
     x = pd.concat([x, row.data[['close', 'date', 'ticker']]])
 
 x.to_pickle('x.pkl')
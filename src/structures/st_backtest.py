@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import asyncio
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from src.parse_securities.candles import CANDLE_COLUMNS
+from src.parse_securities.data_sources import BaseDataSource, MemmapDataSource, MemoryDataSource, MoexDataSource, \
+    run_with_source
+from src.parse_securities.price_oracle import PriceOracle
+from src.structures.st_clock import VirtualClock
+from src.structures.st_portfolio import Portfolio
+from src.structures.st_strategies import DataRequest
+
+STRATEGY_LOOKBACK = pd.Timedelta(days=50)  # сколько дней истории стратегия получает на каждом шаге
+SHARES_LOOKBACK = pd.Timedelta(days=365 * 3)  # сколько дней истории нужно для расчета весов по ковариации
+DEFAULT_EXECUTION_TIME = pd.Timedelta(hours=11)  # время дня, в которое исполняются заявки
+
+
+class Backtest:
+
+    def __init__(self,
+                 tickers: list[str],
+                 dt_start: str | pd.Timestamp,
+                 dt_end: str | pd.Timestamp,
+                 strategy: callable,
+                 init_balance: int | float = 100_000,
+                 weights: list[float] = None,
+                 data_source: BaseDataSource = None,
+                 execution_frequency: str = '1min',
+                 execution_time: pd.Timedelta = DEFAULT_EXECUTION_TIME,
+                 verbose: bool = True):
+        """
+        Бэктест портфеля в памяти. Вся история по всем тикерам загружается из источника данных один раз: дневные
+        свечи для стратегии и весов, свечи ``execution_frequency`` для исполнения заявок. Затем портфель работает
+        с MemoryDataSource из этих свечей, а время ему задают часы симуляции - те же шаги Portfolio.call_strategy,
+        исполнение заявок и история портфеля, но без единого запроса к бирже внутри цикла.
+
+        Портфель проходит каждый день периода [dt_start, dt_end], заявки исполняются в ``execution_time``.
+        Результат совпадает с портфелем, который шагает по тем же свечам через call_strategy вручную:
+
+        .. code-block:: python
+
+            >>> from src.parse_securities.data_sources import SyntheticDataSource
+            >>> from src.strategies.strategy_macd import get_decision_macd_conservative_strategy
+            >>> strategy = get_decision_macd_conservative_strategy
+            >>> backtest = Backtest(['SBER', 'GAZP'], '2022-01-01', '2022-03-31', strategy, weights=[1, 1],
+            ...                     data_source=SyntheticDataSource(), verbose=False)
+            >>> portfolio = backtest.run()
+            >>> round(portfolio.full_balance, 2), len(portfolio.history_table)
+            (88048.19, 218)
+
+            >>> manual = Portfolio(100_000, ['SBER', 'GAZP'], [1, 1], strategy, data_source=backtest.memory_source,
+            ...                    clock=VirtualClock('2021-12-31 11:00:00', '2022-03-31 11:00:00'),
+            ...                    price_oracle=PriceOracle(backtest.memory_source), verbose=False)
+            >>> async def walk():
+            ...     while not manual.flg_end_process:
+            ...         await manual.call_strategy()
+            >>> asyncio.run(walk())
+            >>> manual.full_balance == portfolio.full_balance, manual.free_balance == portfolio.free_balance
+            (True, True)
+            >>> manual.history_table.to_frame().equals(portfolio.history_table.to_frame())
+            True
+
+        :param tickers: тикеры портфеля;
+        :param dt_start: первый день симуляции;
+        :param dt_end: последний день симуляции;
+        :param strategy: стратегия портфеля;
+        :param init_balance: начальный баланс портфеля;
+        :param weights: веса акций в портфеле. Если не указаны, то считаются по ковариации за 3 года до dt_start;
+        :param data_source: источник, из которого загружается история. По умолчанию MOEX ISS;
+        :param execution_frequency: частота свечей, по которым исполняются заявки;
+        :param execution_time: время дня, в которое стратегия принимает решения и исполняются заявки;
+        :param verbose: печатать ли решения стратегии, см. Portfolio
+        """
+        self.tickers = tickers
+        self.dt_start = pd.Timestamp(dt_start).normalize()
+        self.dt_end = pd.Timestamp(dt_end).normalize()
+        self.strategy = strategy
+        self.init_balance = init_balance
+        self.weights = weights
+        self.data_source = data_source if data_source is not None else MoexDataSource()
+        self.execution_frequency = execution_frequency
+        self.execution_time = execution_time
+        self.verbose = verbose
+
+        self.memory_source: MemoryDataSource | None = None
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(tickers={self.tickers}, dt_start={self.dt_start.date()}, ' \
+               f'dt_end={self.dt_end.date()})'
+
+    async def preload(self) -> MemoryDataSource:
+        """
+        Загружает всю историю, которая понадобится портфелю, одним запросом на каждую частоту.
+
+        :return: источник данных из загруженных свечей
+        """
+        lookback = STRATEGY_LOOKBACK if self.weights is not None else max(STRATEGY_LOOKBACK, SHARES_LOOKBACK)
+        # стратегия и расчет цены заявки заглядывают на день вперед от текущего
+        last_day = self.dt_end + pd.Timedelta(days=2)
+
+        daily, execution = await asyncio.gather(
+            self.data_source.get_history(DataRequest(
+                tickers=self.tickers,
+                dt_start=self.dt_start - lookback,
+                dt_end=last_day,
+                dt_frequency='1d',
+                columns=CANDLE_COLUMNS
+            )),
+            self.data_source.get_history(DataRequest(
+                tickers=self.tickers,
+                dt_start=self.dt_start,
+                dt_end=last_day,
+                dt_frequency=self.execution_frequency,
+                columns=CANDLE_COLUMNS
+            ))
+        )
+
+        source = MemoryDataSource()
+        for ticker in self.tickers:
+            for frequency, response in (('1d', daily[ticker]), (self.execution_frequency, execution[ticker])):
+                if response['ok']:
+                    source.add(ticker, frequency, response['data'])
+                    source.lotsizes[ticker] = response['lotsize']
+
+        self.memory_source = source
+
+        return source
+
+    def run(self) -> Portfolio:
+        """
+        Загружает историю и проводит симуляцию.
+
+        :return: портфель после симуляции с балансами и историей
+        """
+        if self.memory_source is None:
+            run_with_source(self.data_source, self.preload())
+
+        # call_strategy сначала сдвигает часы на день, поэтому часы стоят за день до начала
+        clock = VirtualClock(
+            self.dt_start - pd.Timedelta(days=1) + self.execution_time,
+            self.dt_end + self.execution_time
+        )
+        portfolio = Portfolio(
+            init_balance=self.init_balance,
+            tickers=self.tickers,
+            weights=self.weights,
+            strategy=self.strategy,
+            data_source=self.memory_source,
+            clock=clock,
+            price_oracle=PriceOracle(self.memory_source, tuple(dict.fromkeys((self.execution_frequency, '1d')))),
+            verbose=self.verbose
+        )
+
+        asyncio.run(self._walk(portfolio))
+
+        return portfolio
+
+    @staticmethod
+    async def _walk(portfolio: Portfolio) -> None:
+        """
+        Двигает часы портфеля по дням, пока не закончится период.
+
+        :param portfolio: портфель
+        """
+        while not portfolio.flg_end_process:
+            await portfolio.call_strategy()
+
+
+class MultiBacktest:
+
+    def __init__(self,
+                 configs: list[dict],
+                 dt_start: str | pd.Timestamp,
+                 dt_end: str | pd.Timestamp,
+                 strategy: callable,
+                 data_source: BaseDataSource = None,
+                 execution_frequency: str = '1min',
+                 execution_time: pd.Timedelta = DEFAULT_EXECUTION_TIME,
+                 path: str = None,
+                 processes: int = None):
+        """
+        Бэктест многих конфигураций портфеля (тикеры, веса, начальный баланс) на одних и тех же данных. История по
+        всем тикерам всех конфигураций загружается один раз и записывается в файлы, которые отображаются в память
+        (MemmapDataSource). Симуляции идут в пуле процессов: каждый процесс открывает файлы один раз, а все
+        портфели читают одни и те же страницы памяти ОС, поэтому данные не копируются в каждый процесс.
+
+        Стратегия передается в процессы, поэтому она должна быть функцией или объектом уровня модуля.
+
+        .. code-block:: python
+
+            >>> from src.parse_securities.data_sources import SyntheticDataSource
+            >>> from src.strategies.strategy_macd import get_decision_macd_conservative_strategy
+            >>> strategy = get_decision_macd_conservative_strategy
+            >>> configs = [{'tickers': ['SBER', 'GAZP'], 'weights': [1, 1]},
+            ...            {'tickers': ['SBER', 'LKOH'], 'weights': [2, 1], 'init_balance': 200_000}]
+            >>> backtest = MultiBacktest(configs, '2022-01-01', '2022-03-31', strategy,
+            ...                          data_source=SyntheticDataSource(), processes=2)
+            >>> summary = backtest.run()
+            >>> summary[['run', 'init_balance', 'full_balance']].round(2)
+               run  init_balance  full_balance
+            0    0        100000      88048.19
+            1    1        200000     186573.93
+
+            Каждая конфигурация дает те же балансы, что и отдельный Backtest:
+
+            >>> single = [Backtest(config['tickers'], '2022-01-01', '2022-03-31', strategy, weights=config['weights'],
+            ...                    init_balance=config.get('init_balance', 100_000),
+            ...                    data_source=SyntheticDataSource(), verbose=False).run() for config in configs]
+            >>> summary['full_balance'].tolist() == [portfolio.full_balance for portfolio in single]
+            True
+            >>> summary['free_balance'].tolist() == [portfolio.free_balance for portfolio in single]
+            True
+
+        :param configs: конфигурации портфелей: словари с ключами tickers, weights (необязательно) и init_balance
+                        (необязательно, по умолчанию 100 000);
+        :param dt_start: первый день симуляции;
+        :param dt_end: последний день симуляции;
+        :param strategy: стратегия портфелей;
+        :param data_source: источник, из которого загружается история. По умолчанию MOEX ISS;
+        :param execution_frequency: частота свечей, по которым исполняются заявки;
+        :param execution_time: время дня, в которое стратегия принимает решения и исполняются заявки;
+        :param path: папка для файлов с историей. По умолчанию временная папка, которая удаляется после run;
+        :param processes: количество процессов. По умолчанию количество ядер
+        """
+        self.configs = configs
+        self.dt_start = pd.Timestamp(dt_start).normalize()
+        self.dt_end = pd.Timestamp(dt_end).normalize()
+        self.strategy = strategy
+        self.data_source = data_source if data_source is not None else MoexDataSource()
+        self.execution_frequency = execution_frequency
+        self.execution_time = execution_time
+        self.path = path
+        self.processes = processes
+
+        self.shared_source: MemmapDataSource | None = None
+        self._temporary_directory: tempfile.TemporaryDirectory | None = None  # папка, если path не указан
+        self.histories: pd.DataFrame | None = None  # истории всех портфелей с номером конфигурации в колонке run
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(configs={len(self.configs)}, dt_start={self.dt_start.date()}, ' \
+               f'dt_end={self.dt_end.date()})'
+
+    async def preload(self) -> MemmapDataSource:
+        """
+        Загружает историю по всем тикерам всех конфигураций и записывает ее в файлы.
+
+        :return: источник данных из записанных файлов
+        """
+        tickers = list(dict.fromkeys(ticker for config in self.configs for ticker in config['tickers']))
+        # веса нужны только для глубины истории: если хотя бы одной конфигурации нужен расчет весов, грузим 3 года
+        weights = None if any(config.get('weights') is None for config in self.configs) else [1] * len(tickers)
+
+        source = await Backtest(
+            tickers, self.dt_start, self.dt_end, self.strategy,
+            weights=weights,
+            data_source=self.data_source,
+            execution_frequency=self.execution_frequency,
+            execution_time=self.execution_time
+        ).preload()
+
+        path = self.path
+        if path is None:
+            self.cleanup()
+            self._temporary_directory = tempfile.TemporaryDirectory(prefix='stock_bot_')
+            path = self._temporary_directory.name
+
+        self.shared_source = MemmapDataSource.write(source, path)
+
+        return self.shared_source
+
+    def run(self) -> pd.DataFrame:
+        """
+        Загружает историю и проводит симуляции всех конфигураций в пуле процессов.
+
+        :return: таблица результатов: строка на конфигурацию с ее параметрами, итоговыми балансами и прибылью.
+                 Истории портфелей - в self.histories
+        """
+        if self.shared_source is None:
+            run_with_source(self.data_source, self.preload())
+
+        tasks = [{
+            'tickers': config['tickers'],
+            'weights': config.get('weights'),
+            'init_balance': config.get('init_balance', 100_000),
+            'dt_start': self.dt_start,
+            'dt_end': self.dt_end,
+            'strategy': self.strategy,
+            'execution_frequency': self.execution_frequency,
+            'execution_time': self.execution_time,
+        } for config in self.configs]
+
+        try:
+            with ProcessPoolExecutor(self.processes, initializer=_open_shared_source,
+                                     initargs=(self.shared_source.path,)) as pool:
+                results = list(pool.map(_run_config, tasks))
+        finally:
+            self.cleanup()
+
+        summary, histories = [], []
+        for run, (task, result) in enumerate(zip(tasks, results)):
+            history = result.pop('history')
+            histories.append(history.assign(run=run))
+            summary.append({
+                'run': run,
+                'tickers': task['tickers'],
+                'weights': task['weights'],
+                'init_balance': task['init_balance'],
+                **result,
+                'total_return': result['full_balance'] / task['init_balance'] - 1,
+            })
+
+        self.histories = pd.concat(histories, ignore_index=True) if histories else pd.DataFrame()
+
+        return pd.DataFrame(summary)
+
+    def cleanup(self) -> None:
+        """
+        Удаляет временную папку с историей, если она создана в preload. Папка, указанная в path, не удаляется.
+        """
+        if self._temporary_directory is None:
+            return
+
+        self.shared_source = None
+        self._temporary_directory.cleanup()
+        self._temporary_directory = None
+
+
+_shared_source: MemmapDataSource | None = None  # источник данных процесса пула, открывается один раз
+
+
+def _open_shared_source(path: str) -> None:
+    global _shared_source
+
+    _shared_source = MemmapDataSource(path)
+
+
+def _run_config(task: dict) -> dict:
+    """
+    Симуляция одной конфигурации в процессе пула.
+
+    :param task: параметры Backtest;
+    :return: итоговые балансы, прибыль и история портфеля
+    """
+    backtest = Backtest(
+        task['tickers'], task['dt_start'], task['dt_end'], task['strategy'],
+        init_balance=task['init_balance'],
+        weights=task['weights'],
+        data_source=_shared_source,
+        execution_frequency=task['execution_frequency'],
+        execution_time=task['execution_time'],
+        verbose=False
+    )
+    backtest.memory_source = _shared_source
+    portfolio = backtest.run()
+
+    return {
+        'full_balance': portfolio.full_balance,
+        'free_balance': portfolio.free_balance,
+        'realised_pnl': portfolio.realised_pnl,
+        'unrealised_pnl': portfolio.unrealised_pnl,
+        'history': portfolio.history_table.to_frame(),
+    }
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import pandas as pd
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Clock:
+    """
+    Базовый класс часов. Портфель и процесс покупки берут текущее время только из часов, поэтому один и тот же код
+    работает и в реальном времени, и в симуляции, где время двигает движок бэктеста.
+    """
+
+    def now(self) -> pd.Timestamp:
+        """
+        :return: текущее время
+        """
+        raise NotImplementedError
+
+    def now_str(self) -> str:
+        """
+        :return: текущее время в формате '%Y-%m-%d %H:%M:%S'
+        """
+        return self.now().strftime(DATETIME_FORMAT)
+
+    @property
+    def finished(self) -> bool:
+        """
+        :return: дошло ли время до конца периода, который нужно прожить
+        """
+        return False
+
+
+class SystemClock(Clock):
+    """
+    Часы реального времени.
+    """
+
+    def now(self) -> pd.Timestamp:
+        return pd.Timestamp.now()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}()'
+
+
+class VirtualClock(Clock):
+
+    def __init__(self, start: str | pd.Timestamp, end: str | pd.Timestamp = None):
+        """
+        Часы симуляции: время стоит на месте, пока его не сдвинут через :meth:`set` или :meth:`advance`.
+
+        .. code-block:: python
+
+            >>> clock = VirtualClock('2022-09-15 11:00:00', end='2022-09-17')
+            >>> clock.advance(pd.Timedelta(days=1)).now_str(), clock.finished
+            ('2022-09-16 11:00:00', False)
+            >>> clock.advance(pd.Timedelta(days=1)).finished
+            True
+
+        :param start: начальное время;
+        :param end: конец периода симуляции. По умолчанию время создания часов
+        """
+        self._now = pd.Timestamp(start)
+        self.end = pd.Timestamp(end) if end is not None else pd.Timestamp.now()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(now={self._now}, end={self.end})'
+
+    def now(self) -> pd.Timestamp:
+        return self._now
+
+    @property
+    def finished(self) -> bool:
+        return self._now >= self.end
+
+    def set(self, dt: str | pd.Timestamp) -> VirtualClock:
+        """
+        Переводит часы на указанное время.
+
+        :param dt: новое время;
+        :return: сами часы
+        """
+        self._now = pd.Timestamp(dt)
+        return self
+
+    def advance(self, delta: pd.Timedelta) -> VirtualClock:
+        """
+        Сдвигает часы вперед.
+
+        :param delta: на сколько сдвинуть;
+        :return: сами часы
+        """
+        self._now = self._now + delta
+        return self
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,414 @@
+from __future__ import annotations
+
+import json
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from src.parse_securities.candles import to_epoch
+from src.parse_securities.data_sources import BaseDataSource, MoexDataSource
+from src.parse_securities.moex_client import get_moex_client
+from src.structures.st_strategies import DataRequest
+
+COVARIANCE_HORIZON = pd.Timedelta(days=365 * 3)  # за какой период считается ковариация для весов портфеля
+COVARIANCE_FILE = 'covariance.json'
+COVARIANCE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'stock-bot')  # если у клиента нет кэша свечей
+
+
+def covariance_path(data_source: BaseDataSource) -> str | None:
+    """
+    Путь, по которому сохраняется ковариация цен из источника данных: для MOEX ISS - рядом с кэшем свечей клиента
+    (или в COVARIANCE_DIR, если кэша нет). Ковариацию по другим источникам (синтетика, файлы, память) не сохраняем,
+    чтобы при следующем запуске она не смешалась с биржевыми ценами.
+
+    .. code-block:: python
+
+        >>> from src.parse_securities.data_sources import SyntheticDataSource
+        >>> covariance_path(SyntheticDataSource()) is None
+        True
+
+    :param data_source: источник рыночных данных;
+    :return: путь к json файлу или None - не сохранять
+    """
+    if not isinstance(data_source, MoexDataSource):
+        return None
+
+    cache = (data_source.client if data_source.client is not None else get_moex_client()).candle_cache
+    return os.path.join(cache.path if cache is not None else COVARIANCE_DIR, COVARIANCE_FILE)
+
+
+class RollingCovariance:
+
+    def __init__(self, tickers: list[str], horizon: pd.Timedelta = COVARIANCE_HORIZON, path: str = None):
+        """
+        Скользящие средние и ковариации рядов нескольких бумаг за период ``horizon``. Для каждой пары бумаг
+        хранятся накопленные суммы по барам, где есть значения обеих бумаг: количество баров, сумма значений и сумма
+        произведений. Новый бар добавляется, а бар старше периода вычитается за O(n^2) без пересчета по всей истории,
+        поэтому средние, ковариации и веса портфеля доступны сразу. Результат совпадает с ``pd.DataFrame.mean()`` и
+        ``pd.DataFrame.cov()`` по барам периода (пропуски исключаются попарно).
+
+        Значения хранятся со сдвигом на первое значение каждой бумаги, чтобы суммы квадратов не теряли точность.
+        Раз в окно суммы пересчитываются заново по хранимым барам, чтобы не копилась ошибка округления от вычитаний.
+
+        Если указан путь, то состояние читается с диска при создании (если период совпадает) и сохраняется
+        методом :meth:`save`, поэтому при следующем запуске догружаются только новые бары, см. :meth:`refresh`.
+        Тикеры из сохраненного состояния остаются, а недостающие добавляются через :meth:`add_tickers`.
+
+        .. code-block:: python
+
+            >>> prices = pd.DataFrame({'A': [10., 11., 12., 11.5, 13.], 'B': [100., 99., np.nan, 101., 104.]},
+            ...                       index=pd.date_range('2022-10-03', periods=5))
+            >>> covariance = RollingCovariance(['A', 'B'], horizon=pd.Timedelta(days=3))
+            >>> covariance.update_many(prices)
+            >>> np.allclose(covariance.covariance(), prices.iloc[-4:].cov())  # бары за [t - 3 дня, t]
+            True
+            >>> covariance.inverse_variance_weights().round(4)
+            array([0.1066, 0.8934])
+
+        :param tickers: тикеры бумаг;
+        :param horizon: период, за который считаются статистики. None - вся история;
+        :param path: путь к json файлу для сохранения состояния между запусками. None - не сохранять
+        """
+        self.tickers = list(tickers)
+        self._positions = {ticker: position for position, ticker in enumerate(self.tickers)}
+        self.horizon = pd.Timedelta(horizon) if horizon is not None else None
+        self.path = path
+        self._pending: set[str] = set()  # добавленные тикеры, по которым еще не загружена история хранимых баров
+
+        self.reset()
+        self._read()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(tickers={len(self.tickers)}, bars={len(self.bars)}, ' \
+               f'last_time={self.last_time})'
+
+    def reset(self) -> None:
+        """
+        Очищает накопленные суммы и бары.
+        """
+        n = len(self.tickers)
+
+        self.bars: deque[tuple[int, np.ndarray]] = deque()  # (время бара в секундах от эпохи, значения)
+        self.shift = np.full(n, np.nan)  # первое значение каждой бумаги
+        self.count = np.zeros((n, n))  # количество баров, где есть значения обеих бумаг
+        self.sums = np.zeros((n, n))  # sums[i, j] - сумма значений i по барам, где есть значения i и j
+        self.products = np.zeros((n, n))  # сумма произведений
+        self.last_time: int | None = None
+        self._evicted = 0
+
+    def add_tickers(self, tickers: list[str]) -> None:
+        """
+        Добавляет бумаги, которых еще нет. По хранимым барам у новых бумаг значений нет, их история за период
+        догружается при следующем :meth:`refresh`.
+
+        .. code-block:: python
+
+            >>> covariance = RollingCovariance(['A'])
+            >>> covariance.update_many(pd.DataFrame({'A': [1., 2.]}, index=pd.date_range('2022-10-03', periods=2)))
+            >>> covariance.add_tickers(['A', 'B'])
+            >>> covariance.tickers, covariance.count.tolist()
+            (['A', 'B'], [[2.0, 0.0], [0.0, 0.0]])
+
+        :param tickers: тикеры бумаг
+        """
+        new = [ticker for ticker in dict.fromkeys(tickers) if ticker not in self._positions]
+        if not new:
+            return
+
+        k = len(new)
+        self.tickers += new
+        self._positions = {ticker: position for position, ticker in enumerate(self.tickers)}
+        self.bars = deque((time, np.append(values, np.full(k, np.nan))) for time, values in self.bars)
+        self.shift = np.append(self.shift, np.full(k, np.nan))
+        self.count, self.sums, self.products = (np.pad(matrix, ((0, k), (0, k)))
+                                                for matrix in (self.count, self.sums, self.products))
+
+        if self.bars:
+            self._pending.update(new)
+
+    def update(self, time: str | pd.Timestamp | int, values: np.ndarray | list[float]) -> None:
+        """
+        Добавляет бар и вычитает бары старше периода. Бары не позже последнего добавленного пропускаются.
+
+        :param time: время бара (дата-время или секунды от эпохи);
+        :param values: значения бумаг в порядке tickers, nan - значения нет;
+        """
+        time = int(time) if isinstance(time, (int, np.integer)) else to_epoch(time)
+        if self.last_time is not None and time <= self.last_time:
+            return
+
+        values = np.asarray(values, dtype=float)
+        new = np.isnan(self.shift) & ~np.isnan(values)
+        self.shift[new] = values[new]
+
+        centered = values - self.shift
+        self.bars.append((time, centered))
+        self._add(centered, 1)
+        self.last_time = time
+
+        self.evict(time - self.horizon.value // 10 ** 9 if self.horizon is not None else None)
+
+    def update_many(self, values: pd.DataFrame) -> None:
+        """
+        Добавляет бары по порядку.
+
+        :param values: датафрейм с временем баров в индексе, колонки - тикеры (лишние колонки не учитываются,
+                       недостающие - nan)
+        """
+        values = values.reindex(columns=self.tickers).sort_index()
+
+        for time, row in zip(values.index, values.to_numpy(dtype=float)):
+            self.update(time, row)
+
+    def evict(self, before: int | None) -> None:
+        """
+        Вычитает бары, которые начались раньше указанного времени.
+
+        :param before: время в секундах от эпохи. None - ничего не вычитать
+        """
+        if before is None:
+            return
+
+        while self.bars and self.bars[0][0] < before:
+            self._add(self.bars.popleft()[1], -1)
+            self._evicted += 1
+
+        if self.bars and self._evicted >= len(self.bars):
+            self._recompute()
+
+    def mean(self) -> pd.Series:
+        """
+        :return: средние значения бумаг за период
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums.diagonal() / self.count.diagonal() + self.shift
+
+        return pd.Series(mean, index=self.tickers)
+
+    def covariance(self, ddof: int = 1) -> pd.DataFrame:
+        """
+        :param ddof: поправка на степени свободы, как в pandas;
+        :return: матрица ковариаций за период
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = (self.products - self.sums * self.sums.T / self.count) / (self.count - ddof)
+
+        covariance[self.count <= ddof] = np.nan
+
+        return pd.DataFrame(covariance, index=self.tickers, columns=self.tickers)
+
+    def variance(self, ddof: int = 1) -> pd.Series:
+        """
+        :param ddof: поправка на степени свободы, как в pandas;
+        :return: дисперсии бумаг за период
+        """
+        n = self.count.diagonal()
+        s = self.sums.diagonal()
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(n > ddof, (self.products.diagonal() - s * s / n) / (n - ddof), np.nan)
+
+        return pd.Series(variance, index=self.tickers)
+
+    def inverse_variance_weights(self, tickers: list[str] = None) -> np.ndarray:
+        """
+        Веса, обратные дисперсии нормированного ряда (ряд, деленный на свое среднее за период), как в
+        Portfolio.calc_shares.
+
+        :param tickers: тикеры, для которых нужны веса. По умолчанию все тикеры;
+        :return: вектор весов с суммой 1
+        """
+        rows = slice(None) if tickers is None else [self._positions[ticker] for ticker in tickers]
+        n = self.count.diagonal()[rows]
+        s = self.sums.diagonal()[rows]
+
+        # считаем на numpy без pandas, чтобы веса можно было пересчитывать на каждом шаге
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = s / n + self.shift[rows]
+            variance = (self.products.diagonal()[rows] - s * s / n) / (n - 1)
+            shares = mean ** 2 / variance
+
+        return shares / shares.sum()
+
+    async def refresh(self, data_source: BaseDataSource, now: str | pd.Timestamp) -> None:
+        """
+        Догружает дневные цены закрытия после последнего добавленного бара (или за весь период, если баров нет)
+        одним запросом по всем тикерам и добавляет их. Загружаются только завершенные дни - по вчерашний день
+        включительно: свеча текущего дня еще не закрыта, а добавленный бар больше не обновляется. Для бумаг из
+        :meth:`add_tickers` сначала догружается история хранимых баров.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> from src.parse_securities.data_sources import MemoryDataSource
+            >>> source = MemoryDataSource({('SBER', '1d'): pd.DataFrame({
+            ...     'close': [130., 131., 129.], 'begin': ['2022-10-03', '2022-10-04', '2022-10-05']})})
+            >>> covariance = RollingCovariance(['SBER'])
+            >>> asyncio.run(covariance.refresh(source, '2022-10-05 11:00:00'))
+            >>> covariance.mean().round(2).tolist()  # свеча 2022-10-05 еще не закрыта
+            [130.5]
+
+        :param data_source: источник рыночных данных;
+        :param now: текущее время, по которое нужны бары
+        """
+        now = pd.Timestamp(now)
+        last_session = now.normalize() - pd.Timedelta(days=1)
+        if self._pending and self.bars:
+            closes = await self._load_closes(data_source, sorted(self._pending),
+                                             pd.Timestamp(self.bars[0][0], unit='s'),
+                                             pd.Timestamp(self.last_time, unit='s'))
+            if closes is not None:
+                self._merge(closes)
+        self._pending.clear()
+
+        if self.last_time is not None:
+            start = pd.Timestamp(self.last_time, unit='s') + pd.Timedelta(days=1)
+        elif self.horizon is not None:
+            start = now - self.horizon
+        else:
+            raise ValueError('Для пустой истории без периода непонятно, с какой даты загружать цены')
+
+        if start.normalize() <= last_session:
+            closes = await self._load_closes(data_source, self.tickers, start, last_session)
+            if closes is not None:
+                self.update_many(closes)
+
+        self.evict(to_epoch(now.normalize() - self.horizon) if self.horizon is not None else None)
+
+    def get_state(self) -> dict:
+        """
+        :return: тикеры, период и хранимые бары, которые можно сохранить в json. Накопленные суммы при
+                 восстановлении пересчитываются по барам
+        """
+        return {
+            'tickers': self.tickers,
+            'horizon': self.horizon.value // 10 ** 9 if self.horizon is not None else None,
+            'bars': [[time, (values + self.shift).tolist()] for time, values in self.bars],
+        }
+
+    def set_state(self, state: dict) -> None:
+        """
+        :param state: состояние из get_state с теми же тикерами
+        """
+        self.reset()
+
+        for time, values in state['bars']:
+            self.update(time, values)
+
+    def save(self) -> None:
+        """
+        Сохраняет состояние на диск, если указан путь.
+        """
+        if self.path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(self.get_state(), file)
+
+    def _read(self) -> bool:
+        """
+        Читает состояние с диска, если оно там есть и посчитано для тех же тикеров и периода.
+
+        :return: удалось ли прочитать состояние
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        with open(self.path, encoding='utf-8') as file:
+            state = json.load(file)
+
+        horizon = self.horizon.value // 10 ** 9 if self.horizon is not None else None
+        if state['horizon'] != horizon:
+            return False
+
+        tickers = self.tickers
+        self.tickers = list(state['tickers'])
+        self._positions = {ticker: position for position, ticker in enumerate(self.tickers)}
+        self.set_state(state)
+        self.add_tickers(tickers)
+        return True
+
+    @staticmethod
+    async def _load_closes(data_source: BaseDataSource,
+                           tickers: list[str],
+                           start: pd.Timestamp,
+                           end: pd.Timestamp) -> pd.DataFrame | None:
+        """
+        Загружает дневные цены закрытия бумаг одним запросом.
+
+        :param data_source: источник рыночных данных;
+        :param tickers: тикеры бумаг;
+        :param start: первый день;
+        :param end: последний день;
+        :return: датафрейм с временем баров в индексе и тикерами в колонках или None, если цен нет
+        """
+        history = await data_source.get_history(DataRequest(
+            tickers=tickers,
+            dt_start=start.strftime('%Y-%m-%d'),
+            dt_end=end.strftime('%Y-%m-%d'),
+            dt_frequency='1d'
+        ))
+
+        closes = [response['data'].set_index('begin')['close'].rename(ticker)
+                  for ticker, response in history.items() if response['ok'] and not response['data'].empty]
+        return pd.concat(closes, axis=1) if closes else None
+
+    def _merge(self, values: pd.DataFrame) -> None:
+        """
+        Дописывает значения бумаг в хранимые бары (бары, которых нет, добавляются) и пересчитывает суммы. Бары
+        позже последнего добавленного пропускаются - их добавит обычное обновление.
+
+        :param values: датафрейм с временем баров в индексе, колонки - тикеры
+        """
+        bars = {time: bar + self.shift for time, bar in self.bars}
+        values = values.reindex(columns=self.tickers)
+
+        for time, row in zip(values.index, values.to_numpy(dtype=float)):
+            time = int(time) if isinstance(time, (int, np.integer)) else to_epoch(time)
+            if time > self.last_time:
+                continue
+
+            bar = bars.setdefault(time, np.full(len(self.tickers), np.nan))
+            known = ~np.isnan(row)
+            bar[known] = row[known]
+
+        last_time = self.last_time
+        self.reset()
+        for time in sorted(bars):
+            self.update(time, bars[time])
+
+        self.last_time = last_time
+
+    def _add(self, values: np.ndarray, sign: int) -> None:
+        """
+        Добавляет (sign = 1) или вычитает (sign = -1) бар из накопленных сумм.
+        """
+        mask = ~np.isnan(values)
+        values = np.where(mask, values, 0.)
+
+        self.count += sign * np.outer(mask, mask)
+        self.sums += sign * np.outer(values, mask)
+        self.products += sign * np.outer(values, values)
+
+    def _recompute(self) -> None:
+        """
+        Пересчитывает накопленные суммы по хранимым барам со сдвигом на первые значения периода.
+        """
+        times = [time for time, _ in self.bars]
+        values = np.array([bar for _, bar in self.bars]) + self.shift
+        last_time = self.last_time
+
+        self.reset()
+        for time, row in zip(times, values):
+            self.update(time, row)
+
+        self.last_time = last_time
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,364 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+from src.parse_securities.candles import epoch_seconds
+from src.parse_securities.data_sources import BaseDataSource
+from src.structures.st_securities import MAX_LEVERAGE
+from src.structures.st_strategies import DataRequest
+
+MIN_VARIANCE = 'min_variance'
+RISK_PARITY = 'risk_parity'
+MEAN_VARIANCE = 'mean_variance'
+METHODS = (MIN_VARIANCE, RISK_PARITY, MEAN_VARIANCE)
+
+MAX_ITERATIONS = 5000  # ограничение на количество итераций решателей
+TOLERANCE = 1e-10  # решатель останавливается, когда веса за итерацию меняются меньше, чем на эту величину
+
+
+class ReturnsMatrix:
+
+    def __init__(self, returns: pd.DataFrame):
+        """
+        Матрица доходностей бумаг (бары x тикеры) и посчитанные по ней один раз средние и ковариации. Ковариация
+        считается матричными произведениями с попарным исключением пропусков, как ``pd.DataFrame.cov()``.
+        Матрицу можно сохранить на диск через :meth:`save` и прочитать через :meth:`read`, чтобы не загружать
+        историю заново.
+
+        .. code-block:: python
+
+            >>> prices = pd.DataFrame({'A': [10., 11., 12., 11.5, 13.], 'B': [100., 99., np.nan, 101., 104.]})
+            >>> returns = ReturnsMatrix.from_prices(prices)
+            >>> np.allclose(returns.covariance(), prices.pct_change(fill_method=None).cov())
+            True
+
+        :param returns: датафрейм доходностей, колонки - тикеры, nan - доходности нет
+        """
+        self.returns = returns.astype(float)
+        self.tickers = list(returns.columns)
+
+        self._mean: np.ndarray | None = None
+        self._covariance: np.ndarray | None = None
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(bars={len(self.returns)}, tickers={len(self.tickers)})'
+
+    @classmethod
+    def from_prices(cls, prices: pd.DataFrame) -> ReturnsMatrix:
+        """
+        :param prices: датафрейм цен закрытия, колонки - тикеры;
+        :return: матрица доходностей от бара к бару
+        """
+        return cls(prices.sort_index().pct_change(fill_method=None).iloc[1:])
+
+    @classmethod
+    async def load(cls,
+                   tickers: list[str],
+                   data_source: BaseDataSource,
+                   dt_start: str | pd.Timestamp,
+                   dt_end: str | pd.Timestamp) -> ReturnsMatrix:
+        """
+        Загружает дневные цены закрытия всех тикеров одним запросом и считает доходности. Цены выравниваются по
+        времени свечи.
+
+        .. code-block:: python
+
+            >>> import asyncio
+            >>> from src.parse_securities.data_sources import MemoryDataSource
+            >>> source = MemoryDataSource({('SBER', '1d'): pd.DataFrame({
+            ...     'close': [130., 131., 129.], 'begin': ['2022-10-03', '2022-10-04', '2022-10-05']})})
+            >>> returns = asyncio.run(ReturnsMatrix.load(['SBER', 'UNKNOWN'], source, '2022-10-01', '2022-10-06'))
+            >>> returns.tickers, int(returns.returns['UNKNOWN'].isna().sum())
+            (['SBER', 'UNKNOWN'], 2)
+
+        :param tickers: тикеры бумаг;
+        :param data_source: источник рыночных данных;
+        :param dt_start: начало периода;
+        :param dt_end: конец периода;
+        :return: матрица доходностей. У тикеров без данных доходности - nan, их вес в решателях - 0
+        """
+        history = await data_source.get_history(DataRequest(tickers, dt_start, dt_end, '1d'))
+
+        # тикеры без данных (ошибка или пустой ответ) остаются в матрице колонками из nan
+        closes = [history[ticker]['data'].set_index('begin')['close'].rename(ticker) for ticker in tickers
+                  if history[ticker]['ok'] and not history[ticker]['data'].empty]
+        prices = pd.concat(closes, axis=1) if closes else pd.DataFrame(dtype=float)
+
+        return cls.from_prices(prices.reindex(columns=tickers))
+
+    def save(self, path: str) -> None:
+        """
+        Сохраняет матрицу в файл ``.npz``.
+
+        :param path: путь к файлу
+        """
+        index = self.returns.index
+        index = epoch_seconds(index) if isinstance(index, pd.DatetimeIndex) else index.to_numpy()
+        np.savez(path, values=self.returns.to_numpy(), index=index, tickers=np.array(self.tickers))
+
+    @classmethod
+    def read(cls, path: str) -> ReturnsMatrix:
+        """
+        :param path: путь к файлу из save;
+        :return: матрица доходностей
+        """
+        with np.load(path) as dump:
+            return cls(pd.DataFrame(dump['values'], index=dump['index'], columns=dump['tickers'].tolist()))
+
+    def mean(self) -> np.ndarray:
+        """
+        :return: средние доходности бумаг
+        """
+        if self._mean is None:
+            with np.errstate(invalid='ignore'):
+                self._mean = np.nanmean(self.returns.to_numpy(), axis=0)
+
+        return self._mean
+
+    def covariance(self) -> np.ndarray:
+        """
+        :return: матрица ковариаций доходностей (ddof=1), nan - у пары бумаг меньше двух общих баров
+        """
+        if self._covariance is None:
+            values = self.returns.to_numpy()
+            mask = (~np.isnan(values)).astype(float)
+            values = np.nan_to_num(values)
+
+            count = mask.T @ mask  # количество баров, где есть доходности обеих бумаг
+            sums = values.T @ mask  # sums[i, j] - сумма доходностей i по барам, где есть доходности i и j
+            products = values.T @ values
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                covariance = (products - sums * sums.T / count) / (count - 1)
+
+            covariance[count <= 1] = np.nan
+            self._covariance = covariance
+
+        return self._covariance
+
+
+def project_weights(weights: np.ndarray) -> np.ndarray:
+    """
+    Ближайший (в евклидовой норме) вектор неотрицательных весов с суммой 1 (проекция на симплекс). Решение имеет
+    вид w = (v - t)+, где порог t находится сортировкой.
+
+    .. code-block:: python
+
+        >>> project_weights(np.array([0.5, 0.8, -0.2]))
+        array([0.35, 0.65, 0.  ])
+
+    :param weights: вектор весов;
+    :return: вектор весов
+    """
+    weights = np.asarray(weights, dtype=float)
+
+    return np.maximum(weights - _threshold(weights, 1.), 0.)
+
+
+def to_allocations(weights: np.ndarray, max_leverage: float = MAX_LEVERAGE) -> np.ndarray:
+    """
+    Доли капитала, которые нужно выделить бумагам через ``Portfolio(weights=...)``, чтобы позиции из весов
+    оптимизатора можно было открыть: длинной позиции нужна доля w, а короткая в Portfolio ограничена долей бумаги,
+    умноженной на плечо, поэтому ей нужна доля -w / max_leverage. Если сумма долей меньше 1, то Portfolio
+    нормирует их к 1, и все позиции получают пропорционально больше капитала.
+
+    .. code-block:: python
+
+        >>> to_allocations(np.array([0.7, -0.225]))
+        array([0.7, 0.3])
+
+    :param weights: веса позиций (доли капитала, короткие - отрицательные);
+    :param max_leverage: плечо портфеля;
+    :return: доли капитала бумаг
+    """
+    weights = np.asarray(weights, dtype=float)
+
+    return np.where(weights >= 0, weights, -weights / max_leverage)
+
+
+def mean_variance_weights(mean: np.ndarray,
+                          covariance: np.ndarray,
+                          risk_aversion: float = 1.,
+                          long_only: bool = True,
+                          max_leverage: float = MAX_LEVERAGE) -> np.ndarray:
+    """
+    Веса, которые максимизируют mean @ w - risk_aversion / 2 * w @ covariance @ w, при ограничениях Portfolio:
+    капитал делится между бумагами целиком, длинная позиция не больше доли бумаги, а короткая - не больше доли
+    бумаги, умноженной на max_leverage. Доли под длинные (p) и короткие (q) позиции лежат на одном симплексе, а вес
+    бумаги w = p - max_leverage * q, поэтому задача выпуклая и решается ускоренным проекционным градиентным спуском
+    (FISTA): на каждой итерации одно умножение матрицы на вектор и проекция :func:`project_weights`. Если у бумаги
+    заняты обе доли, то их разница не используется и остается свободным капиталом. Доли для Portfolio -
+    :func:`to_allocations`.
+
+    .. code-block:: python
+
+        >>> covariance = np.array([[0.04, 0.], [0., 0.01]])
+        >>> mean_variance_weights(np.array([0.1, 0.02]), covariance, risk_aversion=10).round(4)
+        array([0.36, 0.64])
+        >>> weights = mean_variance_weights(np.array([0.1, -0.05]), covariance, risk_aversion=10, long_only=False)
+        >>> weights.round(4), float(to_allocations(weights).sum().round(4))  # остаток капитала свободен
+        (array([ 0.25, -0.5 ]), 0.9167)
+
+    :param mean: ожидаемые доходности бумаг;
+    :param covariance: матрица ковариаций доходностей;
+    :param risk_aversion: коэффициент неприятия риска;
+    :param long_only: только длинные позиции;
+    :param max_leverage: плечо портфеля, если разрешены короткие позиции, как в Portfolio;
+    :return: вектор весов: доли капитала, короткие позиции - отрицательные
+    """
+    mean, covariance, valid = _prepare(mean, covariance)
+    n = len(mean)
+
+    # веса через доли капитала: w = exposure @ [p, q]
+    exposure = np.eye(n) if long_only else np.hstack([np.eye(n), -max_leverage * np.eye(n)])
+    hessian = exposure.T @ (risk_aversion * covariance) @ exposure
+    gradient_mean = exposure.T @ mean
+    step = 1 / max(np.linalg.eigvalsh(hessian)[-1], 1e-12)
+
+    shares = project_weights(np.r_[np.full(n, 1 / n), np.zeros(exposure.shape[1] - n)])
+    point, momentum = shares, 1.
+
+    for _ in range(MAX_ITERATIONS):
+        new_shares = project_weights(point - step * (hessian @ point - gradient_mean))
+
+        new_momentum = (1 + np.sqrt(1 + 4 * momentum ** 2)) / 2
+        point = new_shares + (momentum - 1) / new_momentum * (new_shares - shares)
+
+        converged = np.abs(new_shares - shares).max() < TOLERANCE
+        shares, momentum = new_shares, new_momentum
+        if converged:
+            break
+
+    return _expand(exposure @ shares, valid)
+
+
+def min_variance_weights(covariance: np.ndarray) -> np.ndarray:
+    """
+    Веса портфеля минимальной дисперсии, позиции только длинные. Короткие позиции здесь не помогают: в Portfolio у
+    бумаги не может быть длинной и короткой позиции сразу, и с ними минимум дисперсии - держать весь капитал
+    свободным.
+
+    .. code-block:: python
+
+        >>> min_variance_weights(np.array([[0.04, 0.], [0., 0.01]]))
+        array([0.2, 0.8])
+
+    :param covariance: матрица ковариаций доходностей;
+    :return: вектор весов
+    """
+    covariance = np.asarray(covariance, dtype=float)
+
+    return mean_variance_weights(np.zeros(len(covariance)), covariance)
+
+
+def risk_parity_weights(covariance: np.ndarray, budgets: np.ndarray = None) -> np.ndarray:
+    """
+    Веса, при которых вклад каждой бумаги в риск портфеля w_i * (covariance @ w)_i пропорционален ее бюджету риска.
+    Решается методом Ньютона для выпуклой задачи min y @ covariance @ y / 2 - budgets @ log(y), y > 0, веса -
+    y / sum(y). Позиции только длинные.
+
+    .. code-block:: python
+
+        >>> risk_parity_weights(np.array([[0.04, 0.], [0., 0.01]]))
+        array([0.33333333, 0.66666667])
+
+    :param covariance: матрица ковариаций доходностей;
+    :param budgets: бюджеты риска бумаг. По умолчанию равные;
+    :return: вектор весов
+    """
+    _, covariance, valid = _prepare(np.zeros(len(covariance)), covariance)
+    n = len(covariance)
+    budgets = np.full(n, 1 / n) if budgets is None else np.asarray(budgets, dtype=float)[valid] / \
+        np.sum(np.asarray(budgets, dtype=float)[valid])
+
+    y = budgets / np.sqrt(np.diag(covariance))
+
+    for _ in range(MAX_ITERATIONS):
+        gradient = covariance @ y - budgets / y
+        hessian = covariance + np.diag(budgets / y ** 2)
+        direction = np.linalg.solve(hessian, gradient)
+
+        # шаг уменьшается, пока y не останется положительным
+        step = 1.
+        while np.any(y - step * direction <= 0):
+            step /= 2
+
+        new_y = y - step * direction
+        converged = np.abs(new_y - y).max() < TOLERANCE * y.max()
+        y = new_y
+        if converged:
+            break
+
+    return _expand(y / y.sum(), valid)
+
+
+def optimize_weights(returns: ReturnsMatrix, method: str = MIN_VARIANCE, **kwargs) -> np.ndarray:
+    """
+    Веса портфеля по матрице доходностей. Веса с только длинными позициями можно сразу передать в
+    ``Portfolio(weights=...)``, а веса с короткими позициями переводятся в доли капитала Portfolio через
+    :func:`to_allocations`.
+
+    .. code-block:: python
+
+        >>> prices = pd.DataFrame({'A': [10., 11., 10.5, 11.5, 12.], 'B': [100., 100.5, 100.2, 101., 101.3]})
+        >>> optimize_weights(ReturnsMatrix.from_prices(prices), RISK_PARITY).round(4)
+        array([0.0642, 0.9358])
+
+    :param returns: матрица доходностей;
+    :param method: MIN_VARIANCE, RISK_PARITY или MEAN_VARIANCE;
+    :param kwargs: параметры min_variance_weights, risk_parity_weights или mean_variance_weights;
+    :return: вектор весов в порядке returns.tickers
+    """
+    if method == MIN_VARIANCE:
+        return min_variance_weights(returns.covariance(), **kwargs)
+    if method == RISK_PARITY:
+        return risk_parity_weights(returns.covariance(), **kwargs)
+    if method == MEAN_VARIANCE:
+        return mean_variance_weights(returns.mean(), returns.covariance(), **kwargs)
+
+    raise ValueError(f'Метод {method} не поддерживается, доступны {METHODS}')
+
+
+def _threshold(weights: np.ndarray, total: float) -> float:
+    """
+    :return: порог t, при котором sum(max(weights - t, 0)) = total
+    """
+    ordered = np.sort(weights)[::-1]
+    cumulative = np.cumsum(ordered) - total
+    rho = np.nonzero(ordered * np.arange(1, len(ordered) + 1) > cumulative)[0][-1]
+
+    return cumulative[rho] / (rho + 1)
+
+
+def _prepare(mean: np.ndarray, covariance: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Убирает бумаги без дисперсии (нет доходностей) и заменяет на 0 ковариации пар без общих баров.
+
+    :return: средние и ковариации оставшихся бумаг, маска оставшихся бумаг
+    """
+    mean = np.asarray(mean, dtype=float)
+    covariance = np.asarray(covariance, dtype=float)
+
+    variance = np.diag(covariance)
+    valid = np.isfinite(variance) & (variance > 0) & np.isfinite(mean)
+    if not valid.any():
+        raise ValueError('Нет ни одной бумаги с посчитанной дисперсией доходностей')
+
+    return mean[valid], np.nan_to_num(covariance[np.ix_(valid, valid)]), valid
+
+
+def _expand(weights: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    :return: веса всех бумаг: у убранных в _prepare бумаг вес 0
+    """
+    result = np.zeros(len(valid))
+    result[valid] = weights
+
+    return result
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -1,19 +1,35 @@
+from __future__ import annotations
+
+import asyncio
 from collections import defaultdict
-from copy import deepcopy
 from typing import Union
 
 import numpy as np
 from pandas import Timestamp
 
+from src.parse_securities.candles import CANDLE_COLUMNS
+from src.parse_securities.data_sources import BaseDataSource, MoexDataSource, run_with_source
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+from src.parse_securities.price_oracle import PriceOracle
+from src.parse_securities.quotes import QuoteSnapshot
+from src.structures.st_clock import DATETIME_FORMAT, Clock, SystemClock, VirtualClock
+from src.structures.st_covariance import RollingCovariance, covariance_path
+from src.structures.st_triggers import TIE_STOP, detect_triggers, stack_bars
 from src.strategies.strategy_macd import get_decision_macd_conservative_strategy
 from src.structures.st_purchase import *
 from src.structures.st_securities import *
 from src.structures.st_strategies import *
 
 MOEX_RUSSIA_INDEX_TICKERS = ['GAZP', 'GLTR', 'MAGN', 'MGTS', 'SBER', 'TATN', ]
+RECONCILE_EVERY = 1000  # через сколько обновлений позиций накопленные суммы сверяются с полным пересчетом
+RECONCILE_TOLERANCE = 1e-6  # допустимое относительное расхождение накопленных сумм с полным пересчетом
+SIMULATION_START = '2022-09-15 11:00:00'  # с какого времени идет пошаговая симуляция бота
 
 
 class Securities(defaultdict):
+    """
+    Портфель бумаг: тикер -> SecurityState.
+    """
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.get_json()})'
@@ -23,53 +39,297 @@ class Securities(defaultdict):
 
 
 class PortfolioHistory:
-    def __init__(self):
+    STATE_FIELDS = ('quantity', 'price', 'sl', 'tp')  # состояние бумаги после изменения
+    FIELDS = (*STATE_FIELDS, 'received_quantity', 'received_price',
+              'current_quantity', 'current_price', 'current_sl', 'current_tp')  # колонки по каждой бумаге
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        """
+        Колоночная история портфеля. Каждое изменение портфеля - строка в заранее выделенных буферах NumPy: время,
+        полный баланс и по каждой бумаге количество, цена, стоп-лосс и тейк-профит после изменения, количество и
+        цена полученных в этом изменении бумаг, а также состояние до изменения (колонки current_*). Позиции
+        меняются только через записи истории, поэтому состояние до изменения копируется из предыдущей строки.
+        Буферы растут удвоением, поэтому запись стоит O(количество бумаг).
+
+        .. code-block:: python
+
+            >>> history = PortfolioHistory()
+            >>> new = Securities(SecurityState, {'SBER': SecurityState(10, 130.)})
+            >>> history.log_history(100_000., '2022-09-16 11:00:00', Securities(), new)
+            >>> new['SBER'].update_state(0, 0)
+            >>> received = Securities(SecurityState, {'SBER': SecurityState(-10, 132.)})
+            >>> history.log_history(100_020., '2022-09-19 11:00:00', received, new)
+            >>> len(history), history.between('2022-09-17', '2022-09-30').balance
+            (2, array([100020.]))
+            >>> history.to_frame()[['dt', 'ticker', 'current_quantity', 'received_quantity', 'quantity']]
+                               dt ticker  current_quantity  received_quantity  quantity
+            0 2022-09-16 11:00:00   SBER               NaN                NaN      10.0
+            1 2022-09-19 11:00:00   SBER              10.0              -10.0       0.0
+
+        :param capacity: начальный размер буферов
+        """
+        self.tickers: dict[str, int] = {}  # тикер -> номер колонки в буферах бумаг
+        self._size = 0
+        self._dt = np.empty(capacity, dtype='datetime64[s]')
+        self._balance = np.empty(capacity, dtype=np.float64)
+        self._columns = {field: np.full((capacity, 0), np.nan) for field in self.FIELDS}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(rows={self._size}, tickers={list(self.tickers)})'
+
+    @property
+    def dt(self) -> np.ndarray:
+        return self._dt[:self._size]
+
+    @property
+    def balance(self) -> np.ndarray:
+        return self._balance[:self._size]
+
+    def column(self, field: str) -> np.ndarray:
         """
-        Конструктор класса, отвечающего за историю по портфелю
+        :param field: одна из колонок FIELDS;
+        :return: матрица (строки истории x тикеры) без копирования, порядок тикеров - self.tickers
         """
-        self.__history: dict[  # словарь с ключом - номером изменения и данными: дата и время, размер портфеля и состав
-            int, dict[
-                str,
-                Timestamp,
-                float,
-                dict[str, SecurityState],
-                dict[str, SecurityState],
-                dict[str, SecurityState]
-            ]
-        ] = dict()
-        self.__counter = 0
+        return self._columns[field][:self._size, :len(self.tickers)]
 
     def log_history(self,
                     balance: [float, int],
                     timestamp: str,
-                    current_structure: Securities,
                     received_structure: Securities,
                     new_structure: Securities
                     ):
         """
-        Логирование состояния портфеля
+        Логирование состояния портфеля. Текущее состояние портфеля (до изменения) берется из предыдущей строки.
 
         :param balance: новый баланс портфеля
-        :param timestamp: дата и    время изменения
-        :param current_structure: текущее состояние портфеля
+        :param timestamp: дата и время изменения
         :param received_structure: полученное состояние портфеля
         :param new_structure: обновленное состояние портфеля
         :return: только обновляет историю
         """
-        self.__counter += 1
-        self.__history[self.__counter] = {
-            'dt': timestamp,
-            'balance': balance,
-            'current_structure': current_structure.__repr__(),
-            'received_structure': received_structure.__repr__(),
-            'new_structure': new_structure.__repr__(),
-        }
+        for ticker in new_structure.keys() | received_structure.keys():
+            if ticker not in self.tickers:
+                self._add_ticker(ticker)
+
+        if self._size == len(self._dt):
+            self._grow_rows()
+
+        row = self._size
+        self._dt[row] = np.datetime64(timestamp, 's')
+        self._balance[row] = balance
+
+        if row > 0:
+            for field in self.STATE_FIELDS:
+                self._columns[f'current_{field}'][row] = self._columns[field][row - 1]
+
+        for ticker, state in new_structure.items():
+            column = self.tickers[ticker]
+            self._columns['quantity'][row, column] = _to_float(state.quantity)
+            self._columns['price'][row, column] = _to_float(state.price)
+            self._columns['sl'][row, column] = _to_float(state.stop_loss)
+            self._columns['tp'][row, column] = _to_float(state.take_profit)
+
+        for ticker, state in received_structure.items():
+            column = self.tickers[ticker]
+            self._columns['received_quantity'][row, column] = _to_float(state.quantity)
+            self._columns['received_price'][row, column] = _to_float(state.price)
+
+        self._size += 1
+
+    def between(self, start: str | pd.Timestamp = None, end: str | pd.Timestamp = None) -> PortfolioHistory:
+        """
+        История за период [start, end] без копирования буферов - только для чтения. Время в истории должно
+        не убывать, как в симуляции.
+
+        :param start: начало периода. None - с начала истории;
+        :param end: конец периода. None - до конца истории;
+        :return: история за период, буферы которой являются срезами буферов этой истории
+        """
+        dt = self.dt
+        lo = 0 if start is None else int(np.searchsorted(dt, np.datetime64(pd.Timestamp(start), 's'), 'left'))
+        hi = len(dt) if end is None else int(np.searchsorted(dt, np.datetime64(pd.Timestamp(end), 's'), 'right'))
+
+        view = self.__class__.__new__(self.__class__)
+        view.tickers = dict(self.tickers)
+        view._size = hi - lo
+        view._dt = _readonly(self._dt[lo:hi])
+        view._balance = _readonly(self._balance[lo:hi])
+        view._columns = {field: _readonly(values[lo:hi, :len(self.tickers)]) for field, values in self._columns.items()}
+
+        return view
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: история в длинном формате: строка на каждое изменение и бумагу - dt, balance, ticker и колонки FIELDS
+        """
+        rows, tickers = self._size, list(self.tickers)
+
+        return pd.DataFrame({
+            'dt': np.repeat(self.dt, len(tickers)),
+            'balance': np.repeat(self.balance, len(tickers)),
+            'ticker': np.tile(np.array(tickers, dtype=object), rows),
+            **{field: self.column(field).reshape(-1) for field in self.FIELDS},
+        })
+
+    def to_arrow(self):
+        """
+        :return: история в формате pyarrow.Table (нужен пакет pyarrow)
+        """
+        import pyarrow
+
+        return pyarrow.Table.from_pandas(self.to_frame(), preserve_index=False)
+
+    def to_parquet(self, path: str) -> None:
+        """
+        Сохраняет историю в parquet файл (нужен пакет pyarrow или fastparquet).
+
+        :param path: путь к файлу
+        """
+        self.to_frame().to_parquet(path, index=False)
+
+    def get_history(self) -> str:
+        """
+        :return: история в формате json (список записей to_frame)
+        """
+        return self.to_frame().to_json(orient='records', date_format='iso')
+
+    def _add_ticker(self, ticker: str) -> None:
+        column = len(self.tickers)
+        self.tickers[ticker] = column
+
+        capacity = self._columns['quantity'].shape[1]
+        if column == capacity:
+            for field, values in self._columns.items():
+                grown = np.full((values.shape[0], max(1, 2 * capacity)), np.nan)
+                grown[:, :capacity] = values
+                self._columns[field] = grown
+
+    def _grow_rows(self) -> None:
+        capacity = max(1, 2 * len(self._dt))
+
+        dt = np.empty(capacity, dtype='datetime64[s]')
+        dt[:self._size] = self._dt[:self._size]
+        self._dt = dt
+
+        balance = np.empty(capacity, dtype=np.float64)
+        balance[:self._size] = self._balance[:self._size]
+        self._balance = balance
+
+        for field, values in self._columns.items():
+            grown = np.full((capacity, values.shape[1]), np.nan)
+            grown[:self._size] = values[:self._size]
+            self._columns[field] = grown
+
+
+def _to_float(value: float | None) -> float:
+    return np.nan if value is None else float(value)
+
+
+def _readonly(values: np.ndarray) -> np.ndarray:
+    values = values.view()
+    values.flags.writeable = False
+    return values
+
+
+class PortfolioLedger:
+
+    def __init__(self):
+        """
+        Накопленные суммы портфеля, которые обновляются за O(1) на каждую сделку и каждую новую цену: стоимость
+        позиций по рынку, стоимость позиций по цене входа, реализованная прибыль и комиссии. Нереализованная
+        прибыль - разница стоимости по рынку и по цене входа. Накопленные суммы периодически сверяются с полным
+        пересчетом, см. :meth:`reconcile`.
+
+        .. code-block:: python
+
+            >>> ledger = PortfolioLedger()
+            >>> ledger.update_position('SBER', 10, 130., mark=130.)
+            >>> ledger.update_mark('SBER', 135.)
+            >>> ledger.positions_value, ledger.unrealised_pnl
+            (1350.0, 50.0)
+            >>> ledger.realise(4 * (136. - 130.))
+            >>> ledger.update_position('SBER', 6, 130., mark=136.)
+            >>> ledger.positions_value, ledger.unrealised_pnl, ledger.realised_pnl
+            (816.0, 36.0, 24.0)
+        """
+        self.quantities: dict[str, int] = {}
+        self.prices: dict[str, float] = {}  # цена входа в позицию
+        self.marks: dict[str, float] = {}  # цена, по которой позиция оценивается
+
+        self.positions_value = 0.  # сумма quantity * mark
+        self.cost_value = 0.  # сумма quantity * price
+        self.realised_pnl = 0.
+        self.fees = 0.
+        self.updates = 0  # обновлений с последней сверки
 
     def __repr__(self) -> str:
-        return json.dumps(self.__history)
+        return f'{self.__class__.__name__}(positions_value={self.positions_value}, ' \
+               f'unrealised_pnl={self.unrealised_pnl}, realised_pnl={self.realised_pnl}, fees={self.fees})'
 
-    def get_history(self):
-        return json.dumps(self.__history)
+    @property
+    def unrealised_pnl(self) -> float:
+        return self.positions_value - self.cost_value
+
+    def update_position(self, ticker: str, quantity: int, price: float, mark: float) -> None:
+        """
+        Учитывает новое состояние позиции после сделки.
+
+        :param ticker: тикер бумаги;
+        :param quantity: количество бумаг после сделки;
+        :param price: цена входа в позицию после сделки;
+        :param mark: цена, по которой позиция оценивается
+        """
+        quantity, price, mark = quantity or 0, price or 0, mark or 0
+
+        self.positions_value += quantity * mark - self.quantities.get(ticker, 0) * self.marks.get(ticker, 0)
+        self.cost_value += quantity * price - self.quantities.get(ticker, 0) * self.prices.get(ticker, 0)
+
+        self.quantities[ticker] = quantity
+        self.prices[ticker] = price
+        self.marks[ticker] = mark
+        self.updates += 1
+
+    def update_mark(self, ticker: str, mark: float) -> None:
+        """
+        Учитывает новую цену бумаги без сделки.
+
+        :param ticker: тикер бумаги;
+        :param mark: новая цена
+        """
+        mark = mark or 0
+
+        self.positions_value += self.quantities.get(ticker, 0) * (mark - self.marks.get(ticker, 0))
+        self.marks[ticker] = mark
+
+    def realise(self, pnl: float) -> None:
+        """
+        :param pnl: прибыль, реализованная закрытием части позиции
+        """
+        self.realised_pnl += pnl
+
+    def reconcile(self, positions: dict[str, tuple[int, float, float]]) -> float:
+        """
+        Сверяет накопленные суммы с полным пересчетом и заменяет их пересчитанными.
+
+        :param positions: словарь тикер -> (количество, цена входа, цена оценки) по всем позициям портфеля;
+        :return: расхождение стоимости позиций по рынку до сверки
+        """
+        self.quantities = {ticker: quantity or 0 for ticker, (quantity, _, _) in positions.items()}
+        self.prices = {ticker: price or 0 for ticker, (_, price, _) in positions.items()}
+        self.marks = {ticker: mark or 0 for ticker, (_, _, mark) in positions.items()}
+
+        positions_value = sum(self.quantities[ticker] * self.marks[ticker] for ticker in positions)
+        drift = self.positions_value - positions_value
+
+        self.positions_value = positions_value
+        self.cost_value = sum(self.quantities[ticker] * self.prices[ticker] for ticker in positions)
+        self.updates = 0
+
+        return drift
 
 
 class Portfolio:
@@ -79,7 +339,15 @@ class Portfolio:
                  tickers: list[str] = None,
                  weights: list[float] = None,
                  strategy: callable = None,
-                 type_process: str = 'sim'):
+                 type_process: str = 'sim',
+                 client: MoexClient = None,
+                 data_source: BaseDataSource = None,
+                 quotes: QuoteSnapshot = None,
+                 clock: Clock = None,
+                 price_oracle: PriceOracle = None,
+                 trigger_tie: str = TIE_STOP,
+                 covariance: RollingCovariance = None,
+                 verbose: bool = True):
         """
         Инициализация портфеля
 
@@ -90,23 +358,53 @@ class Portfolio:
         :param strategy: стратегия, которая будет использоваться для обновления портфеля.
         :param type_process: тип процесса, в котором работает портфель. Может быть 'sim' или 'real', соответственно
                              симуляция или реальный процесс
+        :param client: клиент MOEX ISS с общим пулом соединений. По умолчанию общий клиент процесса;
+        :param data_source: источник рыночных данных. По умолчанию MOEX ISS через client;
+        :param quotes: снимок текущих котировок. Если указан, то исполнение заявок, оценка портфеля и проверка
+                       стоп-лоссов идут по текущим ценам из одного запроса на все тикеры, а не по свечам каждого тикера;
+        :param clock: часы, из которых портфель берет текущее время. По умолчанию часы реального времени. Для
+                      симуляции передаются часы VirtualClock, которые call_strategy сдвигает на день за шаг;
+        :param price_oracle: оракул цен, через который идут расчет суммы заявки, исполнение заявок, оценка позиций
+                             и проверка стоп-лоссов, если нет снимка котировок. По умолчанию цена последней
+                             минутной свечи из data_source, которая началась не позже времени заявки, а если
+                             минутных свечей нет - закрытие последнего завершенного дня;
+        :param trigger_tie: какой уровень считать сработавшим первым, если за один бар задеты и стоп-лосс, и
+                            тейк-профит, см. st_triggers.detect_triggers;
+        :param covariance: скользящая ковариация цен закрытия, по которой считаются веса, если они не указаны. Если
+                           у нее указан путь, то между запусками догружаются только новые бары. По умолчанию
+                           ковариация, сохраненная рядом с кэшем свечей, см. calc_shares;
+        :param verbose: печатать ли решение стратегии по каждому тикеру на каждом шаге
         """
         if not isinstance(init_balance, Union[int, float]):
             raise ValueError('Баланс должен быть числом типа int или float')
 
         self.__free_balance = init_balance  # баланс рублей в портфеле
-        self.__max_leverage = 0.75  # максимальный уровень плеча
+        self.__max_leverage = MAX_LEVERAGE  # максимальный уровень плеча
         self.__full_balance = init_balance  # баланс с учетом ценности всех бумаг
         self.__securities = Securities(SecurityState)  # инициализируем пустой дефолтный словарь - портфель бумаг
         self.__history = PortfolioHistory()
+        self.__ledger = PortfolioLedger()  # накопленные суммы для расчета полного баланса за O(1)
+        self.__marked_at = None  # время снимка котировок или часов, на которое оценены позиции
+        self.reconcile_every = RECONCILE_EVERY
+        self.reconcile_drifts: list[tuple[str, float]] = []  # (время, расхождение) сверок выше допуска
         self.strategy = strategy
+        self.client = client if client is not None else get_moex_client()
+        self.data_source = data_source if data_source is not None else MoexDataSource(self.client)
+        self.quotes = quotes
+        self.clock = clock if clock is not None else SystemClock()
+        self.price_oracle = price_oracle if price_oracle is not None else PriceOracle(self.data_source)
+        self.trigger_tie = trigger_tie
+        self.covariance = covariance
+        self.verbose = verbose
+        self.__checked_at = self.clock.now()  # до какого времени проверены стоп-лоссы и тейк-профиты
         if tickers is None:
             self.tickers = MOEX_RUSSIA_INDEX_TICKERS
         else:
             self.tickers = tickers
 
         if weights is None:
-            self.weights = self.calc_shares(self.tickers) * self.__free_balance
+            self.weights = self.calc_shares(self.tickers, self.data_source, self.clock, self.covariance) * \
+                self.__free_balance
 
         else:
             self.weights = (np.array(weights) / np.sum(weights)) * self.__free_balance
@@ -118,35 +416,52 @@ class Portfolio:
 
         self.__type_process = type_process if type_process in ['sim', 'real'] else 'sim'
         self.rate_sim_exchange_fee = 0.00125
-        self.st_time = pd.Timestamp('2022-09-15 11:00:00')
 
         self.flg_end_process = False
 
     @staticmethod
-    def calc_shares(tickers: list[str]) -> np.ndarray:
+    def calc_shares(tickers: list[str],
+                    data_source: BaseDataSource = None,
+                    clock: Clock = None,
+                    covariance: RollingCovariance = None) -> np.ndarray:
         """
-        Расчет весов акций по ковариации
+        Расчет весов акций по ковариации: веса обратны дисперсии цены закрытия, деленной на свое среднее за 3 года.
+        Ковариация догружает только дневные бары после последнего посчитанного и сохраняется на диск, если у нее
+        указан путь, поэтому повторный расчет не скачивает всю историю. Ковариация по умолчанию хранится рядом с
+        кэшем свечей, см. st_covariance.covariance_path.
 
         :param tickers: датафрейм с ценами закрытия акций;
+        :param data_source: источник рыночных данных. По умолчанию MOEX ISS;
+        :param clock: часы, от текущего времени которых берется история за 3 года. По умолчанию реальное время;
+        :param covariance: скользящая ковариация. Недостающие tickers в нее добавляются. По умолчанию ковариация,
+                           сохраненная для data_source;
         :return: вектор весов акций
         """
-        request = DataRequest(
-            tickers=tickers,
-            dt_start=(pd.Timestamp.now() - pd.Timedelta(days=365 * 3)).strftime('%Y-%m-%d'),
-            dt_end=pd.Timestamp.now().strftime('%Y-%m-%d'),
-            dt_frequency='1d'
-        )
+        now = clock.now() if clock is not None else pd.Timestamp.now()
+        data_source = data_source if data_source is not None else MoexDataSource()
+        if covariance is None:
+            covariance = RollingCovariance(tickers, path=covariance_path(data_source))
 
-        data = asyncio.run(get_security_history_aiomoex(request))
-        df_data = []
-        for ticker, data in data.items():
-            df_data.append(data['data']['close'].rename(ticker))
+        covariance.add_tickers(tickers)
+        # calc_shares синхронный и запускает свой event loop, поэтому сессия клиента закрывается вместе с ним
+        run_with_source(data_source, covariance.refresh(data_source, now))
+        covariance.save()
+
+        return covariance.inverse_variance_weights(tickers)
+
+    @property
+    def st_time(self) -> pd.Timestamp:
+        """
+        Текущее время портфеля - время его часов.
+        """
+        return self.clock.now()
 
-        df_data = pd.concat(df_data, axis=1)
-        shares = (1 / (df_data / df_data.mean(axis=0)).cov()).values.diagonal()
-        shares = shares / shares.sum()
+    @st_time.setter
+    def st_time(self, value: pd.Timestamp) -> None:
+        if not isinstance(self.clock, VirtualClock):
+            raise ValueError('Время можно переводить только у часов симуляции VirtualClock')
 
-        return shares
+        self.clock.set(value)
 
     @property
     def type_process(self) -> str:
@@ -168,18 +483,123 @@ class Portfolio:
     def history(self) -> str:
         return self.__history.get_history()
 
+    @property
+    def history_table(self) -> PortfolioHistory:
+        return self.__history
+
+    @property
+    def ledger(self) -> PortfolioLedger:
+        return self.__ledger
+
+    @property
+    def realised_pnl(self) -> float:
+        return float(self.__ledger.realised_pnl)
+
+    @property
+    def unrealised_pnl(self) -> float:
+        return float(self.__ledger.unrealised_pnl)
+
     async def _update_full_balance(self):
         """
-        Обновляет полный баланс портфеля;
+        Обновляет полный баланс портфеля из накопленной стоимости позиций - за O(1), без обхода всех бумаг.
+        Если обновился снимок котировок или сдвинулись часы, то все позиции переоцениваются по новым ценам. Раз в
+        ``reconcile_every`` обновлений позиций накопленные суммы сверяются с полным пересчетом. Снимок котировок
+        здесь не загружается: он обновляется один раз за шаг, см. :meth:`_refresh_quotes`.
+        """
+        if self._mark_time() != self.__marked_at:
+            await self.mark_to_market()
+
+        if self.__ledger.updates >= self.reconcile_every:
+            await self.reconcile()
+
+        self.__full_balance = self.__free_balance + self.__ledger.positions_value
+
+    async def _refresh_quotes(self) -> None:
+        """
+        Обновляет снимок котировок, если он есть и устарел. Вызывается один раз в начале шага (call_strategy или
+        update_securities), поэтому все сделки и оценки шага идут по одному снимку.
+        """
+        if self.quotes is not None:
+            await self.quotes.refresh(self.client)
+
+    async def mark_to_market(self) -> None:
+        """
+        Переоценивает все позиции по текущим ценам, каждая бумага - за O(1). Цены всех позиций загружаются
+        одним запросом к оракулу цен.
         """
-        self.__full_balance = 0
+        held = [ticker for ticker, security in self.__securities.items() if security.quantity]
+
+        if self.quotes is None:
+            await self.price_oracle.prefetch(held, self.clock.now_str())
 
-        for security in self.__securities.values():
-            self.__full_balance += security.quantity * security.price
+        for ticker in held:
+            self.__ledger.update_mark(ticker, await self._mark_price(ticker))
 
-        self.__full_balance += self.__free_balance
+        self.__marked_at = self._mark_time()
+
+    def _mark_time(self):
+        """
+        :return: момент, на который берутся цены оценки: время снимка котировок, если он есть, иначе время часов
+        """
+        return self.quotes.loaded_at if self.quotes is not None else self.clock.now()
+
+    async def reconcile(self) -> float:
+        """
+        Пересчитывает стоимость позиций с нуля и сверяет ее с накопленной суммой. Расхождение выше
+        RECONCILE_TOLERANCE означает ошибку в учете сделок: оно записывается в reconcile_drifts вместе с временем
+        часов, а накопленные суммы заменяются пересчитанными.
 
-    async def update_securities(self, *args: StrategyResponse) -> None:
+        :return: расхождение накопленной стоимости позиций с пересчитанной
+        """
+        positions = {}
+        for ticker, security in self.__securities.items():
+            positions[ticker] = (security.quantity, security.price, await self._mark_price(ticker))
+
+        drift = self.__ledger.reconcile(positions)
+
+        if abs(drift) > RECONCILE_TOLERANCE * max(1., abs(self.__free_balance + self.__ledger.positions_value)):
+            self.reconcile_drifts.append((self.clock.now_str(), drift))
+
+        return drift
+
+    async def _update_security_state(self,
+                                     security: str,
+                                     new_quantity: int,
+                                     new_price: float,
+                                     sl: float = None,
+                                     tp: float = None) -> None:
+        """
+        Обновляет состояние бумаги и накопленные суммы портфеля.
+
+        :param security: имя бумаги;
+        :param new_quantity: количество бумаг после сделки;
+        :param new_price: цена позиции после сделки;
+        :param sl: стоп-лосс;
+        :param tp: тейк-профит
+        """
+        self.__securities[security].update_state(new_quantity, new_price, sl, tp)
+        self.__ledger.update_position(security, new_quantity, new_price, await self._mark_price(security))
+
+    async def _mark_price(self, ticker: str) -> float:
+        """
+        Цена для оценки позиции: последняя цена сделки из снимка котировок, если он есть, иначе цена оракула на
+        время часов. Если цены нет (например, в выходной), то последняя известная цена оценки, а если бумага еще
+        не оценивалась - цена бумаги в портфеле.
+
+        :param ticker: тикер бумаги;
+        :return: цена бумаги
+        """
+        if self.quotes is not None:
+            price = await self.quotes.price(ticker, client=self.client)
+        else:
+            price = await self.price_oracle.price(ticker, self.clock.now_str())
+
+        if price is not None:
+            return price
+
+        return self.__ledger.marks.get(ticker) or self.__securities[ticker].price
+
+    async def update_securities(self, *args: StrategyResponse, refresh_quotes: bool = True) -> None:
         """
         Обновляет бумаги в портфеле.
 
@@ -188,63 +608,119 @@ class Portfolio:
                      После обновления цена будет перевзвешена в соответствии с количеством. Если мы стоим в короткой
                      позиции, то покупка просто сократит количество бумаг, а на баланс может поступить положительная
                      разница, при ее наличии. Если в короткой позиции мы продаем бумаги, то их цена перевзвешивается;
+        :param refresh_quotes: обновить снимок котировок перед исполнением. False - шаг уже обновил его
+                               (call_strategy делает это один раз на все свои заявки);
 
         :return: обновляет внутренний портфель
         """
 
-        current_structure: Securities  # логирование в истории состояний по бумагам
         received_structure: Securities  # логирование в истории состояний по бумагам
-        new_structure: Securities  # логирование в истории состояний по бумагам
 
-        current_structure = deepcopy(self.__securities)
         received_structure = Securities()
 
         if self.__type_process == 'sim':
+            if refresh_quotes:
+                await self._refresh_quotes()
+
             for strategy_response in args:
+                # заявка без времени исполняется по часам портфеля
+                if strategy_response.dtime_now is None:
+                    strategy_response.dtime_now = self.clock.now_str()
+
+            for wave in self._execution_waves(args):
+                if self.quotes is None:
+                    # цены всех заявок волны - один запрос к оракулу на каждое время заявки
+                    dtimes: dict[str, list[str]] = {}
+                    for strategy_response in wave:
+                        dtimes.setdefault(strategy_response.dtime_now, []).append(strategy_response.ticker)
+                    await asyncio.gather(*(self.price_oracle.prefetch(tickers, dtime_now)
+                                           for dtime_now, tickers in dtimes.items()))
+
+                # суммы заявки по разным тикерам зависят только от состояния своего тикера,
+                # поэтому все заявки волны рассчитываются одновременно от состояния до волны
+                amounts = await asyncio.gather(*(self.calc_amount(strategy_response) for strategy_response in wave))
+
                 purchase_process = StockPurchaseProcessMoex(
                     purchase_requests=[
                         StockPurchaseRequest(
                             ticker=strategy_response.ticker,
                             type_action=strategy_response.type_action,
-                            amt_assets=await self.calc_amount(strategy_response),
-                            price=strategy_response.price,
+                            amt_assets=amount,
+                            price=strategy_response.price if strategy_response.at_price else None,
                             dtime_now=strategy_response.dtime_now,
                         )
-                    ]
+                        for strategy_response, amount in zip(wave, amounts)
+                    ],
+                    client=self.client,
+                    data_source=self.data_source,
+                    quotes=self.quotes,
+                    price_oracle=self.price_oracle,
+                    refresh_quotes=False  # снимок уже обновлен в начале шага
                 )
-                response = (await purchase_process())[0]  # обрабатываем покупки по одной штуке
-                received_state = deepcopy(SecurityState(
-                    quantity=response.quantity,
-                    price=response.market_price,
-                    stop_loss=strategy_response.stop_loss,
-                    take_profit=strategy_response.take_profit
-                ))
+                responses = await purchase_process()  # цены всех заявок волны загружаются за один проход
+
+                # сделки применяются в порядке заявок
+                for strategy_response, response in zip(wave, responses):
+                    received_state = SecurityState(
+                        quantity=response.quantity,
+                        price=response.market_price,
+                        stop_loss=strategy_response.stop_loss,
+                        take_profit=strategy_response.take_profit
+                    )
 
-                received_structure[strategy_response.ticker] = received_state
-                await self._update_value_securities(
-                    security=response.ticker,
-                    update_security_state=received_state,
-                    exchange_fees=received_state.security_value() * self.rate_sim_exchange_fee
-                )
+                    received_structure[strategy_response.ticker] = received_state
+                    await self._update_value_securities(
+                        security=response.ticker,
+                        update_security_state=received_state,
+                        exchange_fees=received_state.security_value() * self.rate_sim_exchange_fee
+                    )
 
         if len(args) > 0:
             dtime = args[0].dtime_now
 
         else:
-            dtime = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+            dtime = self.clock.now_str()
+
+        # история копирует числа в свои буферы, поэтому снимки структур не нужны
+        await self.log_history(dtime, received_structure, self.__securities)
+
+    @staticmethod
+    def _execution_waves(responses: tuple[StrategyResponse, ...]) -> list[list[StrategyResponse]]:
+        """
+        Делит заявки на волны подряд идущих заявок без повторов тикера. Сумма заявки зависит от позиции по ее
+        тикеру, поэтому повторная заявка по тикеру ждет следующей волны, и результат совпадает с исполнением заявок
+        по одной.
+
+        .. code-block:: python
+
+            >>> waves = Portfolio._execution_waves([StrategyResponse(ticker) for ticker in ['SBER', 'GAZP', 'SBER']])
+            >>> [[response.ticker for response in wave] for wave in waves]
+            [['SBER', 'GAZP'], ['SBER']]
+
+        :param responses: заявки стратегии;
+        :return: список волн
+        """
+        waves = []
+        tickers = set()
+
+        for response in responses:
+            if not waves or response.ticker in tickers:
+                waves.append([])
+                tickers = set()
 
-        await self.log_history(dtime, current_structure, deepcopy(received_structure), deepcopy(self.__securities))
+            waves[-1].append(response)
+            tickers.add(response.ticker)
+
+        return waves
 
     async def log_history(self,
                           timestamp: str,
-                          current_structure: Securities,
                           received_structure: Securities,
                           new_structure: Securities):
         """
-        После покупки логирует историю.
+        После покупки логирует историю. Состояние до покупки - предыдущая запись истории.
 
         :param timestamp: время совершения сделки. Формат '%Y-%m-%d %H:%M:%S' или '%Y-%m-%d'
-        :param current_structure: текущее состояние портфеля
         :param received_structure: полученное состояние портфеля
         :param new_structure: обновленное состояние портфеля
         """
@@ -253,7 +729,6 @@ class Portfolio:
         self.__history.log_history(
             self.__full_balance,
             timestamp,
-            current_structure,
             received_structure,
             new_structure
         )
@@ -273,7 +748,7 @@ class Portfolio:
         """
         self.available_structure[security] -= update_security_state.security_value()
 
-        cur_state: SecurityState = deepcopy(self.__securities[security])
+        cur_state: SecurityState = self.__securities[security]  # только читаем количество до сделки
         # Если мы докупаем бумаги, то их количество увеличивается, и цена взвешивается. Баланс просто уменьшается
 
         # Мы без бумаг или в длинной позиции
@@ -297,6 +772,7 @@ class Portfolio:
                 await self._same_directional_update(security, update_security_state)
 
         self.__free_balance -= exchange_fees
+        self.__ledger.fees += exchange_fees
         await self._update_full_balance()
 
     async def calc_amount(self, strategy_response: StrategyResponse) -> float:
@@ -312,6 +788,9 @@ class Portfolio:
         elif strategy_response.type_action == TypeAction.SELL:
             return await self.calc_amount_sell(strategy_response)
 
+        # стратегия ничего не делает - заявка на нулевую сумму
+        return 0
+
     async def calc_amount_buy(self, strategy_response: StrategyResponse) -> float:
         """
         Расчет количества свободных денег для покупки
@@ -324,20 +803,15 @@ class Portfolio:
         amt_money_2 = np.inf
 
         if strategy_response.quantity is not None:
-            if strategy_response.price is None:
-                price = await get_security_history_aiomoex(
-                    DataRequest(
-                        tickers=[strategy_response.ticker],
-                        dt_start=strategy_response.dtime_now,
-                        dt_end=(pd.Timestamp(strategy_response.dtime_now) + pd.Timedelta(days=1)).strftime("%Y-%m-%d"),
-                        dt_frequency='1d'
-                    )
-                )
-                if not price[strategy_response.ticker]['ok']:
+            if strategy_response.price is None and self.quotes is not None:
+                price = await self.quotes.price(strategy_response.ticker, TypeAction.BUY, self.client)
+                if price is None:
                     return 0
-                if price[strategy_response.ticker]['data'].empty:
+            elif strategy_response.price is None:
+                # та же цена, по которой заявка будет исполнена
+                price = await self.price_oracle.price(strategy_response.ticker, strategy_response.dtime_now)
+                if price is None:
                     return 0
-                price = price[strategy_response.ticker]['data']['close'].iloc[0]
             else:
                 price = strategy_response.price
 
@@ -357,16 +831,15 @@ class Portfolio:
         """
         avail_amt = 0
 
-        if strategy_response.price is None:
-            price = await get_security_history_aiomoex(
-                DataRequest(
-                    tickers=[strategy_response.ticker],
-                    dt_start=strategy_response.dtime_now,
-                    dt_end=(pd.Timestamp(strategy_response.dtime_now) + pd.Timedelta(days=1)).strftime("%Y-%m-%d"),
-                    dt_frequency='1d'
-                )
-            )
-            price = price[strategy_response.ticker]['data']['close'].iloc[0]
+        if strategy_response.price is None and self.quotes is not None:
+            price = await self.quotes.price(strategy_response.ticker, TypeAction.SELL, self.client)
+            if price is None:
+                return 0
+        elif strategy_response.price is None:
+            # та же цена, по которой заявка будет исполнена
+            price = await self.price_oracle.price(strategy_response.ticker, strategy_response.dtime_now)
+            if price is None:
+                return 0
         else:
             price = strategy_response.price
 
@@ -432,10 +905,9 @@ class Portfolio:
 
         # обновляем баланс и состояние по бумаге
         self.__free_balance -= update_security_state.security_value()
-        self.__securities[security].update_state(new_quantity, new_price,
-                                                 update_security_state.stop_loss,
-                                                 update_security_state.take_profit)
-        await self._update_full_balance()
+        await self._update_security_state(security, new_quantity, new_price,
+                                          update_security_state.stop_loss,
+                                          update_security_state.take_profit)
 
     async def _different_directional_update(self,
                                             security: str,
@@ -453,16 +925,25 @@ class Portfolio:
         if abs(cur_state.quantity) > abs(update_security_state.quantity):
             new_quantity = cur_state.quantity + update_security_state.quantity
             new_price = cur_state.price
+            closed_quantity = -update_security_state.quantity
+            # уровни остатка позиции не меняются
+            stop_loss, take_profit = cur_state.stop_loss, cur_state.take_profit
 
         # все продали / купили и вышли в другую позицию
         else:
             new_quantity = cur_state.quantity + update_security_state.quantity
             new_price = update_security_state.price
+            closed_quantity = cur_state.quantity
+            # новая позиция открыта этой заявкой, поэтому уровни - из заявки
+            stop_loss, take_profit = update_security_state.stop_loss, update_security_state.take_profit
+
+        # закрытая часть позиции фиксирует прибыль относительно цены входа
+        if closed_quantity:
+            self.__ledger.realise(closed_quantity * ((update_security_state.price or 0) - (cur_state.price or 0)))
 
         # обновляем баланс
         self.__free_balance -= update_security_state.security_value()
-        self.__securities[security].update_state(new_quantity, new_price)
-        await self._update_full_balance()
+        await self._update_security_state(security, new_quantity, new_price, stop_loss, take_profit)
 
     async def sell_all(self, dtime_now: str) -> None:
         """
@@ -486,96 +967,152 @@ class Portfolio:
 
     async def check_st_tp(self):
         """
-        Проверяет стоп-лосс и тейк профит
+        Проверяет стоп-лосс и тейк профит сразу по всем позициям: по свечам с прошлой проверки находит первый бар,
+        в котором задет уровень, и закрывает позицию временем этого бара по цене уровня (при разрыве - по цене
+        открытия бара). Если есть снимок котировок, то вместо свечей с уровнями сравнивается текущая цена.
+
+        .. code-block:: python
+
+            >>> from src.parse_securities.data_sources import MemoryDataSource
+            >>> bars = pd.DataFrame({'open': [100., 100.], 'high': [100., 101.], 'low': [100., 93.],
+            ...                      'close': [100., 99.], 'begin': ['2022-10-03 11:00:00', '2022-10-03 11:01:00']})
+            >>> clock = VirtualClock('2022-10-03 11:00:00')
+            >>> portfolio = Portfolio(10_000, ['SBER'], [1], data_source=MemoryDataSource({('SBER', '1min'): bars},
+            ...                       {'SBER': 1}), clock=clock, verbose=False)
+            >>> asyncio.run(portfolio.update_securities(StrategyResponse('SBER', TypeAction.BUY, stop_loss=95.)))
+            >>> _ = clock.set('2022-10-03 11:05:00')
+            >>> asyncio.run(portfolio.check_st_tp())
+            >>> portfolio.history_table.column('received_price')[-1], portfolio.realised_pnl  # стоп 95, не закрытие 99
+            (array([95.]), -500.0)
 
         :return: продает или покупает бумаги
         """
+        positions = [
+            (ticker, security) for ticker, security in self.__securities.items()
+            if security.quantity and (security.stop_loss is not None or security.take_profit is not None)
+        ]
         sell = []
-        for security in self.__securities:
-            try:
-                if self.__securities[security].quantity > 0:
-                    if self.__securities[security].price < self.__securities[security].stop_loss:
-                        sell.append(StrategyResponse(
-                            ticker=security,
-                            type_action=TypeAction.SELL,
-                            quantity=abs(self.__securities[security].quantity),
-                            dtime_now=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        ))
-                    elif self.__securities[security].price > self.__securities[security].take_profit:
-                        sell.append(StrategyResponse(
-                            ticker=security,
-                            type_action=TypeAction.SELL,
-                            quantity=abs(self.__securities[security].quantity),
-                            dtime_now=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        ))
-                elif self.__securities[security].quantity < 0:
-                    if self.__securities[security].price > self.__securities[security].stop_loss:
-                        sell.append(StrategyResponse(
-                            ticker=security,
-                            type_action=TypeAction.BUY,
-                            quantity=abs(self.__securities[security].quantity),
-                            dtime_now=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        ))
-                    elif self.__securities[security].price < self.__securities[security].take_profit:
-                        sell.append(StrategyResponse(
-                            ticker=security,
-                            type_action=TypeAction.BUY,
-                            quantity=abs(self.__securities[security].quantity),
-                            dtime_now=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        ))
-            except TypeError:
-                pass
+
+        if positions:
+            tickers = [ticker for ticker, _ in positions]
+            bars = await self._trigger_bars(tickers)
+            triggers = detect_triggers(
+                direction=np.array([security.quantity for _, security in positions]),
+                stop_loss=np.array([_to_float(security.stop_loss) for _, security in positions]),
+                take_profit=np.array([_to_float(security.take_profit) for _, security in positions]),
+                open_=bars['open'],
+                high=bars['high'],
+                low=bars['low'],
+                tie=self.trigger_tie
+            )
+
+            for row in np.flatnonzero(triggers['triggered']):
+                ticker, security = positions[row]
+                dtime = pd.Timestamp(bars['begin'][row, triggers['bar'][row]], unit='s')
+                sell.append(StrategyResponse(
+                    ticker=ticker,
+                    type_action=TypeAction.SELL if security.quantity > 0 else TypeAction.BUY,
+                    price=float(triggers['price'][row]),
+                    quantity=abs(security.quantity),
+                    dtime_now=dtime.strftime(DATETIME_FORMAT),
+                    at_price=True
+                ))
+
+            # сделки исполняются в порядке срабатывания
+            sell.sort(key=lambda response: response.dtime_now)
+
+        self.__checked_at = self.clock.now()
         await self.update_securities(*sell)
 
+    async def _trigger_bars(self, tickers: list[str]) -> dict[str, np.ndarray]:
+        """
+        Свечи для проверки стоп-лоссов и тейк-профитов: бары частоты исполнения заявок, которые начались после
+        прошлой проверки и до текущего времени (бар, который начинается сейчас, еще не закрылся). Если есть
+        снимок котировок, то один бар из текущей цены.
+
+        :param tickers: тикеры позиций;
+        :return: матрицы open, high, low, begin, см. st_triggers.stack_bars
+        """
+        if self.quotes is not None:
+            begin = int(self.clock.now().timestamp())
+            prices = [await self._mark_price(ticker) for ticker in tickers]
+            return stack_bars([
+                pd.DataFrame({'open': [price], 'high': [price], 'low': [price], 'begin': [begin]}) for price in prices
+            ])
+
+        history = await self.data_source.get_history(DataRequest(
+            tickers=tickers,
+            dt_start=(self.__checked_at + pd.Timedelta(seconds=1)).strftime(DATETIME_FORMAT),
+            dt_end=(self.clock.now() - pd.Timedelta(seconds=1)).strftime(DATETIME_FORMAT),
+            dt_frequency=self.price_oracle.resolutions[0],
+            columns=CANDLE_COLUMNS
+        ))
+
+        return stack_bars([
+            history[ticker]['data'] if history[ticker]['ok'] else pd.DataFrame(columns=['open', 'high', 'low', 'begin'])
+            for ticker in tickers
+        ])
+
     async def call_strategy(self) -> [StrategyResponse]:
         """
-        Вызывает стратегию
+        Вызывает стратегию. Часы симуляции сначала сдвигаются на день, с часами реального времени стратегия
+        вызывается на текущий момент.
 
-        :param dtime_now: текущее время;
         :return: None
         """
-        self.st_time = self.st_time + pd.Timedelta(days=1)
+        if isinstance(self.clock, VirtualClock):
+            self.clock.advance(pd.Timedelta(days=1))
+        await self._refresh_quotes()
         resps = []
         for ticker in self.available_structure.keys():
-            # проверим что не выходной
-            price = await get_security_history_aiomoex(DataRequest(
+            # проверим что не выходной: есть свеча текущего дня (свеча следующего дня есть и в воскресенье)
+            price = await self.data_source.get_history(DataRequest(
                 tickers=[ticker],
                 dt_start=self.st_time.strftime('%Y-%m-%d'),
-                dt_end=(self.st_time + pd.Timedelta('1d')).strftime('%Y-%m-%d'),
+                dt_end=self.st_time.strftime('%Y-%m-%d'),
                 dt_frequency='1d'
             ))
             if price[ticker]['ok']:
                 if not price[ticker]['data'].empty:
-                    prices = await get_security_history_aiomoex(DataRequest(
+                    prices = await self.data_source.get_history(DataRequest(
                         tickers=[ticker],
                         dt_end=(self.st_time + pd.Timedelta('1D')).strftime('%Y-%m-%d'),
                         dt_start=(self.st_time - pd.Timedelta('50D')).strftime('%Y-%m-%d'),
                         dt_frequency='1d'
                     ))
-                    st_response = await self.strategy(prices[ticker]['data'].close, ticker=ticker)
+                    st_response = await self.strategy(prices[ticker]['data'].set_index('begin').close, ticker=ticker)
                     st_response.ticker = ticker
-                    print(self.st_time, st_response)
-                    await self.update_securities(st_response)
+                    if self.verbose:
+                        print(self.st_time, st_response)
+                    await self.update_securities(st_response, refresh_quotes=False)
                     resps.append(st_response)
         await self.check_st_tp()
-        if self.st_time >= pd.Timestamp.now():
+        if self.clock.finished:
             self.flg_end_process = True
 
         return resps
 
 
 if __name__ == '__main__':
-    import asyncio
-    import json
-    from time import sleep
-
-    port = Portfolio(init_balance=100_000, strategy=get_decision_macd_conservative_strategy)
-    for i in range(30):
-        try:
-            asyncio.run(port.call_strategy())
-        except Exception as e:
-            print(f'время подождем : {e}')
-            sleep(5)
+    from src.parse_securities.moex_client import shutdown_moex_client, startup_moex_client
+
+    port = Portfolio(init_balance=100_000, strategy=get_decision_macd_conservative_strategy,
+                     clock=VirtualClock(SIMULATION_START))
+
+
+    async def main():
+        # весь прогон идет в одном event loop, чтобы все запросы шли через один пул соединений.
+        # Ограничения биржи обрабатывает ограничитель запросов клиента (повторы с паузой), поэтому день не теряется
+        await startup_moex_client()
+        for i in range(30):
+            await port.call_strategy()
+
+        print(get_moex_client().limiter.stats())
+
+        await shutdown_moex_client()
+
+
+    asyncio.run(main())
 
     # print(port.securities, port.free_balance, port.available_structure)
     # i = 0
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime
 
 import pandas as pd
 
-from src.parse_securities.async_moex import get_security_history_aiomoex
-from src.structures.st_strategies import DataRequest, TypeAction
+from src.parse_securities.data_sources import BaseDataSource, MoexDataSource
+from src.parse_securities.moex_client import MoexClient, get_moex_client
+from src.parse_securities.price_oracle import PriceOracle
+from src.parse_securities.quotes import QuoteSnapshot
+from src.parse_securities.security_master import get_security_master
+from src.structures.st_strategies import TypeAction
 
 
 class DataMessage:
@@ -29,6 +34,7 @@ class DataMessage:
 
 
 class StockPurchaseRequest:
+    __slots__ = ('ticker', 'type_action', 'price', 'amt_assets', 'dtime_now')
 
     def __init__(self,
                  ticker: str,
@@ -62,13 +68,15 @@ class StockPurchaseRequest:
 
         :return: Возвращает словарь с информацией о покупке
         """
-        return self.__dict__
+        return {name: getattr(self, name) for name in self.__slots__}
 
     def __repr__(self) -> str:
         return str(self.get_state())
 
 
 class StockPurchaseResponse:
+    __slots__ = ('message', 'ticker', 'market_price', 'quantity', 'lot_quantity', 'exchange_fee', 'dt_purchase',
+                 'type_purchase')
 
     def __init__(self,
                  message: DataMessage,
@@ -112,12 +120,35 @@ class StockPurchaseResponse:
 
 class StockPurchaseProcessMoex:
 
-    def __init__(self, purchase_requests: list[StockPurchaseRequest]):
+    def __init__(self,
+                 purchase_requests: list[StockPurchaseRequest],
+                 client: MoexClient = None,
+                 data_source: BaseDataSource = None,
+                 quotes: QuoteSnapshot = None,
+                 price_oracle: PriceOracle = None,
+                 refresh_quotes: bool = True):
         """
+        Исполнение пачки заявок. Цены для всех заявок загружаются за один проход: один запрос к оракулу цен на
+        все тикеры с одинаковым временем заявки, запросы с разным временем идут одновременно. Ответы возвращаются
+        в порядке заявок.
+
         :param purchase_requests: запросы от стратегии
+        :param client: клиент MOEX ISS с общим пулом соединений. По умолчанию общий клиент процесса;
+        :param data_source: источник рыночных данных. По умолчанию MOEX ISS через client;
+        :param quotes: снимок текущих котировок. Если указан, то заявки исполняются по текущим ценам
+                       (покупка по OFFER, продажа по BID) из одного запроса на все тикеры, а не по минутным свечам;
+        :param price_oracle: оракул цен, общий с расчетом суммы заявки и оценкой портфеля. По умолчанию цены
+                             минутных свечей из data_source, а без них - закрытие прошлого дня;
+        :param refresh_quotes: обновить ли снимок котировок перед исполнением, если он устарел. False - исполнить по
+                               текущему снимку (например, портфель уже обновил его в начале шага)
         """
         self.purchase_requests = purchase_requests
-        self.data: dict = {}
+        self.client = client if client is not None else get_moex_client()
+        self.data_source = data_source if data_source is not None else MoexDataSource(self.client)
+        self.quotes = quotes
+        self.price_oracle = price_oracle if price_oracle is not None else PriceOracle(self.data_source)
+        self.refresh_quotes = refresh_quotes
+        self.data: list[dict] = []  # данные о цене для каждой заявки, в порядке purchase_requests
 
     async def __call__(self) -> list[StockPurchaseResponse]:
         """
@@ -127,15 +158,15 @@ class StockPurchaseProcessMoex:
         await self._data_update()
         responses = []
 
-        for req in self.purchase_requests:
-            data = self.data[req.ticker]
+        for req, data in zip(self.purchase_requests, self.data):
             quantity = 0
             num_lots = 0
 
             market_price = None
 
-            if data['ok'] and not data['data'].empty:
-                market_price = data['data']['close'].iloc[-1]
+            # заявка с ценой (закрытие по уровню стоп-лосса или тейк-профита) исполняется по своей цене
+            if data['ok'] and (req.price is not None or not data['data'].empty):
+                market_price = req.price if req.price is not None else data['data']['close'].iloc[-1]
 
                 calc_quantity = await self.calc_purchase_quantity(market_price, req.amt_assets)
                 num_lots = int(calc_quantity / data['lotsize'])
@@ -156,6 +187,7 @@ class StockPurchaseProcessMoex:
                     market_price=market_price,
                     quantity=quantity,
                     lot_quantity=num_lots,
+                    dt_purchase=req.dtime_now,
                 )
             )
         return responses
@@ -207,23 +239,61 @@ class StockPurchaseProcessMoex:
 
     async def _data_update(self) -> None:
         """
-        Обновляет данные о бумаге;
+        Обновляет данные о бумагах всех заявок: заявки группируются по времени, на каждую группу - один запрос
+        к оракулу цен по всем ее тикерам, запросы групп идут одновременно.
+
+        """
+        if self.quotes is not None:
+            self.data = await self._quotes_update()
+            return
+
+        groups: dict[str, list[str]] = {}  # время заявки -> тикеры
+        for req in self.purchase_requests:
+            groups.setdefault(req.dtime_now, []).append(req.ticker)
+
+        await asyncio.gather(*(self.price_oracle.prefetch(tickers, dtime_now) for dtime_now, tickers in groups.items()))
+
+        self.data = [await self.price_oracle.response(req.ticker, req.dtime_now) for req in self.purchase_requests]
+
+    async def _quotes_update(self) -> list[dict]:
+        """
+        Собирает данные о бумагах из снимка котировок в том же формате, что и история цен:
+        цена исполнения заявки - единственное значение колонки close.
+
+        :return: список {'ok', 'message', 'lotsize', 'data'} в порядке заявок
+        """
+        if self.refresh_quotes:
+            await self.quotes.refresh(self.client)
 
+        return list(await asyncio.gather(*(self._quote_data(req) for req in self.purchase_requests)))
+
+    async def _quote_data(self, req: StockPurchaseRequest) -> dict:
+        """
+        :param req: заявка;
+        :return: данные о цене исполнения заявки из снимка котировок
         """
-        data_request = DataRequest(
-            tickers=[strategy_request.ticker for strategy_request in self.purchase_requests],
-            dt_start=self.purchase_requests[0].dtime_now,
-            dt_end=(pd.Timestamp(self.purchase_requests[0].dtime_now) +
-                    pd.Timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M:%S'),
-            dt_frequency='1min'
-        )
-        self.data = await get_security_history_aiomoex(data_request)
+        lotsize = await get_security_master().lotsize(req.ticker, self.client)
+
+        if lotsize is None:
+            return {'ok': False, 'message': f'Тикера {req.ticker} нет на MOEX', 'lotsize': None,
+                    'data': pd.DataFrame()}
+
+        price = await self.quotes.price(req.ticker, req.type_action, self.client)
+
+        return {
+            'ok': True,
+            'message': '',
+            'lotsize': lotsize,
+            'data': pd.DataFrame({'close': [price]} if price is not None else {'close': []}, dtype=float)
+        }
 
 
 if __name__ == '__main__':
     # import doctest
     import asyncio
 
+    from src.parse_securities.moex_client import shutdown_moex_client
+
     # doctest.testmod()
 
     reqs = [
@@ -232,7 +302,13 @@ if __name__ == '__main__':
         StockPurchaseRequest('appl', TypeAction.NOTHING, 100, dtime_now='2022-12-06 11:00:00')
     ]
 
-    process = StockPurchaseProcessMoex(reqs)
-    resps = asyncio.run(process())
+    async def main():
+        process = StockPurchaseProcessMoex(reqs)
+        try:
+            return await process()
+        finally:
+            await shutdown_moex_client()
+
+    resps = asyncio.run(main())
 
     print(resps)
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
-from copy import copy
+from collections import deque
 
 PRICE_PRECISION = 16
+SECURITY_HISTORY_SIZE = 256  # сколько последних состояний бумаги хранит SecurityState. None - без ограничения
+MAX_LEVERAGE = 0.75  # короткая позиция по бумаге - не больше этой доли выделенного на бумагу капитала
 
 
 class StockSecurityPrice:
@@ -19,27 +21,44 @@ class StockSecurityPrice:
 
 
 class SecurityState:
+    __slots__ = ('quantity', 'price', 'stop_loss', 'take_profit', 'history_security')
 
     def __init__(self,
                  quantity: int = 0,
                  price: float = 0,
                  stop_loss: float = None,
-                 take_profit: float = None):
+                 take_profit: float = None,
+                 history_size: int | None = SECURITY_HISTORY_SIZE):
         """
         Конструктор класса, который будет хранить состояние конкретной бумаги.
 
+        История состояний - кольцевой буфер из ``history_size`` последних состояний, поэтому память на позицию
+        не растет с длиной симуляции. Полная история изменений портфеля хранится в PortfolioHistory.
+
         .. note:: Стоп лосс и тейк профит пока исполняют заявку по бумаге в полном объеме
 
+        .. code-block:: python
+
+            >>> security_state = SecurityState(1, 2, history_size=2)
+            >>> for price in (3, 4):
+            ...     security_state.update_state(1, price)
+            >>> [state['price'] for state in security_state.history_security]
+            [3, 4]
+
         :param quantity: количество актива;
         :param stop_loss: Цена с целью ограничить свои убытки;
         :param take_profit: Цена, при которой мы получаем таргетированную выгоду;
-        :param price: цена актива
+        :param price: цена актива;
+        :param history_size: сколько последних состояний хранить. None - всю историю, 0 - не хранить историю
         """
         self.quantity: int = quantity
         self.price: float = price
         self.stop_loss = stop_loss
         self.take_profit = take_profit
-        self.history_security: list[dict] = [self._get_state()]
+        self.history_security: deque[dict] = deque(maxlen=history_size)
+
+        if history_size != 0:
+            self.history_security.append(self._get_state())
 
     def _get_state(self) -> dict:
         """
@@ -92,7 +111,7 @@ class SecurityState:
             >>> security_state
             {'quantity': 5, 'price': 6, 'sl': 3, 'tp': 4}
 
-            >>> security_state.history_security
+            >>> list(security_state.history_security)
             [{'quantity': 1, 'price': 2, 'sl': 3, 'tp': 4}, {'quantity': 5, 'price': 6, 'sl': 3, 'tp': 4}]
 
         :param new_quantity: количество актива;
@@ -106,7 +125,8 @@ class SecurityState:
         self.stop_loss = sl
         self.take_profit = tp
 
-        self.history_security.append(self._get_state())
+        if self.history_security.maxlen != 0:
+            self.history_security.append(self._get_state())
 
     def short_state(self) -> SecurityState:
         """
@@ -119,9 +139,7 @@ class SecurityState:
 
         :return: возвращает состояние бумаги без ее истории. Не изменяет объект
         """
-        copy_self = copy(self)
-        copy_self.history_security = []
-        return copy_self
+        return self.__class__(self.quantity, self.price, self.stop_loss, self.take_profit, history_size=0)
 
 
 class InfoSecurityRequest:
@@ -17,6 +17,8 @@ class StrategyResponse:
     """
     Класс, в котором определена общая структура ответа от стратегии
     """
+    __slots__ = ('ticker', 'type_action', 'price', 'quantity', 'dtime_now', 'stop_loss', 'take_profit', 'comment',
+                 'at_price')
 
     def __init__(self,
                  ticker: str = None,
@@ -26,7 +28,8 @@ class StrategyResponse:
                  dtime_now: str = None,
                  stop_loss: float = None,
                  take_profit: float = None,
-                 comment: str = None):
+                 comment: str = None,
+                 at_price: bool = False):
         """
         Конструктор класса
 
@@ -38,6 +41,8 @@ class StrategyResponse:
         :param stop_loss: стоп-лосс
         :param take_profit: тейк-профит
         :param comment: комментарий, описание действия, которое нужно совершить
+        :param at_price: исполнить заявку по price, а не по рыночной цене (например, закрытие позиции по уровню
+                         стоп-лосса или тейк-профита)
         """
 
         self.ticker = ticker
@@ -48,6 +53,7 @@ class StrategyResponse:
         self.take_profit = take_profit
         self.comment = comment
         self.quantity = quantity
+        self.at_price = at_price
 
     def __repr__(self):
         return f'StrategyResponse(' \
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+TIE_STOP = 'stop'  # если за бар задеты оба уровня, считаем, что первым сработал стоп-лосс (консервативно)
+TIE_TAKE = 'take'  # первым сработал тейк-профит
+TIE_OPEN = 'open'  # первым сработал уровень, который ближе к цене открытия бара
+TIE_POLICIES = (TIE_STOP, TIE_TAKE, TIE_OPEN)
+
+
+class TriggerKind:
+    """
+    Класс, в котором определены типы срабатывания уровней
+    """
+
+    NOTHING = 0
+    STOP_LOSS = 1
+    TAKE_PROFIT = 2
+
+
+def stack_bars(frames: list[pd.DataFrame]) -> dict[str, np.ndarray]:
+    """
+    Собирает свечи нескольких бумаг в матрицы (бумаги x бары). Бумаги с меньшим количеством свечей дополняются
+    nan, время - значением -1.
+
+    .. code-block:: python
+
+        >>> bars = stack_bars([pd.DataFrame({'open': [1., 2.], 'high': [1., 2.], 'low': [1., 2.], 'begin': [0, 60]}),
+        ...                    pd.DataFrame({'open': [3.], 'high': [3.], 'low': [3.], 'begin': [0]})])
+        >>> bars['low'], bars['begin']
+        (array([[ 1.,  2.],
+               [ 3., nan]]), array([[ 0, 60],
+               [ 0, -1]]))
+
+    :param frames: свечи каждой бумаги с колонками open, high, low, begin (epoch seconds);
+    :return: словарь open, high, low, begin с матрицами
+    """
+    width = max((len(frame) for frame in frames), default=0)
+    bars = {column: np.full((len(frames), width), np.nan) for column in ('open', 'high', 'low')}
+    bars['begin'] = np.full((len(frames), width), -1, dtype=np.int64)
+
+    for row, frame in enumerate(frames):
+        for column in bars:
+            bars[column][row, :len(frame)] = frame[column].to_numpy()
+
+    return bars
+
+
+def detect_triggers(direction: np.ndarray,
+                    stop_loss: np.ndarray,
+                    take_profit: np.ndarray,
+                    open_: np.ndarray,
+                    high: np.ndarray,
+                    low: np.ndarray,
+                    tie: str = TIE_STOP) -> dict[str, np.ndarray]:
+    """
+    Находит для каждой позиции первый бар, в котором цена задела стоп-лосс или тейк-профит, сразу по всем позициям.
+    Длинная позиция закрывается по стоп-лоссу, если low <= stop_loss, по тейк-профиту, если high >= take_profit;
+    короткая - наоборот. Если за один бар задеты оба уровня, то первым считается уровень, через который бар открылся
+    с разрывом, а иначе - по правилу ``tie``. Цена исполнения - уровень, а при разрыве - цена открытия бара.
+
+    .. code-block:: python
+
+        >>> result = detect_triggers(
+        ...     direction=np.array([1, 1, -1]),
+        ...     stop_loss=np.array([95., 95., 105.]),
+        ...     take_profit=np.array([110., np.nan, 90.]),
+        ...     open_=np.array([[100., 100.], [100., 94.], [100., 100.]]),
+        ...     high=np.array([[101., 112.], [101., 96.], [101., 106.]]),
+        ...     low=np.array([[99., 94.], [99., 93.], [99., 89.]]),
+        ... )
+        >>> result['bar'], result['kind'], result['price']
+        (array([1, 1, 1]), array([1, 1, 1]), array([ 95.,  94., 105.]))
+        >>> detect_triggers(np.array([1]), np.array([95.]), np.array([110.]), np.array([[109.]]),
+        ...                 np.array([[112.]]), np.array([[94.]]), tie=TIE_OPEN)['kind']
+        array([2])
+
+    :param direction: знак позиции по каждой бумаге: 1 - длинная, -1 - короткая, 0 - позиции нет;
+    :param stop_loss: стоп-лосс по каждой бумаге, nan - уровня нет;
+    :param take_profit: тейк-профит по каждой бумаге, nan - уровня нет;
+    :param open_: цены открытия, матрица (бумаги x бары), nan - бара нет;
+    :param high: максимальные цены, матрица (бумаги x бары);
+    :param low: минимальные цены, матрица (бумаги x бары);
+    :param tie: правило, если за один бар задеты оба уровня: TIE_STOP, TIE_TAKE или TIE_OPEN;
+    :return: словарь массивов по бумагам: triggered - сработал ли уровень, bar - номер бара (-1, если не сработал),
+             kind - TriggerKind, price - цена исполнения (nan, если не сработал)
+    """
+    if tie not in TIE_POLICIES:
+        raise ValueError(f'Правило {tie} не поддерживается, доступны {TIE_POLICIES}')
+
+    direction = np.sign(np.asarray(direction, dtype=float))[:, None]
+    stop_loss = np.asarray(stop_loss, dtype=float)[:, None]
+    take_profit = np.asarray(take_profit, dtype=float)[:, None]
+    long, short = direction > 0, direction < 0
+
+    # сравнения с nan дают False, поэтому отсутствующие уровни и бары не срабатывают
+    with np.errstate(invalid='ignore'):
+        stop_hit = (long & (low <= stop_loss)) | (short & (high >= stop_loss))
+        take_hit = (long & (high >= take_profit)) | (short & (low <= take_profit))
+        stop_gap = (long & (open_ <= stop_loss)) | (short & (open_ >= stop_loss))
+        take_gap = (long & (open_ >= take_profit)) | (short & (open_ <= take_profit))
+
+    hit = stop_hit | take_hit
+    rows = np.arange(hit.shape[0])
+
+    if hit.shape[1] == 0:
+        return {'triggered': np.zeros(len(rows), dtype=bool), 'bar': np.full(len(rows), -1),
+                'kind': np.full(len(rows), TriggerKind.NOTHING), 'price': np.full(len(rows), np.nan)}
+
+    bar = hit.argmax(axis=1)
+    triggered = hit[rows, bar]
+    bar_open = open_[rows, bar]
+
+    if tie == TIE_STOP:
+        stop_by_policy = np.ones(len(rows), dtype=bool)
+    elif tie == TIE_TAKE:
+        stop_by_policy = np.zeros(len(rows), dtype=bool)
+    else:
+        stop_by_policy = np.abs(bar_open - stop_loss[:, 0]) <= np.abs(bar_open - take_profit[:, 0])
+
+    # при разрыве на открытии первым срабатывает уровень, через который открылся бар
+    stop_wins_tie = stop_gap[rows, bar] | (~take_gap[rows, bar] & stop_by_policy)
+    is_stop = stop_hit[rows, bar] & (~take_hit[rows, bar] | stop_wins_tie)
+
+    kind = np.where(~triggered, TriggerKind.NOTHING, np.where(is_stop, TriggerKind.STOP_LOSS, TriggerKind.TAKE_PROFIT))
+
+    level = np.where(is_stop, stop_loss[:, 0], take_profit[:, 0])
+    gap = np.where(is_stop, stop_gap[rows, bar], take_gap[rows, bar])
+    price = np.where(triggered, np.where(gap, bar_open, level), np.nan)
+
+    return {'triggered': triggered, 'bar': np.where(triggered, bar, -1), 'kind': kind, 'price': price}
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()